@@ -2,12 +2,15 @@ from PyQt5.QtCore import QUrl
 import uuid
 import asyncio
 import json
+from collections import deque
 import pylsl
 from PyQt5.QtCore import QObject, pyqtSignal
 from PyQt5.QtWebSockets import QWebSocket
 
 LOCAL_BASE_URL = "ws://localhost:8000/api/v1"
 ONLINE_BASE_URL = "ws://server.neurohike.quest/api/v1"
+# Sent chunks kept until the server acknowledges them, to replay after a reconnect
+REPLAY_BUFFER_SIZE = 256
 
 
 class WebSocketHandler(QObject):
@@ -24,11 +27,16 @@ class WebSocketHandler(QObject):
         self.websocket = QWebSocket()
         self.websocket.connected.connect(self.connected)
         self.websocket.disconnected.connect(self.disconnected)
+        self.websocket.disconnected.connect(self.on_disconnected)
         self.websocket.textMessageReceived.connect(
             self.on_text_message_recieved)
 
         # Connection status for reconnect attempts
         self.connected_successfully = False
+        # Once started, reconnecting resumes the session instead of restarting it
+        self.started = False
+        self.next_sequence = 0
+        self.unacked = deque(maxlen=REPLAY_BUFFER_SIZE)
 
     def connect(self, server_type="local"):
         base_url = LOCAL_BASE_URL if server_type == "local" else ONLINE_BASE_URL
@@ -38,35 +46,68 @@ class WebSocketHandler(QObject):
     async def send_initial_frame(self):
         # Made this method asynchronous
         initial_frame = {
-            "type": "START",
+            "type": "RESUME" if self.started else "START",
             "session_id": self.session_id,
-            "channel_labels": self.channel_labels,
-            "sampling_rate": 250,
+            # "ACK <sequence>" every few chunks instead of one per chunk
+            "ack_mode": "cumulative",
         }
-        print("Sending initial frame")
+        if not self.started:
+            initial_frame["channel_labels"] = self.channel_labels
+            initial_frame["sampling_rate"] = 250
+        print(f"Sending initial frame ({initial_frame['type']})")
         await asyncio.sleep(0.1)  # Wait for the connection to open
         print(f"Socket state: {self.websocket.state()}")
         if self.websocket.state() == 3:  # QAbstractSocket::ConnectedState = 3
             self.websocket.sendTextMessage(json.dumps(initial_frame))
+            self.started = True
 
     async def send_data(self, data):
         if self.websocket.state() == 3:
             data = {
                 "type": "EEG_DATA",
                 "session_id": self.session_id,
+                "sequence": self.next_sequence,
                 "data": data["data"],
                 "timestamps": data["timestamps"]
             }
-            self.websocket.sendTextMessage(json.dumps(data))
+            self.next_sequence += 1
+            message = json.dumps(data)
+            self.unacked.append((data["sequence"], message))
+            self.websocket.sendTextMessage(message)
         else:
             raise ValueError("Websocket is not connected")
 
+    def replay(self, next_sequence):
+        """Resend the chunks the server has not received, from `next_sequence` on."""
+        for sequence, message in self.unacked:
+            if sequence >= next_sequence:
+                self.websocket.sendTextMessage(message)
+
+    def on_disconnected(self):
+        self.connected_successfully = False
+
     def on_text_message_recieved(self, message):
         if message.startswith("ACK"):
+            acked = message[len("ACK"):].strip()
+            if acked:
+                # Cumulative ACK, everything up to it arrived
+                while self.unacked and self.unacked[0][0] <= int(acked):
+                    self.unacked.popleft()
             self.connected_successfully = True
             self.connectionAcknowledged.emit()
-        else:
-            self.textMessageReceived.emit(message)
+            return
+        try:
+            reply = json.loads(message)
+        except ValueError:
+            reply = None
+        if isinstance(reply, dict) and reply.get("type") == "RESUME":
+            print(f"Resuming at chunk {reply['next_sequence']}")
+            self.replay(reply["next_sequence"])
+        elif isinstance(reply, dict) and "Nothing to resume" in str(reply.get("error")):
+            # The server already ended the session, start it over
+            self.started = False
+            asyncio.ensure_future(self.send_initial_frame())
+        self.textMessageReceived.emit(message)
 
 
 async def lsl_stream_to_websocket(self, stream_config, server_type="local"):
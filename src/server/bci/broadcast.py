@@ -0,0 +1,68 @@
+'''
+Fan-out of classification results to the WebSockets subscribed to a session.
+'''
+
+import asyncio
+import threading
+from typing import List, Optional, Tuple
+
+from server.bci.models import ClassificationResult
+
+
+def result_message(result: ClassificationResult) -> dict:
+    """WebSocket frame carrying a classification result."""
+    return {"type": "CLASSIFICATION_RESULT", **result.model_dump(mode="json")}
+
+
+class ResultBroadcaster:
+    """
+    Publishes the classification results of one session to any number of subscribers.
+
+    Each subscriber owns a bounded asyncio queue on its event loop. Results can
+    be published from any thread, a subscriber that falls behind loses its
+    oldest results rather than delaying the others. Publishing `None` tells the
+    subscribers the session has ended.
+    """
+
+    def __init__(self, max_queue: int = 32):
+        self.max_queue = max_queue
+        self._subscribers: List[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def has_subscribers(self) -> bool:
+        return bool(self._subscribers)
+
+    def __len__(self) -> int:
+        return len(self._subscribers)
+
+    def subscribe(self) -> asyncio.Queue:
+        """Register a subscriber on the running event loop and return its queue."""
+        queue = asyncio.Queue(maxsize=self.max_queue)
+        with self._lock:
+            self._subscribers.append((asyncio.get_running_loop(), queue))
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        with self._lock:
+            self._subscribers = [(loop, q) for loop, q in self._subscribers if q is not queue]
+
+    @staticmethod
+    def _offer(queue: asyncio.Queue, item):
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(item)
+
+    def publish(self, item: Optional[dict]):
+        """Send a result to every subscriber, `None` to signal the end of the session."""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._offer, queue, item)
+            except RuntimeError:
+                # The subscriber's event loop is gone
+                self.unsubscribe(queue)
+
+    def close(self):
+        self.publish(None)
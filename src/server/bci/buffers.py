@@ -0,0 +1,210 @@
+'''
+Preallocated NumPy buffers for streamed EEG.
+
+Samples are stored channel-major, i.e. as (n_channels, n_samples) arrays, which
+is the layout MNE and the classifiers expect.
+'''
+
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+from mne import Info
+from mne.io import RawArray
+
+from server.bci.models import EEGChunk
+from server.bci.frames import EEGFrame
+
+
+def chunk_to_arrays(chunk: Union[EEGChunk, EEGFrame]) -> Tuple[np.ndarray, np.ndarray]:
+    '''Convert an incoming chunk to (channel-major samples, timestamps) arrays.
+
+    Binary frames are already arrays, so this only returns a transposed view of them.
+    '''
+    samples = np.asarray(chunk.data, dtype=np.float32)
+    timestamps = np.asarray(chunk.timestamps, dtype=np.float64)
+    if samples.ndim != 2:
+        raise ValueError("EEG data must be a list of samples, one value per channel")
+    if timestamps.shape[0] != samples.shape[0]:
+        raise ValueError(
+            f"Got {samples.shape[0]} samples but {timestamps.shape[0]} timestamps")
+    return samples.T, timestamps
+
+
+class EEGRingBuffer:
+    """
+    Fixed-capacity ring buffer of EEG samples with a matching timestamp ring.
+
+    Both rings are allocated once, appending a chunk copies it into place in at
+    most two slices. Samples are addressed by their absolute index in the stream
+    (`total_samples` counts every sample ever appended), so readers can keep
+    positions across appends. Reads return views into the ring unless the
+    requested range wraps around the end of the storage, in which case it is
+    copied.
+    """
+
+    def __init__(self, n_channels: int, capacity: int, sfreq: Optional[float] = None,
+                 dtype=np.float32):
+        if capacity < 1:
+            raise ValueError("Ring buffer capacity must be at least one sample")
+        self.n_channels = n_channels
+        self.capacity = capacity
+        self.sfreq = sfreq
+        self.data = np.zeros((n_channels, capacity), dtype=dtype)
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.total_samples = 0
+
+    @classmethod
+    def for_stream(cls, n_channels: int, sfreq: float, seconds: float,
+                   max_bytes: int) -> 'EEGRingBuffer':
+        '''Size a buffer for `seconds` of data, capped at `max_bytes` of memory.'''
+        bytes_per_sample = n_channels * np.dtype(np.float32).itemsize + \
+            np.dtype(np.float64).itemsize
+        capacity = min(int(seconds * sfreq), max_bytes // bytes_per_sample)
+        return cls(n_channels, max(capacity, 1), sfreq=sfreq)
+
+    def __len__(self) -> int:
+        return min(self.total_samples, self.capacity)
+
+    @property
+    def first_index(self) -> int:
+        """Absolute index of the oldest sample still held in the buffer."""
+        return self.total_samples - len(self)
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes + self.timestamps.nbytes
+
+    def append(self, samples: np.ndarray, timestamps: np.ndarray):
+        '''Append a channel-major chunk of shape (n_channels, n_samples).'''
+        if samples.shape[0] != self.n_channels:
+            raise ValueError(
+                f"Expected {self.n_channels} channels, got {samples.shape[0]}")
+        n = samples.shape[1]
+        if n == 0:
+            return
+        if n > self.capacity:
+            # Only the tail fits, skip the samples that would be overwritten anyway
+            skipped = n - self.capacity
+            samples = samples[:, skipped:]
+            timestamps = timestamps[skipped:]
+            self.total_samples += skipped
+            n = self.capacity
+
+        start = self.total_samples % self.capacity
+        first = min(n, self.capacity - start)
+        self.data[:, start:start + first] = samples[:, :first]
+        self.timestamps[start:start + first] = timestamps[:first]
+        if first < n:
+            self.data[:, :n - first] = samples[:, first:]
+            self.timestamps[:n - first] = timestamps[first:]
+        self.total_samples += n
+
+    def read(self, start: int, stop: int) -> Tuple[np.ndarray, np.ndarray]:
+        '''Return samples and timestamps for the absolute index range [start, stop).'''
+        if start < self.first_index or stop > self.total_samples or start > stop:
+            raise IndexError(
+                f"Range [{start}, {stop}) is outside the buffered range "
+                f"[{self.first_index}, {self.total_samples})")
+        n = stop - start
+        offset = start % self.capacity
+        if offset + n <= self.capacity:
+            return self.data[:, offset:offset + n], self.timestamps[offset:offset + n]
+        # Wraps around the end of the storage
+        first = self.capacity - offset
+        data = np.concatenate(
+            (self.data[:, offset:], self.data[:, :n - first]), axis=1)
+        timestamps = np.concatenate(
+            (self.timestamps[offset:], self.timestamps[:n - first]))
+        return data, timestamps
+
+    def latest(self, n: int) -> Tuple[np.ndarray, np.ndarray]:
+        '''Return the `n` most recent samples (fewer if the buffer holds less).'''
+        n = min(n, len(self))
+        return self.read(self.total_samples - n, self.total_samples)
+
+    def last_seconds(self, seconds: float) -> Tuple[np.ndarray, np.ndarray]:
+        '''Return the most recent `seconds` of data.'''
+        if not self.sfreq:
+            raise ValueError("Sampling rate is unknown")
+        return self.latest(int(round(seconds * self.sfreq)))
+
+    def clear(self):
+        self.total_samples = 0
+
+
+class CalibrationRecorder:
+    """
+    Append-only recorder for the EEG of a calibration run.
+
+    The first block is sized for the whole protocol, so a calibration that
+    follows its protocol is written into a single preallocated array and
+    `to_raw` hands a view of it to MNE without copying. If more samples than
+    expected arrive, further blocks of `growth_seconds` are allocated and
+    joined once when the raw object is built.
+    """
+
+    def __init__(self, n_channels: int, sfreq: float, duration: float,
+                 growth_seconds: float = 10.0):
+        self.n_channels = n_channels
+        self.sfreq = sfreq
+        self.target_samples = int(round(duration * sfreq))
+        self.growth_samples = max(int(growth_seconds * sfreq), 1)
+        self.blocks: List[np.ndarray] = []
+        self.timestamp_blocks: List[np.ndarray] = []
+        self.n_samples = 0
+        self._block_fill = 0
+        self._add_block(max(self.target_samples, 1))
+
+    def _add_block(self, size: int):
+        self.blocks.append(np.empty((self.n_channels, size), dtype=np.float64))
+        self.timestamp_blocks.append(np.empty(size, dtype=np.float64))
+        self._block_fill = 0
+
+    @property
+    def nbytes(self) -> int:
+        return sum(block.nbytes for block in self.blocks) + \
+            sum(block.nbytes for block in self.timestamp_blocks)
+
+    @property
+    def remaining(self) -> int:
+        return max(self.target_samples - self.n_samples, 0)
+
+    @property
+    def is_complete(self) -> bool:
+        return self.n_samples >= self.target_samples
+
+    def append(self, samples: np.ndarray, timestamps: np.ndarray):
+        '''Append a channel-major chunk of shape (n_channels, n_samples).'''
+        if samples.shape[0] != self.n_channels:
+            raise ValueError(
+                f"Expected {self.n_channels} channels, got {samples.shape[0]}")
+        written = 0
+        n = samples.shape[1]
+        while written < n:
+            block = self.blocks[-1]
+            if self._block_fill == block.shape[1]:
+                self._add_block(self.growth_samples)
+                block = self.blocks[-1]
+            count = min(n - written, block.shape[1] - self._block_fill)
+            block[:, self._block_fill:self._block_fill + count] = \
+                samples[:, written:written + count]
+            self.timestamp_blocks[-1][self._block_fill:self._block_fill + count] = \
+                timestamps[written:written + count]
+            self._block_fill += count
+            written += count
+        self.n_samples += n
+
+    def _joined(self, blocks: List[np.ndarray]) -> np.ndarray:
+        trimmed = blocks[:-1] + [blocks[-1][..., :self._block_fill]]
+        if len(trimmed) == 1:
+            return trimmed[0]
+        return np.concatenate(trimmed, axis=-1)
+
+    def get_data(self) -> Tuple[np.ndarray, np.ndarray]:
+        '''Return the recorded samples and timestamps, copying only if the recording grew.'''
+        return self._joined(self.blocks), self._joined(self.timestamp_blocks)
+
+    def to_raw(self, info: Info) -> RawArray:
+        '''Build the MNE RawArray of the recording.'''
+        data, _ = self.get_data()
+        return RawArray(data, info, copy="auto", verbose=False)
@@ -0,0 +1,177 @@
+'''
+Timestamp regularization of streamed EEG.
+
+Headsets stamp their samples with the LSL clock, and those timestamps jitter,
+drift from the declared sampling rate, repeat when a chunk is resent and jump
+when samples are lost. `ClockModel` fits a linear model of the LSL time of
+each sample against its index in the stream and resamples the chunks onto a
+uniform grid at the declared sampling rate, so the sample index of the
+session buffers maps to time by index arithmetic alone.
+'''
+
+from typing import Optional, Tuple
+
+import numpy as np
+
+
+class ClockModel:
+    """
+    Linear clock model of one stream, t = offset + slope * index.
+
+    Every chunk goes through three vectorized steps:
+
+    1. Samples not later than the last accepted one are duplicates, dropped.
+    2. Each remaining sample gets its index in the stream, counting the
+       samples missing in the gap before it at the declared rate. The model
+       is refitted by least squares over the last `window_seconds`, which
+       removes the jitter of the individual timestamps and follows the drift
+       of the device clock.
+    3. The dejittered samples are linearly interpolated onto the grid
+       origin + k / sfreq, up to the last sample received. Grid points past it
+       are emitted with the next chunk, so the output lags the input by at
+       most one sample period.
+
+    A jump of more than `max_gap_seconds`, forward or backward, is not
+    interpolated over: the model restarts at the sample after it, with a new
+    grid origin.
+    """
+
+    # Fitted periods further than this from the declared one are not trusted
+    MAX_DRIFT = 0.05
+
+    def __init__(self, sfreq: float, window_seconds: float = 10.0, max_gap_seconds: float = 1.0):
+        if sfreq <= 0:
+            raise ValueError("Sampling rate must be positive")
+        self.sfreq = sfreq
+        self.period = 1.0 / sfreq
+        self.window = max(int(window_seconds * sfreq), 2)
+        self.max_gap = max_gap_seconds
+        self.slope = self.period
+        self.offset: Optional[float] = None
+        self.jitter = 0.0
+        self.stats = {
+            "samples_in": 0,
+            "samples_out": 0,
+            "duplicate_samples": 0,
+            "missing_samples": 0,
+            "resyncs": 0,
+        }
+        self._restart()
+
+    def _restart(self):
+        self._indices = np.empty(0, dtype=np.int64)
+        self._times = np.empty(0, dtype=np.float64)
+        self.slope = self.period
+        self.offset = None
+        self.last_index = -1
+        self.last_timestamp: Optional[float] = None
+        self.grid_origin: Optional[float] = None
+        self.next_grid = 0
+        self._last_time: Optional[float] = None
+        self._last_sample: Optional[np.ndarray] = None
+
+    def regularize(self, samples: np.ndarray, timestamps: np.ndarray
+                   ) -> Tuple[np.ndarray, np.ndarray]:
+        '''Resample a channel-major chunk onto the grid, returns (samples, grid timestamps).
+
+        A chunk with another number of channels than the previous ones raises
+        ValueError and leaves the model as it was.
+        '''
+        if self._last_sample is not None and samples.shape[0] != len(self._last_sample):
+            raise ValueError(
+                f"Expected {len(self._last_sample)} channels, got {samples.shape[0]}")
+        if self.last_timestamp is not None and len(timestamps):
+            running = np.maximum.accumulate(np.concatenate(([self.last_timestamp], timestamps)))
+            jumps = np.flatnonzero(np.abs(timestamps - running[:-1]) > self.max_gap)
+            if len(jumps):
+                j = jumps[0]
+                head = self._regularize(samples[:, :j], timestamps[:j])
+                self.stats["resyncs"] += 1
+                self._restart()
+                tail = self.regularize(samples[:, j:], timestamps[j:])
+                return (np.concatenate((head[0], tail[0]), axis=1),
+                        np.concatenate((head[1], tail[1])))
+        return self._regularize(samples, timestamps)
+
+    def _regularize(self, samples: np.ndarray, timestamps: np.ndarray
+                    ) -> Tuple[np.ndarray, np.ndarray]:
+        empty = (samples[:, :0], np.empty(0, dtype=np.float64))
+        self.stats["samples_in"] += len(timestamps)
+        if not len(timestamps):
+            return empty
+        previous = timestamps[0] - self.period if self.last_timestamp is None else self.last_timestamp
+
+        # 1. Duplicates
+        running = np.maximum.accumulate(np.concatenate(([previous], timestamps)))
+        keep = timestamps > running[:-1]
+        self.stats["duplicate_samples"] += int(len(timestamps) - keep.sum())
+        if not keep.any():
+            return empty
+        timestamps = timestamps[keep]
+        samples = samples[:, keep]
+
+        # 2. Indices, predicted by the current model and at least one apart, and fit
+        offset = timestamps[0] if self.offset is None else self.offset
+        predicted = np.rint((timestamps - offset) / self.slope).astype(np.int64)
+        position = np.arange(1, len(timestamps) + 1)
+        indices = np.maximum.accumulate(
+            np.concatenate(([self.last_index], predicted - position)))[1:] + position
+        self.stats["missing_samples"] += int(indices[-1] - self.last_index - len(indices))
+        self._indices = np.concatenate((self._indices, indices))[-self.window:]
+        self._times = np.concatenate((self._times, timestamps))[-self.window:]
+        self._fit()
+        times = self.offset + self.slope * indices
+
+        # 3. Interpolation onto the grid
+        if self._last_time is not None:
+            times = np.concatenate(([self._last_time], times))
+            samples = np.concatenate((self._last_sample[:, None], samples), axis=1)
+        times = np.maximum.accumulate(times)
+        if self.grid_origin is None:
+            self.grid_origin = float(times[0])
+        last_grid = int(np.floor((times[-1] - self.grid_origin) / self.period + 1e-6))
+        grid = self.grid_origin + np.arange(self.next_grid, last_grid + 1) * self.period
+        if len(times) == 1:
+            out = np.repeat(samples, len(grid), axis=1)
+        else:
+            left = np.clip(np.searchsorted(times, grid, side="right") - 1, 0, len(times) - 2)
+            span = times[left + 1] - times[left]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                weight = np.clip(np.where(span > 0, (grid - times[left]) / span, 0.0), 0.0, 1.0)
+            out = samples[:, left] * (1 - weight) + samples[:, left + 1] * weight
+
+        self.last_index = int(indices[-1])
+        self.last_timestamp = float(timestamps[-1])
+        self._last_time = float(times[-1])
+        self._last_sample = samples[:, -1].copy()
+        self.next_grid = last_grid + 1
+        self.stats["samples_out"] += len(grid)
+        return out.astype(samples.dtype, copy=False), grid
+
+    def _fit(self):
+        mean_index = self._indices.mean()
+        mean_time = self._times.mean()
+        centered_index = self._indices - mean_index
+        centered_time = self._times - mean_time
+        variance = (centered_index * centered_index).sum()
+        if variance > 0:
+            slope = (centered_index * centered_time).sum() / variance
+            if abs(slope * self.sfreq - 1) <= self.MAX_DRIFT:
+                self.slope = slope
+        self.offset = mean_time - self.slope * mean_index
+        residuals = centered_time - self.slope * centered_index
+        self.jitter = float(np.sqrt(np.mean(residuals * residuals)))
+
+    @property
+    def effective_sfreq(self) -> float:
+        '''Sampling rate of the device as measured on the LSL clock.'''
+        return 1.0 / self.slope
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "sfreq": self.sfreq,
+            "effective_sfreq": self.effective_sfreq,
+            "drift_ppm": (self.slope * self.sfreq - 1) * 1e6,
+            "jitter_seconds": self.jitter,
+        }
@@ -0,0 +1,160 @@
+from typing import Optional
+from pydantic_settings import BaseSettings
+from pydantic import Field
+
+
+class BCIConfig(BaseSettings):
+    EEG_BUFFER_SECONDS: float = Field(
+        30.0,
+        title="EEG Buffer Length",
+        description="Seconds of EEG kept in memory per session",
+    )
+    EEG_BUFFER_MAX_BYTES: int = Field(
+        16 * 1024 * 1024,
+        title="EEG Buffer Memory Cap",
+        description="Upper bound in bytes for the EEG ring buffer of a single session",
+    )
+    DEFAULT_SAMPLING_RATE: float = Field(
+        250.0,
+        title="Default Sampling Rate",
+        description="Sampling rate assumed when data arrives before the START message",
+    )
+    EPOCH_LENGTH_SECONDS: float = Field(
+        1.0,
+        title="Epoch Length",
+        description="Length in seconds of the windows classified in real-time, "
+                    "unless the session's model defines its own",
+    )
+    EPOCH_OVERLAP: float = Field(
+        0.5,
+        title="Epoch Overlap",
+        description="Overlap ratio between consecutive classification windows",
+    )
+    MAX_EPOCHS_PER_CLASSIFICATION: int = Field(
+        8,
+        title="Max Epochs per Classification",
+        description="Upper bound on the new epochs classified per request, older ones are skipped",
+    )
+    SESSION_IDLE_TTL_SECONDS: float = Field(
+        900.0,
+        title="Idle Session TTL",
+        description="Sessions without any activity for this long are evicted",
+    )
+    CLOSED_SESSION_TTL_SECONDS: float = Field(
+        60.0,
+        title="Closed Session TTL",
+        description="How long ended sessions are kept around for their stats before eviction",
+    )
+    STREAM_RESUME_WINDOW_SECONDS: float = Field(
+        120.0,
+        title="Stream Resume Window",
+        description="How long a session whose stream disconnected without an END message "
+                    "waits for the client to RESUME before it is ended",
+    )
+    SESSION_REAPER_INTERVAL_SECONDS: float = Field(
+        30.0,
+        title="Session Reaper Interval",
+        description="Seconds between two runs of the background session reaper",
+    )
+    SESSION_MEMORY_BUDGET_BYTES: int = Field(
+        512 * 1024 * 1024,
+        title="Session Memory Budget",
+        description="Total bytes of EEG ring buffers kept in memory across sessions, "
+                    "the least recently active sessions are spilled to disk above it. "
+                    "Calibration recordings are not counted, and sessions active since "
+                    "the previous reaper run are never spilled",
+    )
+    FILTER_ENABLED: bool = Field(
+        True,
+        title="Online Filtering",
+        description="Condition calibration and classification EEG as it streams in",
+    )
+    FILTER_L_FREQ: Optional[float] = Field(
+        1.0,
+        title="Band-pass Low Cutoff",
+        description="Lower band-pass cutoff in Hz, unset for no high-pass",
+    )
+    FILTER_H_FREQ: Optional[float] = Field(
+        40.0,
+        title="Band-pass High Cutoff",
+        description="Upper band-pass cutoff in Hz, unset for no low-pass",
+    )
+    NOTCH_FREQ: Optional[float] = Field(
+        50.0,
+        title="Notch Frequency",
+        description="Power line frequency to remove (50 or 60 Hz), unset to disable",
+    )
+    COMMON_AVERAGE_REFERENCE: bool = Field(
+        True,
+        title="Common Average Reference",
+        description="Re-reference the EEG to the average of all channels",
+    )
+    TIMESTAMP_REGULARIZATION: bool = Field(
+        True,
+        title="Timestamp Regularization",
+        description="Resample streamed EEG onto a uniform grid at the declared sampling rate, "
+                    "correcting timestamp jitter and clock drift",
+    )
+    CLOCK_WINDOW_SECONDS: float = Field(
+        10.0,
+        title="Clock Model Window",
+        description="Seconds of recent timestamps the clock model of a stream is fitted on",
+    )
+    CLOCK_MAX_GAP_SECONDS: float = Field(
+        1.0,
+        title="Clock Max Gap",
+        description="Timestamp jumps longer than this restart the clock model instead of "
+                    "being interpolated over",
+    )
+    INGEST_QUEUE_SIZE: int = Field(
+        256,
+        title="Ingest Queue Size",
+        description="EEG frames waiting to be processed per stream before new ones are dropped",
+    )
+    INGEST_HIGH_WATERMARK: float = Field(
+        0.75,
+        title="Ingest High Watermark",
+        description="Fraction of the ingest queue at which the client is told to slow down",
+    )
+    INGEST_LOW_WATERMARK: float = Field(
+        0.25,
+        title="Ingest Low Watermark",
+        description="Fraction of the ingest queue below which the client is told it can resume",
+    )
+    INGEST_RATE_WINDOW_SECONDS: int = Field(
+        10,
+        title="Ingest Rate Window",
+        description="Seconds the per-session frame, sample and byte rates are averaged over",
+    )
+    EEG_MONGO_ENABLED: bool = Field(
+        False,
+        title="Store EEG in MongoDB",
+        description="Write every streamed EEG sample to MongoDB as bucket documents",
+    )
+    EEG_BUCKET_SECONDS: float = Field(
+        10.0,
+        title="EEG Bucket Length",
+        description="Seconds of stream time grouped into one MongoDB document",
+    )
+    EEG_SUMMARY_SECONDS: Optional[float] = Field(
+        0.1,
+        title="EEG Summary Resolution",
+        description="Bin length of the min/max/mean summaries stored with each bucket "
+                    "for downsampled queries, unset to store raw samples only",
+    )
+    EEG_FLUSH_INTERVAL_SECONDS: float = Field(
+        1.0,
+        title="EEG Flush Interval",
+        description="Seconds between two bulk writes of sealed EEG buckets",
+    )
+    EEG_MAX_PENDING_BUCKETS: int = Field(
+        1024,
+        title="Max Pending EEG Buckets",
+        description="Sealed buckets kept while MongoDB is slow or down, the oldest are dropped above it",
+    )
+
+    class Config:
+        env_file = ".env"
+        env_file_encoding = "utf-8"
+        # extra inputs permitted
+        extra = "allow"
@@ -0,0 +1,122 @@
+'''
+Encoding of stored EEG for the /bci/eeg_data/ streaming endpoint.
+
+The response is a stream of chunks, written as soon as they are read from
+storage instead of once the whole range is in memory:
+
+- JSON: newline-delimited JSON, one object per chunk,
+  {"channels": [...], "timestamps": [...], "data": [[...], ...]} with the
+  samples channel-major and missing values as null.
+- Binary: back to back binary EEG frames (see server/bci/frames.py), the
+  channel names are sent in the X-EEG-Channels response header.
+
+With `max_points`, the range is instead split into at most that many equal
+bins and a single JSON envelope with the min, max and mean of every channel
+in each non-empty bin is returned (see `EEGEnvelope`).
+'''
+
+import json
+import uuid
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+from server.bci.frames import encode_frame
+from server.common.repo.eeg_buckets import BinStats, reduce_bins
+from server.common.repo.timeseries import EEGChunkArrays
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+BINARY_MEDIA_TYPE = "application/octet-stream"
+
+
+def _to_list(values: np.ndarray) -> list:
+    if np.issubdtype(values.dtype, np.floating) and np.isnan(values).any():
+        return np.where(np.isnan(values), None, values.astype(object)).tolist()
+    return values.tolist()
+
+
+def encode_ndjson(chunks: Iterable[EEGChunkArrays]) -> Iterator[bytes]:
+    for ch_names, samples, timestamps in chunks:
+        yield json.dumps({
+            "channels": ch_names,
+            "timestamps": timestamps.tolist(),
+            "data": _to_list(samples),
+        }).encode() + b"\n"
+
+
+def encode_binary(chunks: Iterable[EEGChunkArrays], session_id: uuid.UUID,
+                  ch_names: List[str]) -> Iterator[bytes]:
+    '''Encode chunks as frames numbered from 0, all with the channels of `ch_names`.'''
+    for sequence, (names, samples, timestamps) in enumerate(chunks):
+        if names != ch_names:
+            raise ValueError(f"Chunk channels {names} differ from the stream's {ch_names}")
+        yield encode_frame(session_id, sequence, samples.T, timestamps)
+
+
+class EEGEnvelope:
+    """
+    Min/max/mean envelope of each channel over `n_bins` equal bins of
+    [start_time, end_time].
+
+    Stats are folded in chunk by chunk with vectorized reductions, either raw
+    samples or the summaries stored with the buckets, so memory only depends
+    on the number of bins. Channels are taken from the first chunk unless
+    given.
+    """
+
+    def __init__(self, start_time: float, end_time: float, n_bins: int,
+                 channels: Optional[Sequence[str]] = None):
+        self.start_time = start_time
+        self.n_bins = n_bins
+        # A single timestamp still gets a bin
+        self.bin_seconds = max(end_time - start_time, 1e-9) / n_bins
+        self.channels: Optional[List[str]] = None
+        if channels is not None:
+            self._allocate(channels)
+
+    def _allocate(self, channels: Sequence[str]):
+        self.channels = list(channels)
+        self._rows: Dict[str, int] = {name: i for i, name in enumerate(self.channels)}
+        shape = (len(self.channels), self.n_bins)
+        self.mins = np.full(shape, np.nan)
+        self.maxs = np.full(shape, np.nan)
+        self.sums = np.zeros(shape)
+        self.counts = np.zeros(shape, dtype=np.int64)
+
+    def add(self, ch_names: Sequence[str], stats: BinStats):
+        """Fold in the stats of samples or bins starting at the given timestamps."""
+        if self.channels is None:
+            self._allocate(ch_names)
+        timestamps, mins, maxs, sums, counts = stats
+        picked = [i for i, name in enumerate(ch_names) if name in self._rows]
+        if not len(timestamps) or not picked:
+            return
+        rows = [self._rows[ch_names[i]] for i in picked]
+        bins = np.clip(np.floor((timestamps - self.start_time) / self.bin_seconds),
+                       0, self.n_bins - 1).astype(np.int64)
+        bins, mins, maxs, sums, counts = reduce_bins(
+            bins, mins[picked], maxs[picked], sums[picked], counts)
+        grid = np.ix_(rows, bins)
+        self.mins[grid] = np.fmin(self.mins[grid], mins)
+        self.maxs[grid] = np.fmax(self.maxs[grid], maxs)
+        # NaN samples are missing channels, they count for nothing
+        valid = ~np.isnan(sums)
+        self.sums[grid] += np.where(valid, sums, 0.0)
+        self.counts[grid] += np.where(valid, counts, 0)
+
+    def to_dict(self) -> dict:
+        """The non-empty bins, each timestamped by its start."""
+        if self.channels is None:
+            self._allocate([])
+        keep = self.counts.any(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = self.sums[:, keep] / self.counts[:, keep]
+        return {
+            "channels": self.channels,
+            "bin_seconds": self.bin_seconds,
+            "timestamps": (self.start_time + np.flatnonzero(keep) * self.bin_seconds).tolist(),
+            "count": self.counts[:, keep].max(axis=0, initial=0).tolist(),
+            "min": _to_list(self.mins[:, keep]),
+            "max": _to_list(self.maxs[:, keep]),
+            "mean": _to_list(means),
+        }
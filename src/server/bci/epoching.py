@@ -0,0 +1,76 @@
+'''
+Sliding-window epoching of the session ring buffer for real-time classification.
+'''
+
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from server.bci.buffers import EEGRingBuffer
+
+
+@dataclass
+class EpochBatch:
+    """New complete epochs, in stream order."""
+    data: np.ndarray  # (n_epochs, n_channels, n_times)
+    timestamps: np.ndarray  # (n_epochs,) timestamp of the last sample of each window
+    start_indices: np.ndarray  # (n_epochs,) absolute index of the first sample of each window
+
+    def __len__(self) -> int:
+        return self.data.shape[0]
+
+
+class EpochWindower:
+    """
+    Cuts the stream into fixed-length, overlapping epochs, emitting each one once.
+
+    The windower only remembers the absolute sample index where the next epoch
+    starts, so every call costs time proportional to the new data, not to the
+    length of the session. Epochs are returned as a strided view over the ring
+    buffer (copied only if the range wraps around its end), so they must be
+    consumed before more data is appended to the buffer.
+    """
+
+    def __init__(self, sfreq: float, epoch_length: float, overlap: float,
+                 max_epochs: Optional[int] = None):
+        if not 0 <= overlap < 1:
+            raise ValueError("Epoch overlap must be in [0, 1)")
+        self.window = max(int(round(epoch_length * sfreq)), 1)
+        self.step = max(int(round(self.window * (1 - overlap))), 1)
+        self.max_epochs = max_epochs
+        self.next_start: Optional[int] = None
+
+    def reset(self, start: Optional[int] = None):
+        '''Start epoching at absolute sample index `start` (the oldest buffered sample by default).'''
+        self.next_start = start
+
+    def collect(self, buffer: EEGRingBuffer) -> Optional[EpochBatch]:
+        '''Return the epochs completed since the last call, or None if there are none.'''
+        if self.next_start is None:
+            self.next_start = buffer.first_index
+        if self.next_start < buffer.first_index:
+            # Fell behind the ring buffer, resume at the first window still fully buffered
+            lag = buffer.first_index - self.next_start
+            self.next_start += -(-lag // self.step) * self.step
+
+        available = buffer.total_samples - self.next_start
+        if available < self.window:
+            return None
+        n_epochs = (available - self.window) // self.step + 1
+        if self.max_epochs and n_epochs > self.max_epochs:
+            # Only the most recent epochs are worth classifying
+            self.next_start += (n_epochs - self.max_epochs) * self.step
+            n_epochs = self.max_epochs
+
+        stop = self.next_start + (n_epochs - 1) * self.step + self.window
+        data, timestamps = buffer.read(self.next_start, stop)
+        windows = sliding_window_view(data, self.window, axis=1)[:, ::self.step]
+        batch = EpochBatch(
+            data=windows.transpose(1, 0, 2),
+            timestamps=timestamps[self.window - 1::self.step][:n_epochs],
+            start_indices=self.next_start + np.arange(n_epochs) * self.step,
+        )
+        self.next_start += n_epochs * self.step
+        return batch
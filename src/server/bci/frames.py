@@ -0,0 +1,117 @@
+'''
+Binary EEG frame protocol for the /bci/stream WebSocket.
+
+Clients that negotiate `"encoding": "binary"` in their START message send every
+EEG chunk as a single binary WebSocket message laid out as:
+
+    offset  size  field
+    0       4     magic, always b"EEGF"
+    4       1     protocol version (FRAME_VERSION)
+    5       1     sample dtype code (1 = float32, 2 = float64)
+    6       2     channel count (uint16)
+    8       4     sample count (uint32)
+    12      8     sequence number (uint64)
+    20      16    session id (raw UUID bytes)
+    36      ...   samples, sample-major (n_samples x n_channels), little-endian
+    ...     ...   timestamps, one little-endian float64 per sample
+
+All integers are little-endian. The blocks are packed without padding and the
+sample layout matches the nested `data` lists of the JSON `EEG_DATA` frames, so
+both encodings end up as the same (n_samples, n_channels) array on the server.
+'''
+
+import struct
+import uuid
+from dataclasses import dataclass
+from typing import Union
+
+import numpy as np
+
+
+FRAME_MAGIC = b"EEGF"
+FRAME_VERSION = 1
+
+FRAME_HEADER = struct.Struct("<4sBBHIQ16s")
+
+SAMPLE_DTYPES = {
+    1: np.dtype("<f4"),
+    2: np.dtype("<f8"),
+}
+TIMESTAMP_DTYPE = np.dtype("<f8")
+
+
+class FrameError(ValueError):
+    """Raised when a binary frame cannot be decoded."""
+
+
+@dataclass
+class EEGFrame:
+    """A decoded binary EEG frame.
+
+    `data` and `timestamps` are read-only views into the received message, no
+    sample is copied while decoding.
+    """
+    session_id: uuid.UUID
+    sequence: int
+    data: np.ndarray  # (n_samples, n_channels)
+    timestamps: np.ndarray  # (n_samples,)
+
+
+def _dtype_code(dtype) -> int:
+    dtype = np.dtype(dtype).newbyteorder("<")
+    for code, candidate in SAMPLE_DTYPES.items():
+        if candidate == dtype:
+            return code
+    raise FrameError(f"Unsupported sample dtype: {dtype}")
+
+
+def decode_frame(payload: Union[bytes, bytearray, memoryview]) -> EEGFrame:
+    '''Decode a binary EEG frame without copying the sample or timestamp blocks.'''
+    if len(payload) < FRAME_HEADER.size:
+        raise FrameError(
+            f"Frame too short: {len(payload)} bytes, header is {FRAME_HEADER.size}")
+
+    magic, version, dtype_code, n_channels, n_samples, sequence, session_bytes = \
+        FRAME_HEADER.unpack_from(payload, 0)
+    if magic != FRAME_MAGIC:
+        raise FrameError("Invalid frame magic")
+    if version != FRAME_VERSION:
+        raise FrameError(f"Unsupported frame version: {version}")
+    dtype = SAMPLE_DTYPES.get(dtype_code)
+    if dtype is None:
+        raise FrameError(f"Unknown sample dtype code: {dtype_code}")
+
+    n_values = n_channels * n_samples
+    data_offset = FRAME_HEADER.size
+    timestamps_offset = data_offset + n_values * dtype.itemsize
+    expected_size = timestamps_offset + n_samples * TIMESTAMP_DTYPE.itemsize
+    if len(payload) != expected_size:
+        raise FrameError(
+            f"Frame size mismatch: got {len(payload)} bytes, expected {expected_size}")
+
+    data = np.frombuffer(payload, dtype=dtype, count=n_values,
+                         offset=data_offset).reshape(n_samples, n_channels)
+    timestamps = np.frombuffer(payload, dtype=TIMESTAMP_DTYPE, count=n_samples,
+                               offset=timestamps_offset)
+    return EEGFrame(session_id=uuid.UUID(bytes=session_bytes), sequence=sequence,
+                    data=data, timestamps=timestamps)
+
+
+def encode_frame(session_id: Union[uuid.UUID, str], sequence: int, data, timestamps,
+                 dtype=np.float32) -> bytes:
+    '''Encode an EEG chunk of shape (n_samples, n_channels) as a binary frame.'''
+    if not isinstance(session_id, uuid.UUID):
+        session_id = uuid.UUID(str(session_id))
+    dtype_code = _dtype_code(dtype)
+    data = np.ascontiguousarray(data, dtype=SAMPLE_DTYPES[dtype_code])
+    timestamps = np.ascontiguousarray(timestamps, dtype=TIMESTAMP_DTYPE)
+    if data.ndim != 2:
+        raise FrameError("Frame data must be 2D (n_samples, n_channels)")
+    n_samples, n_channels = data.shape
+    if timestamps.shape != (n_samples,):
+        raise FrameError(
+            f"Expected {n_samples} timestamps, got {timestamps.shape[0]}")
+
+    header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, dtype_code, n_channels,
+                               n_samples, sequence, session_id.bytes)
+    return header + data.tobytes() + timestamps.tobytes()
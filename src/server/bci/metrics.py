@@ -0,0 +1,151 @@
+'''
+Ingest throughput and latency instrumentation of the EEG streams.
+'''
+
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+
+class Histogram:
+    """
+    Histogram of durations in seconds over fixed, logarithmically spaced buckets.
+
+    Memory does not grow with the number of observations, quantiles are
+    estimated by the upper bound of the bucket they fall in.
+    """
+
+    def __init__(self, lowest: float = 1e-5, highest: float = 10.0, n_buckets: int = 25):
+        self.bounds = np.geomspace(lowest, highest, n_buckets)
+        # The last bucket counts everything above `highest`
+        self.counts = np.zeros(n_buckets + 1, dtype=np.int64)
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    @property
+    def count(self) -> int:
+        return int(self.counts.sum())
+
+    def observe(self, value: float):
+        self.counts[np.searchsorted(self.bounds, value)] += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        count = self.count
+        if not count:
+            return None
+        bucket = int(np.searchsorted(np.cumsum(self.counts), q * count))
+        return float(self.bounds[bucket]) if bucket < len(self.bounds) else self.max
+
+    def to_dict(self) -> dict:
+        count = self.count
+        return {
+            "count": count,
+            "mean": self.total / count if count else None,
+            "min": self.min if count else None,
+            "max": self.max if count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": {"le": self.bounds.tolist() + [None], "counts": self.counts.tolist()},
+        }
+
+
+class RateMeter:
+    """Total and rate per second over the last `window_seconds` of a counter."""
+
+    def __init__(self, window_seconds: int = 10):
+        self.window = max(int(window_seconds), 1)
+        self.slots = np.zeros(self.window)
+        self.slot_seconds = np.full(self.window, -1, dtype=np.int64)
+        self.total = 0
+        self.started: Optional[float] = None
+
+    def add(self, amount: float, now: float):
+        if self.started is None:
+            self.started = now
+        second = int(now)
+        slot = second % self.window
+        if self.slot_seconds[slot] != second:
+            self.slots[slot] = 0
+            self.slot_seconds[slot] = second
+        self.slots[slot] += amount
+        self.total += amount
+
+    def rate(self, now: float) -> float:
+        if self.started is None:
+            return 0.0
+        first_second = int(now) - self.window + 1
+        recent = self.slot_seconds >= first_second
+        # A stream younger than the window is averaged over its own age
+        span = max(now - max(self.started, first_second), 1.0)
+        return float(self.slots[recent].sum() / span)
+
+
+class IngestMetrics:
+    """
+    Throughput and latency of the frames of one session, from any number of
+    stream connections.
+
+    Every processed EEG frame adds to the frame, sample and byte counters and
+    to three histograms: the time spent parsing it, the time it waited in the
+    ingest queue and its end-to-end latency.
+
+    The client timestamps its samples with its own LSL clock, so the latency
+    is the time from the frame's last sample to the end of its processing
+    minus the smallest such difference seen since the stream started, i.e.
+    the delay above that of the fastest frame. It includes network, queueing and
+    processing delays but not the constant part of the clock offset.
+    """
+
+    def __init__(self, window_seconds: int = 10):
+        self._lock = threading.Lock()
+        self.frames = RateMeter(window_seconds)
+        self.samples = RateMeter(window_seconds)
+        self.bytes = RateMeter(window_seconds)
+        self.parse_seconds = Histogram()
+        self.queue_wait_seconds = Histogram()
+        self.latency_seconds = Histogram()
+        self.clock_offset: Optional[float] = None
+
+    def record_frame(self, n_samples: int, nbytes: int, parse_seconds: float,
+                     queue_wait_seconds: float = 0.0, last_timestamp: Optional[float] = None,
+                     now: Optional[float] = None):
+        '''Account for a frame processed at monotonic time `now`.'''
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.frames.add(1, now)
+            self.samples.add(n_samples, now)
+            self.bytes.add(nbytes, now)
+            self.parse_seconds.observe(parse_seconds)
+            self.queue_wait_seconds.observe(queue_wait_seconds)
+            if last_timestamp is not None:
+                offset = now - last_timestamp
+                if self.clock_offset is None or offset < self.clock_offset:
+                    self.clock_offset = offset
+                self.latency_seconds.observe(offset - self.clock_offset)
+
+    def reset_clock(self):
+        '''Forget the clock offset, a new stream may stamp its samples with another clock.'''
+        with self._lock:
+            self.clock_offset = None
+
+    def get_stats(self, now: Optional[float] = None) -> dict:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return {
+                "frames": self.frames.total,
+                "samples": self.samples.total,
+                "bytes": self.bytes.total,
+                "frames_per_second": self.frames.rate(now),
+                "samples_per_second": self.samples.rate(now),
+                "bytes_per_second": self.bytes.rate(now),
+                "parse_seconds": self.parse_seconds.to_dict(),
+                "queue_wait_seconds": self.queue_wait_seconds.to_dict(),
+                "latency_seconds": self.latency_seconds.to_dict(),
+            }
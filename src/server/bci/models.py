@@ -74,6 +74,18 @@ class EEGMode(Enum):
     CLASSIFICATION = "classification"
 
 
+class FrameEncoding(str, Enum):
+    """Wire encoding of the EEG_DATA frames, negotiated in the START message."""
+    JSON = "json"
+    BINARY = "binary"
+
+
+class AckMode(str, Enum):
+    """How EEG frames are acknowledged, negotiated in the START message."""
+    EACH = "each"  # a text "ACK" after every message
+    CUMULATIVE = "cumulative"  # "ACK <sequence>" every few frames
+
+
 class EEGMarker(BaseModel):
     name: str
     timestamp: datetime
@@ -82,6 +94,7 @@ class EEGMarker(BaseModel):
 class EEGChunk(BaseModel):
     data: List[List]
     timestamps: List
+    sequence: Optional[int] = None
 
 
 class ElectrodeCoordinate(BaseModel):
@@ -162,6 +175,8 @@ class ClassificationResult(BaseModel):
                                 description="ISO8601 timestamp of the classification result")
     issued_at: datetime = Field(...,
                                 description="ISO8601 timestamp of when the classification result was issued")
+    stream_timestamp: Optional[float] = Field(None,
+                                              description="Stream timestamp of the last EEG sample of the classified window")
 
 
 class ServersEnum(str, Enum):
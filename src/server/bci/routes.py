@@ -1,22 +1,32 @@
 from server.auth.service import verify_token_header, optional_token_header
-from typing import Optional
+from typing import List, Optional
 from datetime import datetime
 from fastapi import Query
 from server.bci.streaming import bci_websocket
 from server.bci.models import CalibrationAction, CalibrationSet, CalibrationProtocol
-from server.bci.models import SessionState
+from server.bci.models import SessionState, FrameEncoding
+import itertools
+import os
 import pickle
+import uuid
 from fastapi import Depends
 from pymongo import ASCENDING
 from pymongo.database import Database
-from server.common.repo.timeseries import StorageType, get_mongo_db
+from server.common.repo.timeseries import (
+    StorageType, get_mongo_db, iter_bucket_chunks, iter_bucket_summaries, iter_local_chunks,
+    local_extent, raw_bin_stats, select_range, session_extent)
+from server.common.repo.eeg_buckets import BUCKET_COLLECTION
+from server.bci.eeg_query import (
+    BINARY_MEDIA_TYPE, NDJSON_MEDIA_TYPE, EEGEnvelope, encode_binary, encode_ndjson)
 from .models import EEGChunk
 import json
-from .service import session_manager  # import the session manager instance
+from .service import session_manager, prediction_label, normalize_session_id  # import the session manager instance
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi import WebSocket
 from fastapi import APIRouter, HTTPException, Path, Body
+from fastapi.responses import StreamingResponse
 from .models import CalibrationStartResponse, ClassificationStartRequest, ClassificationStartResponse, ClassificationResult
+from server.machine_learning.service import ml_service
 
 bci = APIRouter(prefix="/bci", tags=["bci"])
 
@@ -46,6 +56,8 @@ def obtain_session(auth_user=Depends(optional_token_header)):
     # Obtain a new session ID or the existing session ID for the user
     # session_id = session_manager.obtain_session()
     session_id = "12345678-1234-5678-1234-567812345678"
+    if auth_user and session_manager.get_session(session_id):
+        session_manager.set_owner(session_id, auth_user.id or auth_user.username)
     return {"session_id": session_id}
 
 
@@ -94,10 +106,17 @@ def fetch_classification_result(session_id: str = Query(..., description="The se
     The state is the classified state, e.g., 'Imagined Walking', 'Rest'. The timestamp is the ISO8601 timestamp of the classification result. The issued_at is the ISO8601 timestamp of when the classification result was issued.
     Also note that errors will be returned in case of any issues with the classification process or signal acquisition.
     '''
-    # session = session_manager.get_session(session_id)
-    # if not session:
-    # raise HTTPException(status_code=404, detail="Session not found")
-    # classification_result = session.get_classification_result()
+    session = session_manager.get_session(session_id)
+    if session and session.start_classification():
+        try:
+            prediction = session.get_classification_results()
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if prediction is None:
+            raise HTTPException(
+                status_code=425, detail="No complete epoch received yet")
+        return ClassificationResult(state=prediction_label(prediction), timestamp=datetime.now(),
+                                    issued_at=datetime.now(), stream_timestamp=session.prediction_buffer[-1][0])
     # randomize state for now for testing
     # if session.connection_status == ConnectionStatus.CONNECTED:
     import random
@@ -120,19 +139,27 @@ async def bci_websocket(session_id: str, websocket: WebSocket):
     await bci_websocket_stream(websocket, session_id)
 
 
+@bci.websocket("/results/{session_id}")
+async def bci_results_websocket(session_id: str, websocket: WebSocket):
+    '''Read-only stream of the classification results of a session, e.g. for the VR game.'''
+    from server.bci.streaming import results_websocket
+    await results_websocket(websocket, session_id)
+
+
 @bci.get("/session/")
 def get_sessions(session_state: SessionState = Query(None, description="Filter sessions by state", alias="state"),
                  session_id: str = Query(
                      None, description="Filter sessions by ID", alias="id"),
                  location: str = Query(
                      None, description="Filter sessions by location, which server it is on", alias="location"),
+                 user_id: str = Query(
+                     None, description="Filter sessions by owning user", alias="user"),
                  ):
     '''Get a list of sessions based on the query parameters. If no parameters are provided, all sessions are returned.
-    If a session ID is provided, only the session with that ID is returned. If a session state is provided, only sessions with that state are returned.'''
-    sessions = []
-    if session_id and session_state:
+    If a session ID is provided, only the session with that ID is returned. If a session state or user is provided, only sessions matching them are returned.'''
+    if session_id and (session_state or user_id):
         raise HTTPException(
-            status_code=400, detail="Cannot filter by both session ID and state")
+            status_code=400, detail="Cannot filter by both session ID and state or user")
 
     if session_id:
         session = session_manager.get_session(session_id)
@@ -141,47 +168,128 @@ def get_sessions(session_state: SessionState = Query(None, description="Filter s
         else:
             raise HTTPException(status_code=404, detail="Session not found")
 
-    if not session_state:
-        for session in session_manager.sessions:
-            sessions.append(session.__dict__())
+    if session_state and user_id:
+        sessions = [session for session in session_manager.sessions_by_user(user_id)
+                    if session.state == session_state]
+    elif session_state:
+        sessions = session_manager.sessions_by_state(session_state)
+    elif user_id:
+        sessions = session_manager.sessions_by_user(user_id)
+    else:
+        sessions = session_manager.list_sessions()
+    return [session.__dict__() for session in sessions]  # TODO: standardize this model into a pydantic schema later
 
-    if session_state:
-        for session in session_manager.sessions:
-            if session.state == session_state:
-                sessions.append(session.__dict__())
-    return sessions  # TODO: standardize this model into a pydantic schema later
+
+@bci.get("/session/reaper/")
+def get_session_reaper_stats():
+    '''Eviction and spill counters of the session reaper, with the current EEG buffer memory usage.'''
+    return {
+        **session_manager.reaper_stats,
+        "sessions": len(session_manager),
+        "memory_usage_bytes": session_manager.memory_usage(),
+    }
+
+
+@bci.get("/session/metrics/")
+def get_session_metrics(session_id: str = Query(
+        None, description="Only return the metrics of this session", alias="id")):
+    '''Ingest throughput, parse time, queue wait and latency of each session's EEG stream, by session ID.'''
+    if session_id:
+        session = session_manager.get_session(session_id)
+        if session is None:
+            raise HTTPException(status_code=404, detail="Session not found")
+        sessions = [session]
+    else:
+        sessions = session_manager.list_sessions()
+    return {str(session.session_id): session.get_ingest_stats() for session in sessions}
+
+
+@bci.get("/classification/model_cache/")
+def get_model_cache_stats():
+    '''Hit, miss and eviction counters of the trained model cache, with its current size.'''
+    return ml_service.models.get_stats()
 
 
 @bci.get("/eeg_data/")
-async def get_eeg_data(
+def get_eeg_data(
     session_id: str,
     storage_type: StorageType,
-    start_time: int = None,
-    end_time: int = None,
+    start_time: Optional[float] = None,
+    end_time: Optional[float] = None,
+    channels: Optional[List[str]] = Query(None),
+    encoding: FrameEncoding = FrameEncoding.JSON,
+    max_points: Optional[int] = Query(None, ge=1, le=100_000),
     db: Database = Depends(get_mongo_db)
 ):
-    if storage_type == StorageType.MONGODB:
-        query = {"metadata.session_id": session_id}
-        if start_time:
-            query["epoch_timestamp"] = {"$gte": start_time}
-        if end_time:
-            query["epoch_timestamp"]["$lte"] = end_time
+    '''
+    Stream the stored EEG of a session between two stream timestamps, either optional.
+
+    The response is newline-delimited JSON or binary EEG frames (see
+    server/bci/eeg_query.py), written chunk by chunk as storage is read.
+    `channels` restricts the response to the given channels. With
+    `max_points`, a single JSON envelope of at most that many min/max/mean
+    points per channel is returned instead of the samples.
+    '''
+    if start_time is not None and end_time is not None and end_time < start_time:
+        raise HTTPException(status_code=400, detail="end_time is before start_time")
 
-        cursor = db["eeg_data_time_series"].find(
-            query).sort("epoch_timestamp", ASCENDING)
-        return [{"magnitude": doc["magnitude"], "epoch_timestamp": doc["epoch_timestamp"]} for doc in cursor]
+    if max_points is not None:
+        return get_eeg_envelope(session_id, storage_type, start_time, end_time,
+                                channels, max_points, db)
 
+    if storage_type == StorageType.MONGODB:
+        chunks = iter_bucket_chunks(db[BUCKET_COLLECTION], session_id,
+                                    start_time, end_time, channels)
     elif storage_type == StorageType.LOCAL_FILE:
         filename = f"eeg_data_{session_id}.pkl" if session_id else "eeg_data.pkl"
-        try:
-            with open(filename, "rb") as f:
-                all_data = []
-                while True:
-                    try:
-                        all_data.extend(pickle.load(f))
-                    except EOFError:
-                        break
-            return all_data
-        except FileNotFoundError:
+        if not os.path.exists(filename):
             raise HTTPException(
                 status_code=404, detail=f"File not found: {filename}")
+        chunks = iter_local_chunks(filename, start_time, end_time, channels)
+
+    if encoding == FrameEncoding.JSON:
+        return StreamingResponse(encode_ndjson(chunks), media_type=NDJSON_MEDIA_TYPE)
+
+    try:
+        frame_session_id = normalize_session_id(session_id)
+    except ValueError:
+        frame_session_id = uuid.UUID(int=0)
+    if channels is None:
+        # Frames carry no channel names, every frame gets the channels of the first chunk
+        first = next(chunks, None)
+        channels = first[0] if first is not None else []
+        chunks = itertools.chain(
+            [first] if first is not None else [],
+            (select_range(chunk, channels=channels) for chunk in chunks))
+    return StreamingResponse(encode_binary(chunks, frame_session_id, list(channels)),
+                             media_type=BINARY_MEDIA_TYPE,
+                             headers={"X-EEG-Channels": ",".join(channels)})
+
+
+def get_eeg_envelope(session_id: str, storage_type: StorageType, start_time: Optional[float],
+                     end_time: Optional[float], channels: Optional[List[str]],
+                     max_points: int, db: Database) -> dict:
+    '''Min/max/mean envelope of the stored EEG of a session, see `EEGEnvelope`.'''
+    if storage_type == StorageType.MONGODB:
+        collection = db[BUCKET_COLLECTION]
+        extent = session_extent(collection, session_id)
+    else:
+        filename = f"eeg_data_{session_id}.pkl" if session_id else "eeg_data.pkl"
+        if not os.path.exists(filename):
+            raise HTTPException(
+                status_code=404, detail=f"File not found: {filename}")
+        extent = None if start_time is not None and end_time is not None else local_extent(filename)
+    if extent is None and (start_time is None or end_time is None):
+        return EEGEnvelope(0.0, 0.0, max_points, channels).to_dict()
+    start = start_time if start_time is not None else extent[0]
+    end = end_time if end_time is not None else extent[1]
+
+    envelope = EEGEnvelope(start, end, max_points, channels)
+    if storage_type == StorageType.MONGODB:
+        for ch_names, stats in iter_bucket_summaries(collection, session_id, start, end,
+                                                     channels, envelope.bin_seconds):
+            envelope.add(ch_names, stats)
+    else:
+        for chunk in iter_local_chunks(filename, start, end, channels):
+            envelope.add(*raw_bin_stats(chunk))
+    return envelope.to_dict()
@@ -1,10 +1,13 @@
 from server.machine_learning.models import TrainingStatus
 import time
+from datetime import datetime
 from server.machine_learning.service import ml_service
 import uuid
+import asyncio
 import pickle
-from collections import deque
-from typing import Optional, List, Union
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, Optional, List, Set, Union
 
 import numpy as np
 import mne
@@ -13,8 +16,10 @@ from mne.io import RawArray
 from fastapi import WebSocket, WebSocketDisconnect
 
 from server.machine_learning.service import MachineLearningService
+from server.machine_learning.preprocessors import StreamingFilterBank
 
 from server.common.repo.pickle_storage import LocalPickleStorage, S3PickleStorage
+from server.common.repo.timeseries import get_eeg_writer
 # from server.common.repo.timeseries import (
 #     # InfluxDBTimeSeriesRepository,
 #     # MongoDbTimeSeriesRepository,
@@ -26,7 +31,17 @@ from server.bci.models import (
     ConnectionStatus,
     EEGData,
     EEGMode,
+    FrameEncoding,
+    ClassificationResult,
 )
+from server.bci.frames import EEGFrame
+from server.bci.buffers import CalibrationRecorder, EEGRingBuffer, chunk_to_arrays
+from server.bci.clock import ClockModel
+from server.bci.metrics import IngestMetrics
+from server.bci.epoching import EpochWindower
+from server.bci.broadcast import ResultBroadcaster, result_message
+from server.machine_learning.models import ClassEnum
+from server.config import CONFIG
 
 from dataclasses import dataclass, field
 
@@ -40,42 +55,74 @@ class SessionStateHandler:
 
     def __init__(self, session: 'BCISession'):
         self.session = session
+        # Called with (session, old_state, new_state), used by the SessionManager indexes
+        self.on_state_change: Optional[Callable] = None
         self.state = SessionState.UNSTARTED
 
+    @property
+    def state(self) -> SessionState:
+        return self._state
+
+    @state.setter
+    def state(self, new_state: SessionState):
+        old_state = getattr(self, "_state", None)
+        self._state = new_state
+        if self.on_state_change is not None and old_state != new_state:
+            self.on_state_change(self.session, old_state, new_state)
+
     def transition_to(self, new_state: SessionState):
         """Handles state transitions and any associated actions."""
         old_state = self.state
         self.state = new_state
 
-        if new_state == SessionState.CALIBRATION and old_state == SessionState.UNSTARTED:
-            self.session.init_calibration(
-                self.session.calibration_protocol)  # Pass protocol here
-        elif new_state == SessionState.TRAINING and old_state == SessionState.CALIBRATION:
-            self.session.end_calibration()
-            self.session.init_training()
-        elif new_state == SessionState.READY_FOR_CLASSIFICATION and old_state == SessionState.TRAINING:
-            model_id = "placeholder"  # Get model ID from somewhere
-            self.session.init_classification(model_id)
-        elif new_state == SessionState.CLASSIFICATION and old_state == SessionState.READY_FOR_CLASSIFICATION:
-            # Start classification (allow this transition)
-            pass
-        elif new_state == SessionState.UNSTARTED:
-            # Reset session state
-            # self.session.state = SessionState.UNSTARTED
-            self.session.connection_status = ConnectionStatus.DISCONNECTED
-            self.session.eeg_buffer.clear()
-            self.session.last_received_timestamp = 0
-            self.session.last_processed_timestamp = 0
-        else:
-            raise ValueError(
-                f"Invalid state transition from {old_state} to {new_state}")
-
-    def handle_data(self, data: EEGChunk):
-        """Delegates data handling to the appropriate method based on the current state."""
+        try:
+            if new_state == SessionState.CALIBRATION and old_state == SessionState.UNSTARTED:
+                self.session.start_calibration_recording()
+                self.session.reset_filters()
+            elif new_state == SessionState.TRAINING and old_state == SessionState.CALIBRATION:
+                self.session.end_calibration()
+                self.session.init_training()
+            elif new_state == SessionState.READY_FOR_CLASSIFICATION and old_state == SessionState.TRAINING:
+                # The model is trained and stored under the session ID
+                self.session.init_classification(str(self.session.session_id))
+            elif new_state == SessionState.CLASSIFICATION and old_state == SessionState.READY_FOR_CLASSIFICATION:
+                # Start classification (allow this transition)
+                self.session.reset_filters()
+                self.session.start_epoching()
+            elif new_state == SessionState.CLOSED:
+                self.session.closed_at = time.monotonic()
+                if old_state == SessionState.TRAINING:
+                    # Nobody is left to use the model
+                    ml_service.cancel_training(str(self.session.session_id))
+            elif new_state == SessionState.UNSTARTED:
+                # Reset session state
+                # self.session.state = SessionState.UNSTARTED
+                self.session.connection_status = ConnectionStatus.DISCONNECTED
+                if self.session.eeg_buffer is not None:
+                    self.session.eeg_buffer.clear()
+                self.session.last_received_timestamp = 0
+                self.session.last_processed_timestamp = 0
+            else:
+                self.state = old_state
+                raise ValueError(
+                    f"Invalid state transition from {old_state} to {new_state}")
+        except Exception:
+            # Invalid transitions keep the old state, a failed transition action
+            # leaves the session in the error state
+            if self.state == new_state and old_state != new_state:
+                self.state = SessionState.ERROR
+            raise
+
+    def handle_data(self, samples: np.ndarray, timestamps: np.ndarray):
+        """Conditions and buffers a channel-major chunk, then delegates it based on the current state."""
+        if self.state in (SessionState.CALIBRATION, SessionState.CLASSIFICATION) \
+                and self.session.filter_bank is not None:
+            samples = self.session.filter_bank.preprocess(samples)
+        self.session.eeg_buffer.append(samples, timestamps)
         if self.state == SessionState.CALIBRATION:
-            self.session.handle_calibration_data(data)
+            self.session.handle_calibration_data(samples, timestamps)
         elif self.state == SessionState.CLASSIFICATION:
-            self.session.handle_classification_data(data)
+            self.session.handle_classification_data(samples, timestamps)
         else:  # Ignore data in other states
             pass
 
@@ -93,13 +140,41 @@ class BCISession:
 
     # Fields with default values
     # state: SessionState = SessionState.UNSTARTED
+    user_id: Optional[str] = None  # owning user, if known
     connection_status: ConnectionStatus = ConnectionStatus.DISCONNECTED
-    eeg_buffer: deque = field(default_factory=lambda: deque(maxlen=1000))
+    frame_encoding: FrameEncoding = FrameEncoding.JSON
+    # Allocated once the channel count and sampling rate are known
+    eeg_buffer: Optional[EEGRingBuffer] = None
+    filter_bank: Optional[StreamingFilterBank] = None
+    # Resamples incoming chunks onto the sampling rate grid, see server/bci/clock.py
+    clock: Optional[ClockModel] = None
+    epoch_windower: Optional[EpochWindower] = None
     last_received_timestamp: float = 0
     last_processed_timestamp: float = 0
-    
-    classification_buffer: List = field(default_factory=list)
+    # Monotonic clock times used by the session reaper
+    last_activity: float = field(default_factory=time.monotonic)
+    closed_at: Optional[float] = None
+    # Storage key of the EEG buffer while it is spilled to disk
+    spilled_key: Optional[str] = None
+
     prediction_buffer: List = field(default_factory=list)
+    # Subscribers receiving each classification result as it is produced
+    results: ResultBroadcaster = field(default_factory=ResultBroadcaster, repr=False)
+    # Push results on the EEG stream socket itself, set by a SUBSCRIBE message
+    push_results: bool = False
+    # Ingest queue metrics of the current stream connection
+    stream_metrics: Optional[Dict] = None
+    # Throughput and latency of the frames received over the whole session
+    ingest: IngestMetrics = field(default_factory=lambda: IngestMetrics(
+        CONFIG.BCI_CONFIG.INGEST_RATE_WINDOW_SECONDS), repr=False)
+    # High-water mark of the stream, the highest frame sequence number accepted
+    last_sequence: Optional[int] = None
+    missing_frames: int = 0
+    duplicate_frames: int = 0
+    # Set while the stream is disconnected, the client may resume until the reaper ends it
+    disconnected_at: Optional[float] = None
+    # Set while a stream socket is connected, a session has one stream at a time
+    stream_attached: bool = False
 
     storage_repo: Union[
         # InfluxDBTimeSeriesRepository,
@@ -111,6 +186,7 @@ class BCISession:
 
 
     calibration_raw: Optional[RawArray] = None
+    calibration_recorder: Optional[CalibrationRecorder] = None
     calibration_protocol: Optional[CalibrationProtocol] = None
     calibration_events: Optional[List] = None
     calibration_duration: Optional[float] = None  # in seconds
@@ -119,87 +195,321 @@ class BCISession:
 
     # raw: Optional[RawArray] = None
     state_handler: SessionStateHandler = field(init=False)
+    _buffer_lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False)
+    _spill_storage: Optional[LocalPickleStorage] = field(
+        default=None, init=False, repr=False)
 
     def __post_init__(self):
         """Initialization after dataclass fields are set."""
         self.state_handler = SessionStateHandler(self)
 
-    def add_eeg_data(self, data: EEGChunk):
-        """Entry point for new EEG data. Delegates to state handler."""
-        self.state_handler.handle_data(data)
+    @property
+    def state(self) -> SessionState:
+        return self.state_handler.state
+
+    def allocate_buffers(self, n_channels: int):
+        """Allocate the EEG ring buffer, sized from the session's sampling rate."""
+        settings = CONFIG.BCI_CONFIG
+        sfreq = self.info["sfreq"] if self.info is not None else settings.DEFAULT_SAMPLING_RATE
+        self.eeg_buffer = EEGRingBuffer.for_stream(
+            n_channels, sfreq, settings.EEG_BUFFER_SECONDS, settings.EEG_BUFFER_MAX_BYTES)
+        if settings.FILTER_ENABLED:
+            self.filter_bank = StreamingFilterBank(
+                sfreq, l_freq=settings.FILTER_L_FREQ, h_freq=settings.FILTER_H_FREQ,
+                notch_freq=settings.NOTCH_FREQ, car=settings.COMMON_AVERAGE_REFERENCE)
+
+    def regularize_timestamps(self, samples: np.ndarray, timestamps: np.ndarray):
+        """Resample a chunk onto the session's sampling grid. Caller holds the buffer lock."""
+        settings = CONFIG.BCI_CONFIG
+        if not settings.TIMESTAMP_REGULARIZATION:
+            return samples, timestamps
+        if self.clock is None:
+            sfreq = self.info["sfreq"] if self.info is not None else settings.DEFAULT_SAMPLING_RATE
+            self.clock = ClockModel(sfreq, settings.CLOCK_WINDOW_SECONDS,
+                                    settings.CLOCK_MAX_GAP_SECONDS)
+        return self.clock.regularize(samples, timestamps)
+
+    def reset_filters(self):
+        """Restart the online filters, e.g. when a new recording phase begins."""
+        if self.filter_bank is not None:
+            self.filter_bank.reset()
+
+    def touch(self):
+        """Record activity on the session, postponing its idle eviction."""
+        self.last_activity = time.monotonic()
+
+    @property
+    def buffer_nbytes(self) -> int:
+        """Bytes of the EEG ring buffer held in memory, what spilling it frees."""
+        with self._buffer_lock:
+            return self.eeg_buffer.nbytes if self.eeg_buffer is not None else 0
+
+    def spill_buffers(self, storage: LocalPickleStorage) -> int:
+        """Move the EEG ring buffer to disk and return the number of bytes freed."""
+        with self._buffer_lock:
+            if self.eeg_buffer is None:
+                return 0
+            key = f"spill/{self.session_id}.pkl"
+            storage.save(self.eeg_buffer, key)
+            freed = self.eeg_buffer.nbytes
+            self.eeg_buffer = None
+            self.spilled_key = key
+            self._spill_storage = storage
+            return freed
+
+    def _restore_buffers(self):
+        """Load a spilled EEG ring buffer back into memory. Caller holds the buffer lock."""
+        if self.spilled_key is None:
+            return
+        self.eeg_buffer = self._spill_storage.load(self.spilled_key)
+        self.discard_spill()
+
+    def discard_spill(self):
+        """Delete the spilled buffer file, if any."""
+        if self.spilled_key is not None:
+            (self._spill_storage.cache_dir / self.spilled_key).unlink(missing_ok=True)
+            self.spilled_key = None
+
+    def _is_new_sequence(self, sequence: Optional[int]) -> bool:
+        """False for a frame at or below the high-water mark (already received)."""
+        if sequence is None or self.last_sequence is None or sequence > self.last_sequence:
+            return True
+        self.duplicate_frames += 1
+        return False
+
+    def _advance_sequence(self, sequence: Optional[int]):
+        """Move the high-water mark to an accepted frame, counting the frames missing before it."""
+        if sequence is None:
+            return
+        if self.last_sequence is not None:
+            self.missing_frames += sequence - self.last_sequence - 1
+        self.last_sequence = sequence
+
+    @property
+    def n_channels(self) -> Optional[int]:
+        """Number of channels of the stream, None before the first chunk of a stream without START."""
+        if self.info is not None:
+            return len(self.info.ch_names)
+        return self.eeg_buffer.n_channels if self.eeg_buffer is not None else None
+
+    @property
+    def next_sequence(self) -> int:
+        """Sequence number the client should continue from."""
+        return 0 if self.last_sequence is None else self.last_sequence + 1
+
+    def add_eeg_data(self, data: Union[EEGChunk, EEGFrame]) -> bool:
+        """Entry point for new EEG data. Delegates to state handler.
+
+        Frames carrying a sequence number at or below the session's high-water
+        mark were already received (e.g. replayed after a reconnect) and are
+        skipped. Returns False for those. A chunk with the wrong number of
+        channels raises ValueError before it changes anything, the high-water
+        mark only moves past frames that were accepted.
+        """
+        samples, timestamps = chunk_to_arrays(data)
+        sequence = getattr(data, "sequence", None)
+        self.touch()
+        with self._buffer_lock:
+            if not self._is_new_sequence(sequence):
+                return False
+            n_channels = self.n_channels
+            if n_channels is not None and samples.shape[0] != n_channels:
+                raise ValueError(f"Expected {n_channels} channels, got {samples.shape[0]}")
+            samples, timestamps = self.regularize_timestamps(samples, timestamps)
+            if len(timestamps):
+                self._restore_buffers()
+                if self.eeg_buffer is None:
+                    self.allocate_buffers(samples.shape[0])
+                self.last_received_timestamp = float(timestamps[-1])
+                self.state_handler.handle_data(samples, timestamps)
+            self._advance_sequence(sequence)
+            calibrated = self.state == SessionState.CALIBRATION and \
+                self.calibration_recorder is not None and self.calibration_recorder.is_complete
+        if calibrated:
+            # Storing the recording and queueing the training do not hold up other chunks
+            print("Calibration complete. Starting training..")
+            self.state_handler.transition_to(SessionState.TRAINING)
+        if len(timestamps) and self.info is not None and CONFIG.BCI_CONFIG.EEG_MONGO_ENABLED:
+            # Only copied into the open bucket, written to MongoDB in the background
+            get_eeg_writer().enqueue(str(self.session_id), samples, timestamps, self.info.ch_names)
+        return True
 
     def init_calibration(self, protocol: CalibrationProtocol):
         """Initialize calibration process."""
         # Setting up the raw and info and events
         try:
-            # Transition to calibration state
+            self.calibration_protocol = protocol
+            # Transition to calibration state, this starts the recording
             self.state_handler.transition_to(SessionState.CALIBRATION)
             return True
         except Exception as e:
             print(f"Error initializing calibration: {e}")
             return None
 
-    def handle_calibration_data(self, data: EEGChunk):
-        """Handles EEG data during calibration."""
-        # Append data to the calibration buffer
-        # self.eeg_buffer.append(data)
-        # Append data to the calibration raw object
-        # flatten the eeg chunk and append to calibration mne.io raw object
-        # Check if we have enough data to end calibration  (based on calibration protocol total length)
+    def start_calibration_recording(self):
+        """Set up the recorder for a calibration run of the protocol's length."""
+        if self.info is None:
+            raise ValueError("Cannot calibrate before the stream has started")
         from .util import calc_protocol_time
-        if self.calibration_raw >= calc_protocol_time(self.calibration_protocol):
-            self.state_handler.transition_to(SessionState.TRAINING)
-            print("Calibration complete. Starting training..")
-        else:
-            data = np.array(data.data).flatten()
-            self.calibration_raw.append(data)
-            print(f"Calibration data length: {len(self.calibration_raw)}")
+        self.calibration_raw = None
+        self.calibration_recorder = CalibrationRecorder(
+            n_channels=len(self.info.ch_names),
+            sfreq=self.info["sfreq"],
+            duration=calc_protocol_time(self.calibration_protocol),
+        )
+
+    def handle_calibration_data(self, samples: np.ndarray, timestamps: np.ndarray):
+        """Handles EEG data during calibration."""
+        recorder = self.calibration_recorder
+        # Record up to the protocol length, anything after that belongs to the next state
+        n = min(samples.shape[1], recorder.remaining)
+        recorder.append(samples[:, :n], timestamps[:n])
+        # Once it holds the protocol's length, add_eeg_data ends the calibration outside the buffer lock
 
     def end_calibration(self):
         """End the calibration process."""
+        # Build the raw object once from the whole recording and release the recorder
+        with self._buffer_lock:
+            recorder, self.calibration_recorder = self.calibration_recorder, None
+        calibration_raw = recorder.to_raw(self.info)
+        # The trials are where the protocol put them, counted from the first calibration sample
+        from .util import protocol_annotations
+        calibration_raw.set_annotations(protocol_annotations(self.calibration_protocol))
+        self.calibration_raw = calibration_raw
         # Store calibration data
         self.storage_repo.save(self.calibration_raw,
                                "calibration_raw"+str(self.session_id))
 
-        print("Calibration complete. Starting training..")
-        self.state_handler.transition_to(SessionState.TRAINING)
-
     def init_training(self):
         """Initialize model training."""
-        # Feed calibration data to the ML service and start training
-        ml_service.add_to_queue(self.calibration_raw)
+        # Feed calibration data to the ML service, training runs in the background
+        ml_service.add_to_queue(
+            str(self.session_id), calibration_data=self.calibration_raw,
+            on_done=self.on_training_done)
+
+    def on_training_done(self, job):
+        """Called by the training scheduler, from a worker callback thread, when the job ends."""
+        if self.state != SessionState.TRAINING:
+            return
+        if job.status == TrainingStatus.COMPLETED:
+            self.state_handler.transition_to(SessionState.READY_FOR_CLASSIFICATION)
+            if self.push_results or self.results.has_subscribers:
+                # Somebody is already waiting for results
+                self.start_classification()
+        else:
+            print(f"Training for session {self.session_id} ended with status {job.status}: {job.error}")
+            self.state_handler.state = SessionState.ERROR
 
     def init_classification(self, model_id: str):
         """Initialize classification with the loaded model."""
         self.classification_model = ml_service.load_model(model_id)
 
-    def handle_classification_data(self, data: EEGChunk):
+    def start_classification(self) -> bool:
+        """Start classifying once the model is ready, returns whether the session is classifying."""
+        with self._buffer_lock:
+            if self.state == SessionState.READY_FOR_CLASSIFICATION:
+                try:
+                    self._restore_buffers()
+                    self.state_handler.transition_to(SessionState.CLASSIFICATION)
+                except Exception as e:
+                    print(f"Error starting classification: {e}")
+            return self.state == SessionState.CLASSIFICATION
+
+    def start_epoching(self):
+        """Start cutting classification epochs from the data received from now on."""
+        settings = CONFIG.BCI_CONFIG
+        model = getattr(self, "classification_model", None)
+        sfreq = self.eeg_buffer.sfreq if self.eeg_buffer is not None else None
+        if sfreq is None:
+            sfreq = self.info["sfreq"] if self.info is not None else settings.DEFAULT_SAMPLING_RATE
+        # Epochs are cut as the model was trained, the config only applies without a model
+        model_sfreq = getattr(model, "sfreq", None)
+        if model_sfreq is not None and model_sfreq != sfreq:
+            raise ValueError(
+                f"Model was trained at {model_sfreq} Hz but the stream runs at {sfreq} Hz")
+        self.epoch_windower = EpochWindower(
+            sfreq,
+            epoch_length=getattr(model, "epoch_length", settings.EPOCH_LENGTH_SECONDS),
+            overlap=getattr(model, "overlap", settings.EPOCH_OVERLAP),
+            max_epochs=settings.MAX_EPOCHS_PER_CLASSIFICATION,
+        )
+        self.epoch_windower.reset(
+            self.eeg_buffer.total_samples if self.eeg_buffer is not None else 0)
+
+    def handle_classification_data(self, samples: np.ndarray, timestamps: np.ndarray):
         """Handles EEG data during classification, makes predictions, and processes results."""
-        # Append data to the classification buffer
-        self.classification_buffer.append(data)
+        # Nothing to do per chunk, the data is read back from the ring buffer when classifying
+        pass
+
+    @property
+    def wants_results(self) -> bool:
+        """Whether results should be computed as data arrives, for a push subscriber."""
+        return self.state == SessionState.CLASSIFICATION and \
+            (self.push_results or self.results.has_subscribers)
+
+    def classify_new_epochs(self) -> List[ClassificationResult]:
+        """Classify the epochs completed since the last call and publish their results to the subscribers."""
+        if self.epoch_windower is None:
+            raise ValueError("Classification has not started for this session")
+        with self._buffer_lock:
+            self._restore_buffers()
+            if self.eeg_buffer is None:
+                return []
+            # The epochs are views into the ring buffer, classify them before it is written again
+            batch = self.epoch_windower.collect(self.eeg_buffer)
+            if batch is None:
+                return []
+            predictions = ml_service.classify_epochs(str(self.session_id), batch.data)
+        # Add to prediction buffer, keyed by the timestamp of the end of each window
+        stream_timestamps = batch.timestamps.tolist()
+        self.prediction_buffer.extend(zip(stream_timestamps, predictions))
+        issued_at = datetime.now()
+        results = [ClassificationResult(state=prediction_label(prediction), timestamp=issued_at,
+                                        issued_at=issued_at, stream_timestamp=stream_timestamp)
+                   for stream_timestamp, prediction in zip(stream_timestamps, predictions)]
+        for result in results:
+            self.results.publish(result_message(result))
+        return results
 
     def get_classification_results(self):
-        """Get the latest classification results."""
-        pred = ml_service.classify(self.session_id, self.classification_buffer)
-        # Add to prediction buffer
-        self.prediction_buffer.append((time.time(), pred))
-        return pred
+        """Classify the epochs completed since the last call and return the latest prediction.
+
+        Returns the previous prediction if no new epoch is complete yet, or None
+        if nothing was classified so far.
+        """
+        self.touch()
+        self.classify_new_epochs()
+        return self.prediction_buffer[-1][1] if self.prediction_buffer else None
+
+    def get_ingest_stats(self) -> dict:
+        """Ingest throughput and latency, with the queue metrics of the current connection."""
+        return {"ingest": self.ingest.get_stats(), "stream": self.stream_metrics}
 
     def get_session_stats(self):
         try:
-            calibration_data_len = len(
-                self.calibration_data.data) if self.calibration_data else 0
-            classification_data_len = len(
-                self.classification_buffer) if self.classification_buffer else 0
-            eeg_buffer_len = len(self.eeg_buffer) if self.eeg_buffer else 0
-            dict_out = {
-                "session_id": self.session_id,
-                "state": str(self.state_handler.state),
-                "channels": dict(self.info.ch_names if self.info else None),
-                "calibration_data": calibration_data_len,
-                "classification_data": classification_data_len,
-                "eeg_buffer_data": eeg_buffer_len
-            }
+            with self._buffer_lock:
+                buffer = self.eeg_buffer
+                if self.calibration_recorder is not None:
+                    calibration_data_len = self.calibration_recorder.n_samples
+                elif self.calibration_raw is not None:
+                    calibration_data_len = int(self.calibration_raw.n_times)
+                else:
+                    calibration_data_len = 0
+                dict_out = {
+                    "session_id": str(self.session_id),
+                    "state": str(self.state_handler.state),
+                    "channels": list(self.info.ch_names) if self.info else None,
+                    "calibration_data": calibration_data_len,
+                    "samples_received": buffer.total_samples if buffer is not None else 0,
+                    "eeg_buffer_data": len(buffer) if buffer is not None else 0,
+                    "eeg_buffer_bytes": buffer.nbytes if buffer is not None else 0,
+                    "last_sequence": self.last_sequence,
+                    "missing_frames": self.missing_frames,
+                    "duplicate_frames": self.duplicate_frames,
+                    "clock": self.clock.get_stats() if self.clock is not None else None,
+                }
+            dict_out.update(self.get_ingest_stats())
             return dict_out
         except Exception as e:
             print(f"Error getting session stats: {e}")
@@ -207,44 +517,261 @@ class BCISession:
 
     def __dict__(self):
         return {
-            "session_id": self.session_id,
+            "session_id": str(self.session_id),
             "state": str(self.state_handler.state),
-            "channels": dict(self.info.ch_names if self.info else None),
+            "channels": list(self.info.ch_names) if self.info else None,
+            "user_id": self.user_id,
         }
 
 # from .repo import ISessionRepository, session_repo
 
 
-class SessionManager:
+def prediction_label(prediction) -> str:
+    """Name of the class predicted by the model, e.g. 'feet' or 'rest'."""
+    try:
+        return ClassEnum(int(prediction)).name
+    except ValueError:
+        return str(prediction)
+
+
+def normalize_session_id(session_id: Union[uuid.UUID, str]) -> uuid.UUID:
+    """Parse a session ID in any UUID notation (dashed, hex, ...) into a UUID."""
+    if isinstance(session_id, uuid.UUID):
+        return session_id
+    return uuid.UUID(str(session_id))
+
+
+class _SessionShard:
+    """One lock stripe of the session registry, with its own secondary indexes."""
+
     def __init__(self):
-        self.sessions = []
-
-    def create_session(self, session_id) -> uuid.UUID:
-        """Create a new BCI session and return its ID."""
-        new_session = BCISession(session_id=session_id)
-        # check if session already exists in memory
-        if session_id in self.sessions:
-            raise Exception("Session already exists.")
-        self.sessions.append(new_session)
+        self.lock = threading.RLock()
+        self.sessions: Dict[uuid.UUID, BCISession] = {}
+        self.by_state: Dict[SessionState, Set[uuid.UUID]] = defaultdict(set)
+        self.by_user: Dict[str, Set[uuid.UUID]] = defaultdict(set)
+
+
+class SessionManager:
+    """
+    In-memory registry of the BCI sessions running on this worker.
+
+    Sessions are keyed by their normalized UUID and spread over lock-striped
+    shards, so lookups are O(1) and only contend with sessions in the same
+    shard. Each shard also indexes its sessions by state and by owning user,
+    which keeps filtered listings proportional to the number of matches.
+
+    A background reaper (see `reap`) evicts ended and idle sessions and keeps
+    the EEG buffers of all sessions within a memory budget.
+    """
+
+    def __init__(self, n_shards: int = 16, spill_storage: Optional[LocalPickleStorage] = None):
+        self.shards = [_SessionShard() for _ in range(n_shards)]
+        self.spill_storage = spill_storage
+        self.reaper_stats = {
+            "evicted_idle": 0,
+            "evicted_closed": 0,
+            "ended_disconnected": 0,
+            "spilled": 0,
+            "spilled_bytes": 0,
+        }
+        self._reaper_task: Optional[asyncio.Task] = None
+
+    def _shard(self, session_id: uuid.UUID) -> _SessionShard:
+        return self.shards[session_id.int % len(self.shards)]
+
+    def _on_state_change(self, session: BCISession, old_state: SessionState, new_state: SessionState):
+        shard = self._shard(session.session_id)
+        with shard.lock:
+            if session.session_id not in shard.sessions:
+                return
+            shard.by_state[old_state].discard(session.session_id)
+            shard.by_state[new_state].add(session.session_id)
+
+    def create_session(self, session_id, user_id: Optional[str] = None) -> BCISession:
+        """Create a new BCI session and return it."""
+        session_id = normalize_session_id(session_id)
+        shard = self._shard(session_id)
+        with shard.lock:
+            # check if session already exists in memory
+            if session_id in shard.sessions:
+                raise ValueError("Session already exists.")
+            new_session = BCISession(session_id=session_id, user_id=user_id)
+            shard.sessions[session_id] = new_session
+            shard.by_state[new_session.state].add(session_id)
+            if user_id:
+                shard.by_user[user_id].add(session_id)
+            new_session.state_handler.on_state_change = self._on_state_change
         return new_session
 
-    def get_session(self, session_id: uuid.UUID) -> Optional[BCISession]:
+    def get_session(self, session_id) -> Optional[BCISession]:
         """Retrieve an existing BCI session by its ID."""
-        for session in self.sessions:
-            if str(session.session_id) == str(session_id):
-                return session
-        return None
+        try:
+            session_id = normalize_session_id(session_id)
+        except ValueError:
+            return None
+        shard = self._shard(session_id)
+        with shard.lock:
+            return shard.sessions.get(session_id)
+
+    def get_or_create_session(self, session_id, user_id: Optional[str] = None) -> BCISession:
+        """Retrieve a session, creating it if it does not exist yet."""
+        session_id = normalize_session_id(session_id)
+        shard = self._shard(session_id)
+        with shard.lock:
+            session = shard.sessions.get(session_id)
+            if session is not None and session.state == SessionState.CLOSED:
+                # An ended session is only kept for its stats, start over
+                self.remove_session(session_id)
+                session = None
+            if session is None:
+                session = self.create_session(session_id, user_id=user_id)
+            return session
+
+    def set_owner(self, session_id, user_id: str):
+        """Record the user owning a session."""
+        session = self.get_session(session_id)
+        if session is None:
+            raise KeyError(f"Session {session_id} not found")
+        shard = self._shard(session.session_id)
+        with shard.lock:
+            if session.user_id:
+                shard.by_user[session.user_id].discard(session.session_id)
+            session.user_id = user_id
+            shard.by_user[user_id].add(session.session_id)
+
+    def remove_session(self, session_id) -> Optional[BCISession]:
+        """Drop a session from the registry and its indexes, cancelling its training job."""
+        session_id = normalize_session_id(session_id)
+        shard = self._shard(session_id)
+        with shard.lock:
+            session = shard.sessions.pop(session_id, None)
+            if session is None:
+                return None
+            shard.by_state[session.state].discard(session_id)
+            if session.user_id:
+                shard.by_user[session.user_id].discard(session_id)
+            session.state_handler.on_state_change = None
+        if session.state == SessionState.TRAINING:
+            ml_service.cancel_training(str(session_id))
+        session.discard_spill()
+        return session
+
+    def _collect(self, index_name: str, key) -> List[BCISession]:
+        sessions = []
+        for shard in self.shards:
+            with shard.lock:
+                ids = getattr(shard, index_name).get(key, ())
+                sessions.extend(shard.sessions[session_id] for session_id in ids)
+        return sessions
+
+    def sessions_by_state(self, state: SessionState) -> List[BCISession]:
+        """All sessions currently in the given state."""
+        return self._collect("by_state", state)
+
+    def sessions_by_user(self, user_id: str) -> List[BCISession]:
+        """All sessions owned by the given user."""
+        return self._collect("by_user", user_id)
+
+    def list_sessions(self) -> List[BCISession]:
+        sessions = []
+        for shard in self.shards:
+            with shard.lock:
+                sessions.extend(shard.sessions.values())
+        return sessions
+
+    def __len__(self) -> int:
+        return sum(len(shard.sessions) for shard in self.shards)
 
     def end_session(self, session_id: uuid.UUID, normal_closure: bool = True):
         """End a session and return the session object."""
         # session = self.sessions.pop(session_id)
         session = self.get_session(session_id)
-        # TODO: add session closing here
+        if session is None:
+            return None
+        # Keep the session around for its stats, the reaper evicts it later
+        if session.state != SessionState.CLOSED:
+            session.state_handler.transition_to(SessionState.CLOSED)
+        # Let the result subscribers know no more results will come
+        session.results.close()
+        if CONFIG.BCI_CONFIG.EEG_MONGO_ENABLED:
+            get_eeg_writer().close_session(str(session.session_id))
         print(f"Session {session_id} ended.")
         # print session stats dict
         print(session.get_session_stats())
         return session
 
+    def reap(self, now: Optional[float] = None) -> dict:
+        """Evict closed and idle sessions, then spill buffers above the memory budget."""
+        settings = CONFIG.BCI_CONFIG
+        now = time.monotonic() if now is None else now
+        for session in self.list_sessions():
+            if session.state == SessionState.CLOSED:
+                if now - session.closed_at >= settings.CLOSED_SESSION_TTL_SECONDS:
+                    self.remove_session(session.session_id)
+                    self.reaper_stats["evicted_closed"] += 1
+            elif (session.state != SessionState.TRAINING
+                  and now - session.last_activity >= settings.SESSION_IDLE_TTL_SECONDS):
+                # No data flows while the model trains, such sessions are not idle
+                self.remove_session(session.session_id)
+                self.reaper_stats["evicted_idle"] += 1
+            elif (session.disconnected_at is not None
+                  and now - session.disconnected_at >= settings.STREAM_RESUME_WINDOW_SECONDS):
+                # The client did not come back to resume its stream
+                self.end_session(session.session_id)
+                self.reaper_stats["ended_disconnected"] += 1
+        self.enforce_memory_budget(settings.SESSION_MEMORY_BUDGET_BYTES, now)
+        return dict(self.reaper_stats)
+
+    def memory_usage(self) -> int:
+        """Bytes of EEG ring buffers held in memory across all sessions."""
+        return sum(session.buffer_nbytes for session in self.list_sessions())
+
+    def enforce_memory_budget(self, budget: int, now: Optional[float] = None):
+        """
+        Spill the buffers of the least recently active sessions until usage fits the budget.
+
+        Sessions that received data since the previous reaper run are streaming
+        and would load their buffer right back, they are never spilled.
+        """
+        now = time.monotonic() if now is None else now
+        sessions = self.list_sessions()
+        usage = sum(session.buffer_nbytes for session in sessions)
+        if usage <= budget:
+            return
+        if self.spill_storage is None:
+            self.spill_storage = LocalPickleStorage()
+        active_since = now - CONFIG.BCI_CONFIG.SESSION_REAPER_INTERVAL_SECONDS
+        for session in sorted(sessions, key=lambda s: s.last_activity):
+            if session.last_activity >= active_since:
+                # Sorted by activity, all the remaining ones are active too
+                break
+            freed = session.spill_buffers(self.spill_storage)
+            if freed:
+                usage -= freed
+                self.reaper_stats["spilled"] += 1
+                self.reaper_stats["spilled_bytes"] += freed
+            if usage <= budget:
+                break
+
+    async def _reaper_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.reap)
+            except Exception as e:
+                print(f"Error reaping sessions: {e}")
+
+    def start_reaper(self):
+        """Start the background reaper on the running event loop."""
+        if self._reaper_task is None or self._reaper_task.done():
+            self._reaper_task = asyncio.get_running_loop().create_task(
+                self._reaper_loop(CONFIG.BCI_CONFIG.SESSION_REAPER_INTERVAL_SECONDS))
+
+    def stop_reaper(self):
+        if self._reaper_task is not None:
+            self._reaper_task.cancel()
+            self._reaper_task = None
+
 
 # Global session manager instance
 session_manager = SessionManager()
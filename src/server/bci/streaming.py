@@ -3,7 +3,9 @@ from server.bci.service import BCISession
 
 import asyncio
 import json
-from typing import Dict, List
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Set
 
 import mne
 from mne.io import RawArray
@@ -13,9 +15,12 @@ from pydantic import BaseModel, Field
 import uuid
 
 from server.bci.models import (
-    EEGChunk, SessionState
+    AckMode, CalibrationProtocol, EEGChunk, SessionState, FrameEncoding
 )
+from server.bci.frames import FrameError, FRAME_VERSION, decode_frame
+from server.bci.broadcast import result_message
 from server.bci.service import session_manager
+from server.config import CONFIG
 
 
 '''
@@ -33,15 +38,65 @@ Use these payloads to test the WebSocket connection in the FastAPI application.
     "O2",
     "P3",
     "P4"
-  ]
+  ],
+  "encoding": "json"
 }
 
+Clients sending binary EEG frames (see server/bci/frames.py) set "encoding" to
+"binary" in the START message and then send each chunk as a binary message.
+
 
 {
   "type": "END",
   "session_id": "12345678-1234-5678-1234-567812345678"
 }
 
+After START, a CALIBRATE message starts recording the calibration with the
+protocol the client runs (e.g. the one from /bci/calibration/start/), from
+the next EEG frame on. Each action is a trial labeled with its "label"
+("feet", "rest"), where the protocol puts it. The model is trained once the
+protocol's length was recorded:
+{
+  "type": "CALIBRATE",
+  "protocol": {"prepare": {...}, "main_trial": {...}, "end": {...}}
+}
+
+Send a SUBSCRIBE message to have CLASSIFICATION_RESULT frames pushed on the
+stream as soon as new epochs are classified ("results": false to stop):
+{
+  "type": "SUBSCRIBE",
+  "results": true
+}
+Classification starts as soon as the model is trained and somebody wants the
+results: a SUBSCRIBE message, a results socket or a result request.
+
+Add "ack_mode": "cumulative" to the START message to have EEG frames
+acknowledged with "ACK <sequence>" every "ack_every" frames (32) or
+"ack_interval_ms" milliseconds (100) instead of an "ACK" per frame. The
+sequence is the highest one up to which every frame was processed, taken
+from binary frames or the "sequence" field of EEG_DATA messages, frames
+without one count as the next. Other messages are still ACKed one by one.
+
+EEG frames should carry increasing sequence numbers. A frame at or below the
+session's high-water mark was already received and is skipped. When the
+stream drops without an END message the session is kept for a while, and a
+client reconnecting to it sends RESUME instead of START:
+{
+  "type": "RESUME",
+  "session_id": "12345678-1234-5678-1234-567812345678",
+  "ack_mode": "cumulative"
+}
+The reply tells it which frame to replay from, the session's channels,
+encoding and buffers are kept as they were:
+{"type": "RESUME", "session_id": "...", "next_sequence": 1234, "last_sequence": 1233, ...}
+A START message starts a new stream, with sequence numbers from scratch.
+
+Clients that only need the predictions connect to /bci/results/{session_id}.
+
+When the server falls behind, it sends {"type": "SLOW_DOWN", ...} and drops
+EEG frames once its queue is full, then {"type": "FLOW_OK", ...} when it has
+caught up (see FlowControl).
+
 {
   "type":"EEG_DATA",
   "timestamps": [1235123],
@@ -59,7 +114,23 @@ Use these payloads to test the WebSocket connection in the FastAPI application.
 '''
 
 
-class StartMessage(BaseModel):
+class AckOptions(BaseModel):
+    """
+    Acknowledgement options of a connection, negotiated by START and RESUME.
+
+    Attributes:
+        ack_mode: Acknowledge every message, or EEG frames cumulatively.
+        ack_every: Cumulative mode, frames between two ACKs at most.
+        ack_interval_ms: Cumulative mode, milliseconds an ACK is delayed at most.
+    """
+    ack_mode: AckMode = Field(
+        AckMode.EACH, description="Acknowledge every message or EEG frames cumulatively")
+    ack_every: int = Field(32, ge=1, description="Frames between two cumulative ACKs at most")
+    ack_interval_ms: float = Field(
+        100.0, gt=0, description="Milliseconds a cumulative ACK is delayed at most")
+
+
+class StartMessage(AckOptions):
     """
     Represents the START message sent at the beginning of a WebSocket session.
 
@@ -68,11 +139,32 @@ class StartMessage(BaseModel):
         session_id: Unique identifier for the session.
         channel_labels: List of channel labels corresponding to the EEG data.
         sampling_rate: Sampling rate of the EEG data.
+        encoding: Encoding of the following EEG_DATA frames, JSON or binary.
     """
     type: str = Field(..., description="Message type (should be 'START')")
     session_id: uuid.UUID
     channel_labels: List[str]
     sampling_rate: float
+    encoding: FrameEncoding = Field(
+        FrameEncoding.JSON, description="Encoding of the EEG data frames")
+
+
+class ResumeMessage(AckOptions):
+    """RESUME message continuing the stream of a session after a reconnect."""
+    type: str = Field(..., description="Message type (should be 'RESUME')")
+    session_id: uuid.UUID
+
+
+class CalibrateMessage(BaseModel):
+    """CALIBRATE message starting the calibration recording of a started stream."""
+    type: str = Field(..., description="Message type (should be 'CALIBRATE')")
+    protocol: CalibrationProtocol
+
+
+class SubscribeMessage(BaseModel):
+    type: str = Field(..., description="Message type (should be 'SUBSCRIBE')")
+    results: bool = Field(
+        True, description="Push classification results on this socket")
 
 
 class EndMessage(BaseModel):
@@ -80,41 +172,364 @@ class EndMessage(BaseModel):
     session_id: uuid.UUID
 
 
+@dataclass
+class QueuedMessage:
+    """A received message with what the ingest metrics need to know about it."""
+    item: Any
+    received_at: float
+    nbytes: int = 0
+    # Time spent decoding the message before it was queued
+    parse_seconds: float = 0.0
+    queue_wait_seconds: float = 0.0
+
+
+class FlowControl:
+    """
+    Bounded ingest queue between the receiver and the processor of one stream.
+
+    EEG frames are dropped once `max_queue` messages are waiting, control
+    messages (START, SUBSCRIBE, END, ...) are always queued so the stream
+    stays consistent. The client is sent a SLOW_DOWN frame when the queue
+    fills past the high watermark and a FLOW_OK frame once the processor has
+    drained it below the low watermark:
+    {"type": "SLOW_DOWN", "queue_depth": 192, "queue_size": 256, "dropped_frames": 0}
+
+    `last` holds the message `take()` returned last, with its queue wait.
+    """
+
+    def __init__(self, websocket: WebSocket, max_queue: int, high_watermark: float = 0.75,
+                 low_watermark: float = 0.25):
+        self.websocket = websocket
+        self.max_queue = max_queue
+        self.high = max(int(max_queue * high_watermark), 1)
+        self.low = int(max_queue * low_watermark)
+        # Unbounded on purpose, the bound only applies to EEG frames
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.slowed_down = False
+        self.last: Optional[QueuedMessage] = None
+        self.metrics = {
+            "received": 0,
+            "processed": 0,
+            "dropped_frames": 0,
+            "queue_depth": 0,
+            "max_queue_depth": 0,
+            "slow_down_signals": 0,
+        }
+
+    async def _signal(self, message_type: str):
+        await self.websocket.send_json({
+            "type": message_type,
+            "queue_depth": self.queue.qsize(),
+            "queue_size": self.max_queue,
+            "dropped_frames": self.metrics["dropped_frames"],
+        })
+
+    async def offer(self, item, droppable: bool, nbytes: int = 0,
+                    parse_seconds: float = 0.0) -> bool:
+        """Queue a received message. Returns False if the frame was dropped."""
+        self.metrics["received"] += 1
+        if droppable and self.queue.qsize() >= self.max_queue:
+            self.metrics["dropped_frames"] += 1
+            return False
+        self.queue.put_nowait(QueuedMessage(item, time.monotonic(), nbytes, parse_seconds))
+        depth = self.queue.qsize()
+        self.metrics["queue_depth"] = depth
+        self.metrics["max_queue_depth"] = max(self.metrics["max_queue_depth"], depth)
+        if not self.slowed_down and depth >= self.high:
+            self.slowed_down = True
+            self.metrics["slow_down_signals"] += 1
+            await self._signal("SLOW_DOWN")
+        return True
+
+    async def take(self):
+        """Next message for the processor, None once the client is gone."""
+        self.last = await self.queue.get()
+        self.metrics["queue_depth"] = self.queue.qsize()
+        if self.slowed_down and self.queue.qsize() <= self.low:
+            self.slowed_down = False
+            await self._signal("FLOW_OK")
+        if self.last is None:
+            return None
+        self.last.queue_wait_seconds = time.monotonic() - self.last.received_at
+        return self.last.item
+
+    def close(self):
+        self.queue.put_nowait(None)
+
+
+class CumulativeAcks:
+    """
+    Acknowledges processed EEG frames by the highest contiguous sequence
+    number, with one "ACK <sequence>" per `every` frames or per `interval`
+    seconds, whichever comes first.
+
+    Frames processed out of order are held until the gap before them fills.
+    A gap still open when `max_ahead` later frames are waiting is given up on
+    (the frame was dropped), so the acknowledged sequence keeps moving.
+    """
+
+    def __init__(self, websocket: WebSocket, every: int = 32, interval: float = 0.1,
+                 max_ahead: int = 1024, start: Optional[int] = None):
+        self.websocket = websocket
+        self.every = every
+        self.interval = interval
+        self.max_ahead = max_ahead
+        # Last sequence already acknowledged before this connection, when resuming
+        self.contiguous: Optional[int] = start
+        self.acked: Optional[int] = start
+        self._ahead: Set[int] = set()
+        self._pending = 0
+        self._last_sent = time.monotonic()
+        self._timer: Optional[asyncio.Task] = None
+
+    def _advance(self, sequence: Optional[int]):
+        if self.contiguous is None:
+            self.contiguous = (sequence if sequence is not None else 0) - 1
+        if sequence is None:
+            sequence = self.contiguous + 1
+        if sequence <= self.contiguous:
+            return
+        self._ahead.add(sequence)
+        if len(self._ahead) > self.max_ahead:
+            self.contiguous = min(self._ahead) - 1
+        while self.contiguous + 1 in self._ahead:
+            self.contiguous += 1
+            self._ahead.discard(self.contiguous)
+
+    async def frame_done(self, sequence: Optional[int]):
+        """Record a processed frame, acknowledging if enough frames or time have passed."""
+        self._advance(sequence)
+        self._pending += 1
+        if self._pending >= self.every or time.monotonic() - self._last_sent >= self.interval:
+            await self.flush()
+        elif self._timer is None or self._timer.done():
+            self._timer = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        try:
+            await self.flush()
+        except Exception:
+            # The socket closed meanwhile
+            pass
+
+    async def flush(self):
+        self._pending = 0
+        self._last_sent = time.monotonic()
+        if self.contiguous is not None and self.contiguous != self.acked:
+            self.acked = self.contiguous
+            await self.websocket.send_text(f"ACK {self.acked}")
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+
+
 async def bci_websocket(websocket: WebSocket, session_id: uuid.UUID):
     """
     WebSocket endpoint for handling EEG data streaming.
 
     This function:
     1. Accepts a WebSocket connection.
-    2. Creates a new BCI session or retrieves an existing one.
-    3. Starts an asynchronous task to receive data from the WebSocket.
-    4. Handles START, EEG_DATA, and END messages.
+    2. Creates a new BCI session or retrieves an existing one. A session only
+       has one stream, a second connection is closed while the first is
+       connected, and a stream that dropped is only continued with RESUME.
+    3. Runs a receiver task reading the socket into a bounded queue (see
+       `FlowControl`) and a processor task handling the queued messages, so a
+       slow step never stalls reading the socket.
+    4. Handles START, RESUME, EEG_DATA, SUBSCRIBE and END messages, and binary EEG frames.
+    5. Pushes classification results after each chunk when subscribed.
 
     Args:
         websocket: The WebSocket object representing the connection.
         session_id: Unique identifier for the session.
     """
     await websocket.accept()
-    session = session_manager.create_session(session_id)
-    await websocket.send_json({"message": "Session created", "session_id": str(session_id)})
+    try:
+        session = session_manager.get_or_create_session(session_id)
+    except ValueError as e:
+        await websocket.send_json({"error": f"Invalid session ID: {e}"})
+        await websocket.close(code=1008)
+        return
+    if session.stream_attached:
+        await websocket.send_json({"error": f"Session {session_id} already has an active stream"})
+        await websocket.close(code=1008)
+        return
+    session.stream_attached = True
+    try:
+        await websocket.send_json({"message": "Session created", "session_id": str(session_id)})
+
+        settings = CONFIG.BCI_CONFIG
+        flow = FlowControl(websocket, settings.INGEST_QUEUE_SIZE,
+                           settings.INGEST_HIGH_WATERMARK, settings.INGEST_LOW_WATERMARK)
+        session.stream_metrics = flow.metrics
+        # A stream that dropped after START is continued, not started over
+        resuming = session.disconnected_at is not None and session.info is not None
+        session.disconnected_at = None
+        receiver = asyncio.ensure_future(receive_messages(websocket, session, flow))
+        try:
+            ended = await process_messages(websocket, session, flow, resuming)
+        except WebSocketDisconnect:
+            ended = False
+        finally:
+            receiver.cancel()
+    finally:
+        session.stream_attached = False
+    if not ended:
+        # Kept for the client to RESUME, the reaper ends it if it does not come back
+        session.disconnected_at = time.monotonic()
+        print(f"Session {session.session_id} disconnected at frame {session.last_sequence}.")
+
 
+async def receive_messages(websocket: WebSocket, session: BCISession, flow: FlowControl):
+    """Read the socket into the ingest queue until the client disconnects."""
     try:
         while True:
-            data_str = await websocket.receive_text()
-            # print(data_str)# for debugging purposes
-            data = json.loads(data_str)
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            session.touch()
+            if message.get("bytes") is not None:
+                await flow.offer(message["bytes"], droppable=True, nbytes=len(message["bytes"]))
+                continue
+            parse_start = time.perf_counter()
+            try:
+                data = json.loads(message["text"])
+            except ValueError:
+                await websocket.send_json({"error": "Invalid JSON message"})
+                continue
+            await flow.offer(data, droppable=data.get("type") == "EEG_DATA",
+                             nbytes=len(message["text"]),
+                             parse_seconds=time.perf_counter() - parse_start)
+    except (WebSocketDisconnect, RuntimeError):
+        # RuntimeError: the processor closed the socket after an END message
+        return
+    finally:
+        flow.close()
+
+
+async def process_messages(websocket: WebSocket, session: BCISession, flow: FlowControl,
+                           resuming: bool = False) -> bool:
+    """
+    Handle the queued messages in order. Returns True if the session ended
+    with an END message, False if the client went away.
+
+    `resuming` is set when the session's previous stream dropped, START is
+    refused until the client sent RESUME.
+    """
+    acks: Optional[CumulativeAcks] = None
+    try:
+        while True:
+            data = await flow.take()
+            if data is None:
+                return False
+            flow.metrics["processed"] += 1
+            if isinstance(data, bytes) or data.get("type") == "EEG_DATA":
+                try:
+                    # Filtering and buffering run off the event loop
+                    if isinstance(data, bytes):
+                        sequence = await asyncio.to_thread(
+                            handle_binary_frame, data, session, flow.last)
+                    else:
+                        sequence = await asyncio.to_thread(
+                            handle_eeg_data, data, session, flow.last)
+                except ValueError as e:  # FrameError included
+                    await websocket.send_json({"error": str(e)})
+                    sequence = data.get("sequence") if isinstance(data, dict) else None
+                    if acks is not None:
+                        # Rejected for good, resending it would not help
+                        await acks.frame_done(sequence)
+                    continue
+                if acks is not None:
+                    await acks.frame_done(sequence)
+                else:
+                    await websocket.send_text("ACK")
+                await push_new_results(session, websocket)
+                continue
+
             if data.get("type") == "START":
-                handle_start_message(data, session)
-            elif data.get("type") == "EEG_DATA":
-                handle_eeg_data(data, session)
+                if resuming:
+                    await websocket.send_json({
+                        "error": f"Session {session.session_id} was interrupted, "
+                                 "send RESUME to continue it or END to end it"})
+                    continue
+                start_msg = handle_start_message(data, session)
+                if session.frame_encoding == FrameEncoding.BINARY:
+                    await websocket.send_json({"message": "Binary frames accepted",
+                                               "encoding": FrameEncoding.BINARY.value,
+                                               "version": FRAME_VERSION})
+                acks = await negotiate_acks(start_msg, websocket, acks)
+            elif data.get("type") == "RESUME":
+                try:
+                    resume_msg = await handle_resume_message(data, session, websocket)
+                except ValueError as e:
+                    await websocket.send_json({"error": str(e)})
+                    continue
+                resuming = False
+                acks = await negotiate_acks(resume_msg, websocket, acks, session.last_sequence)
+            elif data.get("type") == "CALIBRATE":
+                try:
+                    handle_calibrate_message(data, session)
+                except ValueError as e:
+                    await websocket.send_json({"error": str(e)})
+                    continue
+            elif data.get("type") == "SUBSCRIBE":
+                session.push_results = SubscribeMessage(**data).results
+                if session.push_results:
+                    await asyncio.to_thread(session.start_classification)
             elif data.get("type") == "END":
+                if acks is not None:
+                    await acks.flush()
                 await handle_end_message(data, session, websocket)
-                break
+                return True
             else:
                 await websocket.send_json({"error": "Unknown message type"})
             await websocket.send_text("ACK")
-    except WebSocketDisconnect:
-        session_manager.end_session(session.session_id)
+            await push_new_results(session, websocket)
+    finally:
+        if acks is not None:
+            acks.close()
+
+
+async def negotiate_acks(options: AckOptions, websocket: WebSocket,
+                         current: Optional[CumulativeAcks],
+                         start: Optional[int] = None) -> Optional[CumulativeAcks]:
+    """Set up the ACK mode a START or RESUME message asked for, replacing the current one."""
+    if current is not None:
+        current.close()
+    if options.ack_mode != AckMode.CUMULATIVE:
+        return None
+    await websocket.send_json({"message": "Cumulative ACKs",
+                               "ack_mode": AckMode.CUMULATIVE.value,
+                               "ack_every": options.ack_every,
+                               "ack_interval_ms": options.ack_interval_ms})
+    return CumulativeAcks(websocket, options.ack_every, options.ack_interval_ms / 1000,
+                          start=start)
+
+
+async def handle_resume_message(data: Dict, session: BCISession,
+                                websocket: WebSocket) -> ResumeMessage:
+    """
+    Continue the stream of a session after a reconnect.
+
+    Nothing is reset, the client is told the sequence number to replay from.
+    """
+    resume_msg = ResumeMessage(**data)
+    if resume_msg.session_id != uuid.UUID(str(session.session_id)):
+        raise ValueError(f"RESUME is for session {resume_msg.session_id}")
+    if session.info is None:
+        raise ValueError("Nothing to resume, send START first")
+    await websocket.send_json({
+        "type": "RESUME",
+        "session_id": str(session.session_id),
+        "next_sequence": session.next_sequence,
+        "last_sequence": session.last_sequence,
+        "state": session.state.value,
+        "encoding": session.frame_encoding.value,
+        "channel_labels": list(session.info.ch_names),
+    })
+    print(f"Session {session.session_id} resumed at frame {session.next_sequence}.")
+    return resume_msg
 
 
 def handle_start_message(data: Dict, session: BCISession):
@@ -124,7 +539,11 @@ def handle_start_message(data: Dict, session: BCISession):
     This function:
     1. Parses the START message into a `StartMessage` object.
     2. Initializes the session with the received channel labels and sampling rate.
-    3. Creates an empty `RawAr,ray` to store the incoming EEG data.
+    3. Allocates the session's EEG ring buffer for the announced channels.
+    4. Starts counting frame sequence numbers, fitting the stream's clock and
+       measuring its latency from scratch.
+
+    Returns the parsed message, for the connection options it negotiates.
     """
     start_msg = StartMessage(**data)
     session.info = mne.create_info(
@@ -132,16 +551,144 @@ def handle_start_message(data: Dict, session: BCISession):
         sfreq=start_msg.sampling_rate,
         ch_types=["eeg"] * len(start_msg.channel_labels),
     )
+    session.frame_encoding = start_msg.encoding
+    session.last_sequence = None
+    session.clock = None
+    session.ingest.reset_clock()
+    if session.eeg_buffer is None or session.eeg_buffer.n_channels != len(start_msg.channel_labels):
+        session.allocate_buffers(len(start_msg.channel_labels))
     # session.raw = RawArray(
     #     np.zeros((len(session.channel_labels), 0)), info=session.info, verbose=False
     # )
 
     print(f"Session {session.session_id} started.")
+    return start_msg
+
+
+def handle_calibrate_message(data: Dict, session: BCISession):
+    """
+    Handles CALIBRATE messages received from the WebSocket.
+
+    The calibration needs the channels of a started stream and can only be run
+    once per session. Raises ValueError when it cannot be started.
+    """
+    calibrate_msg = CalibrateMessage(**data)
+    if session.info is None:
+        raise ValueError("Send START before CALIBRATE")
+    if session.state != SessionState.UNSTARTED:
+        raise ValueError(f"Cannot calibrate a session in state {session.state.value}")
+    if not session.init_calibration(calibrate_msg.protocol):
+        raise ValueError("Calibration could not be started")
+    print(f"Session {session.session_id} calibrating.")
+
+
+def record_ingest(session: BCISession, chunk, parse_seconds: float,
+                  received: Optional[QueuedMessage]):
+    """Account for an EEG frame accepted by the session in its ingest metrics."""
+    if received is None:
+        received = QueuedMessage(chunk, time.monotonic())
+    timestamps = chunk.timestamps
+    session.ingest.record_frame(
+        n_samples=len(timestamps),
+        nbytes=received.nbytes,
+        parse_seconds=received.parse_seconds + parse_seconds,
+        queue_wait_seconds=received.queue_wait_seconds,
+        last_timestamp=float(timestamps[-1]) if len(timestamps) else None,
+    )
 
 
-def handle_eeg_data(data: Dict, session: BCISession):
+def handle_eeg_data(data: Dict, session: BCISession,
+                    received: Optional[QueuedMessage] = None) -> Optional[int]:
+    """Hand an EEG_DATA message to the session, returns its sequence number if it has one."""
+    parse_start = time.perf_counter()
     eeg_data_msg = EEGChunk(**data)
-    session.add_eeg_data(eeg_data_msg)
+    parse_seconds = time.perf_counter() - parse_start
+    if session.add_eeg_data(eeg_data_msg):
+        record_ingest(session, eeg_data_msg, parse_seconds, received)
+    return eeg_data_msg.sequence
+
+
+def handle_binary_frame(payload: bytes, session: BCISession,
+                        received: Optional[QueuedMessage] = None) -> int:
+    """
+    Handles binary EEG frames received from the WebSocket.
+
+    The frame is decoded in place (see `decode_frame`) and checked against the
+    session before its samples are handed to the session. Returns the frame's
+    sequence number.
+    """
+    if session.frame_encoding != FrameEncoding.BINARY:
+        raise FrameError("Binary frames were not negotiated in the START message")
+    parse_start = time.perf_counter()
+    frame = decode_frame(payload)
+    parse_seconds = time.perf_counter() - parse_start
+    if frame.session_id != uuid.UUID(str(session.session_id)):
+        raise FrameError(f"Frame is for session {frame.session_id}")
+    if session.add_eeg_data(frame):
+        record_ingest(session, frame, parse_seconds, received)
+    return frame.sequence
+
+
+async def push_new_results(session: BCISession, websocket: WebSocket):
+    """
+    Classifies the epochs completed by the last chunk when anyone wants the results.
+
+    Classification runs off the event loop. Every result goes to the read-only
+    result subscribers of the session, and to this socket if it subscribed.
+    """
+    if not session.wants_results:
+        return
+    try:
+        results = await asyncio.to_thread(session.classify_new_epochs)
+    except ValueError as e:
+        await websocket.send_json({"error": str(e)})
+        return
+    if session.push_results:
+        for result in results:
+            await websocket.send_json(result_message(result))
+
+
+async def results_websocket(websocket: WebSocket, session_id: uuid.UUID):
+    """
+    Read-only WebSocket pushing the classification results of a session.
+
+    Lets the VR game receive the predictions of a session without owning its
+    EEG stream. Messages sent by the client are ignored, the socket is closed
+    when the session ends. Subscribing does not create the session, the socket
+    is closed with a policy violation if it does not exist.
+    """
+    await websocket.accept()
+    session = session_manager.get_session(session_id)
+    if session is None:
+        await websocket.send_json({"error": f"Session {session_id} not found"})
+        await websocket.close(code=1008)
+        return
+    queue = session.results.subscribe()
+    await asyncio.to_thread(session.start_classification)
+    receive_task = asyncio.ensure_future(websocket.receive())
+    try:
+        while True:
+            result_task = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait({receive_task, result_task},
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if result_task in done:
+                result = result_task.result()
+                if result is None:
+                    await websocket.send_json({"message": "Session ended"})
+                    await websocket.close()
+                    break
+                await websocket.send_json(result)
+            else:
+                result_task.cancel()
+            if receive_task in done:
+                if receive_task.result()["type"] == "websocket.disconnect":
+                    break
+                receive_task = asyncio.ensure_future(websocket.receive())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receive_task.cancel()
+        session.results.unsubscribe(queue)
 
 
 async def handle_end_message(data: Dict, session: BCISession, websocket: WebSocket):
@@ -5,7 +5,7 @@
 
 from .models import CalibrationAction, CalibrationSet, CalibrationProtocol
 from .models import CalibrationProtocol
-from mne import create_info, concatenate_raws, concatenate_epochs
+from mne import Annotations, create_info, concatenate_raws, concatenate_epochs
 from server.machine_learning.models import ClassEnum
 from server.bci.models import EEGData
 from typing import List
@@ -31,24 +31,40 @@ def calc_protocol_time(calibration_protocol: CalibrationProtocol):
     time = 0
     for event in calibration_protocol.prepare.actions:
         time_prep = 0
-        time_prep += event.baseline
+        time_prep += event.baseline or 0
         time_prep += event.time
-        time_prep += event.cooldown
+        time_prep += event.cooldown or 0
         time += time_prep * calibration_protocol.prepare.repeat
     for event in calibration_protocol.main_trial.actions:
         time_trial = 0
-        time_trial += event.baseline
+        time_trial += event.baseline or 0
         time_trial += event.time
-        time_trial += event.cooldown
+        time_trial += event.cooldown or 0
         time += time_trial * calibration_protocol.main_trial.repeat
     for event in calibration_protocol.end.actions:
         time_end = 0
-        time_end += event.baseline
+        time_end += event.baseline or 0
         time_end += event.time
-        time_end += event.cooldown
+        time_end += event.cooldown or 0
         time += time_end * calibration_protocol.end.repeat
     return time
 
+def protocol_annotations(calibration_protocol: CalibrationProtocol) -> Annotations:
+    '''Annotate every action of a calibration protocol with its label, in seconds
+    from the start of the calibration, in the order calc_protocol_time adds them up.'''
+    onsets, durations, descriptions = [], [], []
+    time = 0
+    for action_set in (calibration_protocol.prepare, calibration_protocol.main_trial,
+                       calibration_protocol.end):
+        for _ in range(action_set.repeat):
+            for event in action_set.actions:
+                time += event.baseline or 0
+                onsets.append(time)
+                durations.append(event.time)
+                descriptions.append(event.label or event.action)
+                time += event.time + (event.cooldown or 0)
+    return Annotations(onsets, durations, descriptions)
+
 def generate_mne_event_labels(protocol: CalibrationProtocol, start_epoch):
     '''Generate MNE event labels from a calibration protocol, 
     starting from a given epoch number. and return the event labels and event ids.'''
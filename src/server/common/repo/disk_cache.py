@@ -0,0 +1,262 @@
+'''
+Bounded on-disk cache shared by every process on the machine.
+
+Cached files live under `root` with the same relative path as their key. A
+sidecar JSON file per key, under `<root>.meta`, holds whatever the caller
+stores about the cached copy (ETag, size, ...) along with the access time
+and hit count the eviction policy uses. File times are left alone, so they
+can still tell when a copy was downloaded. Each process keeps an in-memory
+index of the entries and their total size, so writes only touch the disk
+for the entries they add or evict.
+'''
+
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+try:
+    import fcntl
+except ImportError:  # Windows, only threads of the same process are serialized
+    fcntl = None
+
+
+EVICTION_POLICIES = ("lru", "lfu")
+TEMP_SUFFIX = ".part"
+EVICT_LOCK = ".evict.lock"
+# Thread locks the key locks of a process are spread over
+LOCK_STRIPES = 64
+
+
+class DiskCache:
+    """
+    Cache of downloaded files bounded to `max_bytes` on disk.
+
+    Files are written to a temporary name and renamed into place, so readers,
+    in this process or another one, never see a partial file. `lock(key)`
+    serializes the workers fetching the same key and eviction runs under a
+    cache-wide lock, both through `fcntl` file locks. Within a process, the
+    keys share a fixed pool of `LOCK_STRIPES` thread locks, so two keys may
+    wait on each other but the locks do not grow with the number of keys.
+
+    Once a write takes the cache over its budget, entries are evicted by least
+    recent access ("lru") or fewest hits, oldest first on ties ("lfu"). The
+    file just written is never evicted to make room for itself. Evicting only
+    unlinks the file, a reader that already opened it keeps reading it.
+
+    The index is built by scanning the cache on first use and kept up to date
+    by this process' writes, hits and removals. Entries other processes add
+    or evict are picked up by a rescan every `rescan_seconds`, the budget may
+    be exceeded by their writes until then.
+    """
+
+    def __init__(self, root: Union[str, Path], max_bytes: int, policy: str = "lru",
+                 rescan_seconds: float = 300.0):
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(f"Unknown eviction policy: {policy}")
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.rescan_seconds = rescan_seconds
+        self._thread_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        # Eviction runs under the lock of the key just written, it needs a lock of its own
+        self._evict_thread_lock = threading.Lock()
+        # key -> (size, meta), with the running total of the sizes
+        self._index: Optional[Dict[str, Tuple[int, dict]]] = None
+        self._total = 0
+        self._scanned_at = 0.0
+        self._index_lock = threading.Lock()
+        self.root = Path(root)
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "bytes_served_local": 0,
+            "bytes_fetched": 0,
+            "bytes_evicted": 0,
+        }
+
+    @property
+    def root(self) -> Path:
+        return self._root
+
+    @root.setter
+    def root(self, path: Path):
+        self._root = Path(path)
+        with self._index_lock:
+            self._index = None
+
+    @property
+    def meta_dir(self) -> Path:
+        return self.root.with_name(self.root.name + ".meta")
+
+    def path(self, key: str) -> Path:
+        cached_path = self.root / key
+        cached_path.parent.mkdir(parents=True, exist_ok=True)
+        return cached_path
+
+    def _meta_path(self, key: str) -> Path:
+        return self.meta_dir / f"{key}.json"
+
+    def read_meta(self, key: str) -> Optional[dict]:
+        try:
+            return json.loads(self._meta_path(key).read_text())
+        except (OSError, ValueError):
+            return None
+
+    def write_meta(self, key: str, meta: dict):
+        meta_path = self._meta_path(key)
+        meta_path.parent.mkdir(parents=True, exist_ok=True)
+        self._replace(meta_path, [json.dumps(meta).encode()])
+
+    @staticmethod
+    def _replace(target: Path, chunks: Iterable[bytes]) -> int:
+        """Write chunks to a unique temporary file next to `target` and rename it over `target`."""
+        fd, temp_name = tempfile.mkstemp(
+            dir=target.parent, prefix=f".{target.name}.", suffix=TEMP_SUFFIX)
+        nbytes = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    nbytes += len(chunk)
+            os.replace(temp_name, target)
+        except BaseException:
+            Path(temp_name).unlink(missing_ok=True)
+            raise
+        return nbytes
+
+    @contextmanager
+    def _file_lock(self, name: str) -> Iterator[None]:
+        # flock only excludes other open files, threads need their own lock
+        if name == EVICT_LOCK:
+            thread_lock = self._evict_thread_lock
+        else:
+            thread_lock = self._thread_locks[hash(name) % LOCK_STRIPES]
+        with thread_lock:
+            lock_path = self.meta_dir / name
+            while True:
+                lock_path.parent.mkdir(parents=True, exist_ok=True)
+                with open(lock_path, "a") as lock_file:
+                    if fcntl is not None:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX)
+                        # Lock files are deleted with their entry, a lock taken on a
+                        # deleted file excludes nobody: lock the current file instead
+                        try:
+                            if os.stat(lock_path).st_ino != os.fstat(lock_file.fileno()).st_ino:
+                                continue
+                        except FileNotFoundError:
+                            continue
+                    yield
+                    return
+
+    def lock(self, key: str):
+        """Exclusive lock on one key, across threads and processes."""
+        return self._file_lock(f"{key}.lock")
+
+    def record_hit(self, key: str, meta: dict) -> Path:
+        """Count a hit on a cached file and save its meta, with the access recorded."""
+        cached_path = self.path(key)
+        meta["last_access"] = time.time()
+        meta["hits"] = meta.get("hits", 0) + 1
+        self.write_meta(key, meta)
+        self._index_put(key, meta.get("size", 0), meta)
+        self.stats["hits"] += 1
+        self.stats["bytes_served_local"] += meta.get("size", 0)
+        return cached_path
+
+    def write(self, key: str, chunks: Iterable[bytes], meta: Optional[dict] = None) -> Path:
+        """Store a fetched file atomically with its meta, then evict down to the budget."""
+        cached_path = self.path(key)
+        nbytes = self._replace(cached_path, chunks)
+        meta = {**(meta or {}), "size": nbytes, "last_access": time.time(), "hits": 0}
+        self.write_meta(key, meta)
+        self.stats["misses"] += 1
+        self.stats["bytes_fetched"] += nbytes
+        if self._index_put(key, nbytes, meta) > self.max_bytes:
+            self.evict(keep=key)
+        return cached_path
+
+    def remove(self, key: str):
+        """Delete a cached file with its meta and lock files."""
+        (self.root / key).unlink(missing_ok=True)
+        self._meta_path(key).unlink(missing_ok=True)
+        (self.meta_dir / f"{key}.lock").unlink(missing_ok=True)
+        with self._index_lock:
+            if self._index is not None and key in self._index:
+                self._total -= self._index.pop(key)[0]
+
+    def _load_index(self) -> Dict[str, Tuple[int, dict]]:
+        """The index, scanning the cache on first use and every `rescan_seconds`. Caller holds the index lock."""
+        if self._index is None or time.monotonic() - self._scanned_at >= self.rescan_seconds:
+            self._index = {key: (size, meta) for key, size, meta in self.entries()}
+            self._total = sum(size for size, _ in self._index.values())
+            self._scanned_at = time.monotonic()
+        return self._index
+
+    def _index_put(self, key: str, size: int, meta: dict) -> int:
+        """Add or update an entry of the index, returns the new total."""
+        with self._index_lock:
+            index = self._load_index()
+            previous = index.get(key)
+            index[key] = (size, {"last_access": meta.get("last_access", 0), "hits": meta.get("hits", 0)})
+            self._total += size - (previous[0] if previous is not None else 0)
+            return self._total
+
+    def entries(self) -> List[Tuple[str, int, dict]]:
+        """(key, size, meta) of every cached file read from disk, meta is empty for files without one."""
+        entries = []
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                if name.endswith(TEMP_SUFFIX):
+                    continue
+                path = Path(directory) / name
+                try:
+                    size = path.stat().st_size
+                except FileNotFoundError:  # evicted by another process meanwhile
+                    continue
+                key = path.relative_to(self.root).as_posix()
+                entries.append((key, size, self.read_meta(key) or {}))
+        return entries
+
+    def usage(self) -> int:
+        with self._index_lock:
+            self._load_index()
+            return self._total
+
+    def _eviction_order(self, entry: Tuple[str, Tuple[int, dict]]):
+        _, (_, meta) = entry
+        if self.policy == "lfu":
+            return (meta.get("hits", 0), meta.get("last_access", 0))
+        return meta.get("last_access", 0)
+
+    def evict(self, keep: Optional[str] = None) -> int:
+        """Remove entries until the cache fits `max_bytes`. Returns the number of files removed."""
+        with self._file_lock(EVICT_LOCK):
+            with self._index_lock:
+                entries = sorted(self._load_index().items(), key=self._eviction_order)
+            evicted = 0
+            for key, (size, _) in entries:
+                if self.usage() <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                self.remove(key)
+                evicted += 1
+                self.stats["evictions"] += 1
+                self.stats["bytes_evicted"] += size
+        return evicted
+
+    def get_stats(self) -> dict:
+        """Counters of this process, and the size of the cache shared by all of them."""
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_ratio": self.stats["hits"] / lookups if lookups else 0.0,
+            "bytes": self.usage(),
+            "max_bytes": self.max_bytes,
+            "policy": self.policy,
+        }
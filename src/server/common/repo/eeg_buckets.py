@@ -0,0 +1,344 @@
+'''
+Bucketed storage of streamed EEG in MongoDB.
+
+Instead of one document per sample, the samples of a session are grouped
+into buckets of `bucket_seconds` of stream time. Each bucket is one
+document holding the bucket's timestamps and each channel's samples as
+packed little-endian arrays:
+
+    {
+        "session_id": "...",
+        "bucket_start": 1712.0,   # stream time, a multiple of bucket_seconds
+        "min_ts": 1712.002, "max_ts": 1721.998,
+        "n_samples": 2500,
+        "channels": ["C3", "C4", ...],
+        "timestamps": Binary(float64 * n_samples),
+        "data": {"C3": Binary(float32 * n_samples), ...},
+        "summary": {...},
+    }
+
+The optional summary is the min/max/mean envelope of the bucket over bins
+of `summary.bin_seconds`, so plots of long sessions can be built from a few
+summary points per bucket instead of every sample:
+
+    "summary": {
+        "bin_seconds": 0.1,
+        "timestamps": Binary(float64 * n_bins),   # start of each non-empty bin
+        "count": Binary(uint32 * n_bins),
+        "min": {"C3": Binary(float32 * n_bins), ...},
+        "max": {...},
+        "mean": {...},
+    }
+
+A bucket may be split over several documents when a session pauses longer
+than a bucket, readers merge them by timestamp.
+'''
+
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from bson.binary import Binary
+from pymongo import ASCENDING, InsertOne
+from pymongo.errors import BulkWriteError
+
+BUCKET_COLLECTION = "eeg_data_buckets"
+SAMPLE_DTYPE = np.dtype("<f4")
+TIMESTAMP_DTYPE = np.dtype("<f8")
+COUNT_DTYPE = np.dtype("<u4")
+
+# (bin timestamps or indices, mins, maxs, sums, counts), channel-major
+BinStats = Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+
+def reduce_bins(bins: np.ndarray, mins: np.ndarray, maxs: np.ndarray, sums: np.ndarray,
+                counts: np.ndarray) -> BinStats:
+    '''
+    Combine the stats of samples, or of finer bins, falling in the same bin.
+
+    Returns the distinct bins in increasing order with their min, max, sum
+    and count. Raw samples are passed as their own min, max and sum with a
+    count of one. NaN values (missing channels) are ignored by min and max.
+    '''
+    if not len(bins):
+        return bins, mins, maxs, sums, counts
+    if len(bins) > 1 and (np.diff(bins) < 0).any():
+        order = np.argsort(bins, kind="stable")
+        bins, mins, maxs, sums, counts = (
+            bins[order], mins[:, order], maxs[:, order], sums[:, order], counts[order])
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(bins)) + 1))
+    return (bins[starts],
+            np.fmin.reduceat(mins, starts, axis=1),
+            np.fmax.reduceat(maxs, starts, axis=1),
+            np.add.reduceat(sums, starts, axis=1, dtype=np.float64),
+            np.add.reduceat(counts, starts))
+
+
+def summarize(samples: np.ndarray, timestamps: np.ndarray, origin: float,
+              bin_seconds: float) -> BinStats:
+    '''Min/max/sum/count of channel-major samples over bins of `bin_seconds` from `origin`.'''
+    bins = np.floor((timestamps - origin) / bin_seconds).astype(np.int64)
+    bins, mins, maxs, sums, counts = reduce_bins(
+        bins, samples, samples, samples, np.ones(len(timestamps), dtype=np.int64))
+    return origin + bins * bin_seconds, mins, maxs, sums, counts
+
+
+def pack_bucket(session_id: str, bucket_start: float, ch_names: Sequence[str],
+                samples: np.ndarray, timestamps: np.ndarray,
+                summary_seconds: Optional[float] = None) -> dict:
+    '''Build the document of a bucket from channel-major (n_channels, n_samples) samples.'''
+    samples = np.asarray(samples, dtype=SAMPLE_DTYPE)
+    timestamps = np.asarray(timestamps, dtype=TIMESTAMP_DTYPE)
+    doc = {
+        "session_id": session_id,
+        "bucket_start": float(bucket_start),
+        "min_ts": float(timestamps.min()),
+        "max_ts": float(timestamps.max()),
+        "n_samples": int(len(timestamps)),
+        "channels": list(ch_names),
+        "timestamps": Binary(timestamps.tobytes()),
+        "data": {name: Binary(np.ascontiguousarray(samples[i]).tobytes())
+                 for i, name in enumerate(ch_names)},
+    }
+    if summary_seconds:
+        bin_times, mins, maxs, sums, counts = summarize(
+            samples, timestamps, bucket_start, summary_seconds)
+        means = sums / counts
+
+        def pack(values):
+            return {name: Binary(values[i].astype(SAMPLE_DTYPE).tobytes())
+                    for i, name in enumerate(ch_names)}
+        doc["summary"] = {
+            "bin_seconds": float(summary_seconds),
+            "timestamps": Binary(bin_times.astype(TIMESTAMP_DTYPE).tobytes()),
+            "count": Binary(counts.astype(COUNT_DTYPE).tobytes()),
+            "min": pack(mins),
+            "max": pack(maxs),
+            "mean": pack(means),
+        }
+    return doc
+
+
+def unpack_bucket(doc: dict, picks: Optional[Sequence[str]] = None) -> Tuple[np.ndarray, np.ndarray]:
+    '''Return the (n_channels, n_samples) samples of the picked channels and the timestamps of a bucket.'''
+    names = doc["channels"] if picks is None else picks
+    timestamps = np.frombuffer(doc["timestamps"], dtype=TIMESTAMP_DTYPE)
+    if not names:
+        return np.empty((0, len(timestamps)), dtype=SAMPLE_DTYPE), timestamps
+    samples = np.stack([np.frombuffer(doc["data"][name], dtype=SAMPLE_DTYPE) for name in names])
+    return samples, timestamps
+
+
+def unpack_summary(doc: dict, picks: Optional[Sequence[str]] = None) -> BinStats:
+    '''Return the bin timestamps, mins, maxs, sums and counts of a bucket's summary.'''
+    summary = doc["summary"]
+    names = doc["channels"] if picks is None else picks
+    timestamps = np.frombuffer(summary["timestamps"], dtype=TIMESTAMP_DTYPE)
+    counts = np.frombuffer(summary["count"], dtype=COUNT_DTYPE).astype(np.int64)
+
+    def unpack(stat):
+        if not names:
+            return np.empty((0, len(timestamps)), dtype=SAMPLE_DTYPE)
+        return np.stack([np.frombuffer(summary[stat][name], dtype=SAMPLE_DTYPE)
+                         for name in names])
+    return timestamps, unpack("min"), unpack("max"), unpack("mean") * counts, counts
+
+
+@dataclass
+class _OpenBucket:
+    session_id: str
+    bucket_start: float
+    ch_names: Tuple[str, ...]
+    samples: List[np.ndarray] = field(default_factory=list)
+    timestamps: List[np.ndarray] = field(default_factory=list)
+    n_samples: int = 0
+    updated_at: float = field(default_factory=time.monotonic)
+
+    def to_document(self, summary_seconds: Optional[float] = None) -> dict:
+        return pack_bucket(self.session_id, self.bucket_start, self.ch_names,
+                           np.concatenate(self.samples, axis=1), np.concatenate(self.timestamps),
+                           summary_seconds)
+
+
+class EEGBucketWriter:
+    """
+    Groups streamed samples into bucket documents and writes them from a
+    background thread.
+
+    `enqueue` only copies the samples into the session's open bucket, it never
+    touches MongoDB, so it is cheap enough for the WebSocket path. A bucket is
+    sealed when a sample of the next bucket arrives, when its session has not
+    sent anything for `bucket_seconds`, or on `close_session`/`flush`. Sealed
+    buckets are packed, with a summary over bins of `summary_seconds` when
+    set, and inserted by the writer thread every `flush_interval` seconds with
+    unordered bulk writes of up to `batch_size` documents. At most
+    `max_pending` sealed buckets wait for MongoDB, the oldest ones are dropped beyond that rather than growing without bound.
+    """
+
+    def __init__(self, get_collection: Callable[[], object], bucket_seconds: float = 10.0,
+                 flush_interval: float = 1.0, max_pending: int = 1024, batch_size: int = 256,
+                 summary_seconds: Optional[float] = None):
+        self.get_collection = get_collection
+        self.bucket_seconds = bucket_seconds
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.summary_seconds = summary_seconds
+        self._collection = None
+        self._open: Dict[str, _OpenBucket] = {}
+        self._sealed: Deque[_OpenBucket] = deque()
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self.stats = {
+            "enqueued_samples": 0,
+            "buckets_sealed": 0,
+            "buckets_written": 0,
+            "bulk_writes": 0,
+            "write_errors": 0,
+            "dropped_buckets": 0,
+        }
+
+    @property
+    def pending(self) -> int:
+        return len(self._sealed)
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            self._collection = self.get_collection()
+            self._collection.create_index(
+                [("session_id", ASCENDING), ("min_ts", ASCENDING)])
+        return self._collection
+
+    def enqueue(self, session_id: str, samples: np.ndarray, timestamps: np.ndarray,
+                ch_names: Sequence[str]):
+        """Add channel-major (n_channels, n_samples) samples of a session to its buckets."""
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        if not len(timestamps):
+            return
+        ch_names = tuple(ch_names)
+        bucket_ids = np.floor(timestamps / self.bucket_seconds)
+        # Most chunks fall in a single bucket, split the others at bucket boundaries
+        bounds = [0, *(np.flatnonzero(np.diff(bucket_ids)) + 1), len(timestamps)]
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("EEG bucket writer is shut down")
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="eeg-bucket-writer", daemon=True)
+                self._thread.start()
+            for start, stop in zip(bounds[:-1], bounds[1:]):
+                bucket_start = float(bucket_ids[start] * self.bucket_seconds)
+                bucket = self._open.get(session_id)
+                if bucket is not None and (bucket.bucket_start != bucket_start
+                                           or bucket.ch_names != ch_names):
+                    self._seal(session_id)
+                    bucket = None
+                if bucket is None:
+                    bucket = self._open[session_id] = _OpenBucket(
+                        session_id=session_id, bucket_start=bucket_start, ch_names=ch_names)
+                bucket.samples.append(np.array(samples[:, start:stop], dtype=SAMPLE_DTYPE))
+                bucket.timestamps.append(np.array(timestamps[start:stop]))
+                bucket.n_samples += stop - start
+                bucket.updated_at = time.monotonic()
+            self.stats["enqueued_samples"] += len(timestamps)
+
+    def _seal(self, session_id: str):
+        bucket = self._open.pop(session_id, None)
+        if bucket is None:
+            return
+        self._sealed.append(bucket)
+        self.stats["buckets_sealed"] += 1
+        while len(self._sealed) > self.max_pending:
+            self._sealed.popleft()
+            self.stats["dropped_buckets"] += 1
+        if len(self._sealed) >= self.batch_size:
+            self._cond.notify()
+
+    def close_session(self, session_id: str):
+        """Seal the open bucket of a session, it is written on the next flush."""
+        with self._cond:
+            self._seal(session_id)
+            self._cond.notify()
+
+    def _seal_idle(self):
+        now = time.monotonic()
+        for session_id, bucket in list(self._open.items()):
+            if now - bucket.updated_at >= self.bucket_seconds:
+                self._seal(session_id)
+
+    def flush(self):
+        """Seal every open bucket and write all of them, blocking until done."""
+        with self._cond:
+            for session_id in list(self._open):
+                self._seal(session_id)
+        self._write_sealed()
+
+    def _write_sealed(self):
+        # One writer at a time, so a flush() waits for a write in progress
+        with self._write_lock:
+            while True:
+                with self._cond:
+                    batch = [self._sealed.popleft()
+                             for _ in range(min(self.batch_size, len(self._sealed)))]
+                if not batch:
+                    return
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    print(f"Error writing EEG buckets: {e}")
+                    self.stats["write_errors"] += 1
+                    with self._cond:
+                        # Retried on the next flush, pending buckets stay bounded
+                        self._sealed.extendleft(reversed(batch))
+                        while len(self._sealed) > self.max_pending:
+                            self._sealed.popleft()
+                            self.stats["dropped_buckets"] += 1
+                    return
+
+    def _write(self, batch: List[_OpenBucket]):
+        requests = [InsertOne(bucket.to_document(self.summary_seconds)) for bucket in batch]
+        try:
+            result = self.collection.bulk_write(requests, ordered=False)
+            written = result.inserted_count
+        except BulkWriteError as e:
+            # Unordered, the other documents of the batch were still inserted
+            print(f"Error writing EEG buckets: {e.details['writeErrors'][:1]}")
+            self.stats["write_errors"] += 1
+            written = e.details["nInserted"]
+        self.stats["bulk_writes"] += 1
+        self.stats["buckets_written"] += written
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed:
+                    self._cond.wait(self.flush_interval)
+                closed = self._closed
+                self._seal_idle()
+            self._write_sealed()
+            if closed:
+                return
+
+    def shutdown(self):
+        """Write everything still buffered, then stop the writer thread."""
+        with self._cond:
+            self._closed = True
+            for session_id in list(self._open):
+                self._seal(session_id)
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        else:
+            self._write_sealed()
+
+    def get_stats(self) -> dict:
+        with self._cond:
+            return {**self.stats, "open_buckets": len(self._open),
+                    "pending_buckets": len(self._sealed)}
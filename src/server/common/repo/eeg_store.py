@@ -0,0 +1,314 @@
+'''
+Chunked, columnar on-disk container for EEG recordings.
+
+A container holds one recording as NumPy blocks followed by a JSON header:
+
+    offset  size  field
+    0       4     magic, always b"EEGC"
+    4       1     format version (CONTAINER_VERSION)
+    5       3     reserved, zero
+    8       ...   data blocks, each a channel-major (n_channels, n_block_samples)
+                  array, raw or zlib compressed
+    ...     ...   JSON header: channel names and types, sampling rate, dtype,
+                  codec, annotations, measurement metadata (see write_raw)
+                  and the offset, size and sample range of every block
+    -12     8     JSON header length (uint64, little-endian)
+    -4      4     magic, always b"EEGC"
+
+The header sits at the end so a recording can be written block by block
+without knowing its length in advance. Reads decode only the blocks that
+overlap the requested time range. Uncompressed containers are written as a
+single block, which is memory-mapped instead of read.
+'''
+
+import io
+import json
+import os
+import struct
+import zlib
+from datetime import datetime
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Sequence, Union
+
+import numpy as np
+import mne
+from mne.io import BaseRaw, RawArray
+
+
+CONTAINER_MAGIC = b"EEGC"
+CONTAINER_VERSION = 1
+PREAMBLE = struct.Struct("<4sB3x")
+TRAILER = struct.Struct("<Q4s")
+
+CODEC_NONE = "none"
+CODEC_ZLIB = "zlib"
+
+
+class ContainerError(ValueError):
+    """Raised when a file is not a valid EEG container."""
+
+
+def is_eeg_container(source: Union[str, Path, bytes, BinaryIO]) -> bool:
+    '''Check the magic bytes of a path, a byte string or a seekable file object.'''
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source[:4]) == CONTAINER_MAGIC
+    if isinstance(source, (str, Path)):
+        with open(source, "rb") as f:
+            return f.read(4) == CONTAINER_MAGIC
+    position = source.tell()
+    magic = source.read(4)
+    source.seek(position)
+    return magic == CONTAINER_MAGIC
+
+
+def write_eeg(target: Union[str, Path, BinaryIO], data: np.ndarray, sfreq: float,
+              ch_names: Sequence[str], ch_types: Optional[Sequence[str]] = None,
+              annotations: Optional[List[Dict]] = None, codec: str = CODEC_ZLIB,
+              block_seconds: float = 10.0, compression_level: int = 1,
+              metadata: Optional[Dict] = None):
+    '''
+    Write a channel-major (n_channels, n_times) recording as a container.
+
+    `annotations` is a list of {"onset", "duration", "description"} dicts, in
+    seconds from the start of the recording. `metadata` holds JSON-serializable
+    header fields describing the measurement, see `write_raw`.
+    '''
+    data = np.asarray(data)
+    if data.ndim != 2 or data.shape[0] != len(ch_names):
+        raise ContainerError(
+            f"Expected data of shape ({len(ch_names)}, n_times), got {data.shape}")
+    if codec not in (CODEC_NONE, CODEC_ZLIB):
+        raise ContainerError(f"Unknown codec: {codec}")
+    n_channels, n_times = data.shape
+    dtype = data.dtype.newbyteorder("<")
+    if codec == CODEC_NONE:
+        # A single block can be memory-mapped as one (n_channels, n_times) array
+        block_samples = max(n_times, 1)
+    else:
+        block_samples = max(int(block_seconds * sfreq), 1)
+
+    if isinstance(target, (str, Path)):
+        with open(target, "wb") as f:
+            return write_eeg(f, data, sfreq, ch_names, ch_types, annotations, codec,
+                             block_seconds, compression_level, metadata)
+
+    base = target.tell()
+    target.write(PREAMBLE.pack(CONTAINER_MAGIC, CONTAINER_VERSION))
+    blocks = []
+    for start in range(0, n_times, block_samples):
+        stop = min(start + block_samples, n_times)
+        payload = np.ascontiguousarray(data[:, start:stop], dtype=dtype).tobytes()
+        if codec == CODEC_ZLIB:
+            payload = zlib.compress(payload, compression_level)
+        blocks.append({"offset": target.tell() - base, "nbytes": len(payload),
+                       "start": start, "stop": stop})
+        target.write(payload)
+
+    header = json.dumps({
+        "version": CONTAINER_VERSION,
+        "sfreq": float(sfreq),
+        "ch_names": list(ch_names),
+        "ch_types": list(ch_types) if ch_types is not None else ["eeg"] * n_channels,
+        "n_times": n_times,
+        "dtype": dtype.str,
+        "codec": codec,
+        "annotations": annotations or [],
+        **(metadata or {}),
+        "blocks": blocks,
+    }).encode()
+    target.write(header)
+    target.write(TRAILER.pack(len(header), CONTAINER_MAGIC))
+
+
+def _montage_to_json(raw: BaseRaw) -> Optional[Dict]:
+    montage = raw.get_montage()
+    if montage is None:
+        return None
+    positions = montage.get_positions()
+    return {key: (value.tolist() if isinstance(value, np.ndarray)
+                  else {name: pos.tolist() for name, pos in value.items()} if key == "ch_pos"
+                  else value)
+            for key, value in positions.items()}
+
+
+def write_raw(target: Union[str, Path, BinaryIO], raw: BaseRaw, dtype=None, **kwargs):
+    '''
+    Write an MNE raw object as a container, with its annotations.
+
+    The header also keeps the measurement date, bad channels, first sample and
+    montage (channel positions and fiducials), restored by `EEGContainer.to_raw`.
+    Other `info` fields, e.g. filter settings or projectors, are not stored.
+    '''
+    data = raw.get_data()
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+    annotations = [
+        {"onset": float(onset - raw.first_time), "duration": float(duration),
+         "description": str(description)}
+        for onset, duration, description in zip(
+            raw.annotations.onset, raw.annotations.duration, raw.annotations.description)
+    ]
+    meas_date = raw.info["meas_date"]
+    metadata = {
+        "meas_date": meas_date.isoformat() if meas_date is not None else None,
+        "bads": list(raw.info["bads"]),
+        "first_samp": int(raw.first_samp),
+        "montage": _montage_to_json(raw),
+    }
+    write_eeg(target, data, raw.info["sfreq"], raw.ch_names,
+              ch_types=raw.get_channel_types(), annotations=annotations,
+              metadata=metadata, **kwargs)
+
+
+def raw_to_bytes(raw: BaseRaw, **kwargs) -> bytes:
+    buffer = io.BytesIO()
+    write_raw(buffer, raw, **kwargs)
+    return buffer.getvalue()
+
+
+class EEGContainer:
+    """
+    Reader for an EEG container file.
+
+    Only the header is read when opening, samples are read on demand for the
+    requested channels and time range. Subclasses reading from elsewhere than
+    a local file set `path` to None and override `_read_at`.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._load_header(os.path.getsize(self.path))
+
+    def _read_at(self, offset: int, size: int) -> bytes:
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def _load_header(self, size: int):
+        magic, version = PREAMBLE.unpack(self._read_at(0, PREAMBLE.size))
+        if magic != CONTAINER_MAGIC:
+            raise ContainerError(f"{self} is not an EEG container")
+        if version != CONTAINER_VERSION:
+            raise ContainerError(f"Unsupported container version: {version}")
+        header_size, magic = TRAILER.unpack(self._read_at(size - TRAILER.size, TRAILER.size))
+        if magic != CONTAINER_MAGIC:
+            raise ContainerError(f"{self} is truncated")
+        self.header = json.loads(self._read_at(size - TRAILER.size - header_size, header_size))
+        self.sfreq: float = self.header["sfreq"]
+        self.ch_names: List[str] = self.header["ch_names"]
+        self.ch_types: List[str] = self.header["ch_types"]
+        self.n_times: int = self.header["n_times"]
+        self.dtype = np.dtype(self.header["dtype"])
+        self.codec: str = self.header["codec"]
+        self.annotations: List[Dict] = self.header["annotations"]
+        self.blocks: List[Dict] = self.header["blocks"]
+        # Written by write_raw only
+        self.meas_date: Optional[str] = self.header.get("meas_date")
+        self.bads: List[str] = self.header.get("bads", [])
+        self.first_samp: int = self.header.get("first_samp", 0)
+        self.montage: Optional[Dict] = self.header.get("montage")
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} {self.path}>"
+
+    @property
+    def n_channels(self) -> int:
+        return len(self.ch_names)
+
+    @property
+    def duration(self) -> float:
+        return self.n_times / self.sfreq
+
+    def _picks(self, picks) -> Union[slice, np.ndarray]:
+        if picks is None:
+            return slice(None)
+        return np.array([self.ch_names.index(pick) if isinstance(pick, str) else int(pick)
+                         for pick in picks], dtype=int)
+
+    def memmap(self) -> np.memmap:
+        '''Map the samples of an uncompressed container as a read-only (n_channels, n_times) array.'''
+        if self.codec != CODEC_NONE:
+            raise ContainerError("Only uncompressed containers can be memory-mapped")
+        if self.path is None:
+            raise ContainerError("Only local containers can be memory-mapped")
+        offset = self.blocks[0]["offset"] if self.blocks else PREAMBLE.size
+        return np.memmap(self.path, dtype=self.dtype, mode="r", offset=offset,
+                         shape=(self.n_channels, self.n_times))
+
+    def _read_rows(self, start: int, stop: int, rows) -> np.ndarray:
+        """Read a time range of an uncompressed container one channel row at a time."""
+        indices = np.arange(self.n_channels)[rows]
+        offset = self.blocks[0]["offset"]
+        itemsize = self.dtype.itemsize
+        out = np.empty((len(indices), stop - start), dtype=self.dtype)
+        for i, row in enumerate(indices):
+            out[i] = np.frombuffer(self._read_at(
+                offset + (row * self.n_times + start) * itemsize, (stop - start) * itemsize),
+                dtype=self.dtype)
+        return out
+
+    def read_samples(self, start: int = 0, stop: Optional[int] = None, picks=None) -> np.ndarray:
+        '''Return samples [start, stop) of the picked channels, by index or name.'''
+        stop = self.n_times if stop is None else min(stop, self.n_times)
+        start = max(start, 0)
+        rows = self._picks(picks)
+        if stop <= start:
+            return np.empty((self.n_channels, 0), dtype=self.dtype)[rows]
+        if self.codec == CODEC_NONE:
+            if self.path is None:
+                return self._read_rows(start, stop, rows)
+            return self.memmap()[rows, start:stop]
+
+        needed = [block for block in self.blocks
+                  if block["start"] < stop and block["stop"] > start]
+        # Blocks are stored back to back, fetch the span covering them at once
+        span_start = needed[0]["offset"]
+        span = self._read_at(span_start, needed[-1]["offset"] + needed[-1]["nbytes"] - span_start)
+        parts = []
+        for block in needed:
+            begin = block["offset"] - span_start
+            values = np.frombuffer(zlib.decompress(span[begin:begin + block["nbytes"]]),
+                                   dtype=self.dtype).reshape(
+                self.n_channels, block["stop"] - block["start"])
+            parts.append(values[rows, max(start - block["start"], 0):
+                                min(stop, block["stop"]) - block["start"]])
+        return parts[0] if len(parts) == 1 else np.concatenate(parts, axis=1)
+
+    def read(self, tmin: float = 0.0, tmax: Optional[float] = None, picks=None) -> np.ndarray:
+        '''Return the samples between tmin and tmax seconds of the picked channels.'''
+        start = int(round(tmin * self.sfreq))
+        stop = None if tmax is None else int(round(tmax * self.sfreq))
+        return self.read_samples(start, stop, picks)
+
+    def to_raw(self, tmin: float = 0.0, tmax: Optional[float] = None, picks=None) -> RawArray:
+        '''
+        Build an MNE RawArray of a time and channel range, with the annotations it
+        contains and the stored measurement date, bad channels and montage.
+
+        The first sample of the range keeps its index in the original recording.
+        '''
+        # Always copied, the raw object must not hold on to a read-only map of the file
+        data = np.array(self.read(tmin, tmax, picks), dtype=np.float64)
+        rows = self._picks(picks)
+        ch_names = list(np.array(self.ch_names)[rows])
+        ch_types = list(np.array(self.ch_types)[rows])
+        info = mne.create_info(ch_names=ch_names, sfreq=self.sfreq, ch_types=ch_types)
+        info["bads"] = [name for name in self.bads if name in ch_names]
+        if self.montage is not None:
+            montage = mne.channels.make_dig_montage(**{
+                key: ({name: np.array(pos) for name, pos in value.items()} if key == "ch_pos"
+                      else np.array(value) if isinstance(value, list) else value)
+                for key, value in self.montage.items()})
+            info.set_montage(montage, on_missing="ignore", verbose=False)
+        if self.meas_date is not None:
+            info.set_meas_date(datetime.fromisoformat(self.meas_date))
+        first_samp = self.first_samp + max(int(round(tmin * self.sfreq)), 0)
+        raw = RawArray(data, info, first_samp=first_samp, verbose=False)
+        end = tmin + data.shape[1] / self.sfreq
+        kept = [a for a in self.annotations if tmin <= a["onset"] < end]
+        if kept:
+            raw.set_annotations(mne.Annotations(
+                onset=[a["onset"] - tmin for a in kept],
+                duration=[a["duration"] for a in kept],
+                description=[a["description"] for a in kept]))
+        return raw
@@ -6,25 +6,54 @@ from functools import lru_cache
 from typing import Any
 import pickle
 
+from mne.io import BaseRaw
+
 from fastapi import HTTPException
 # Configuration
 
 from server.config import CONFIG
-from server.common.repo.s3 import S3Repo
+from server.common.repo.s3 import S3Repo, get_s3_repo
+from server.common.repo.eeg_store import (
+    CODEC_NONE, CODEC_ZLIB, EEGContainer, is_eeg_container, write_raw)
 # File Storage Interface (Optional, but good for abstraction)
 
 
 class FileStorage:
+    """
+    Object storage keyed by path.
+
+    MNE raw objects are stored in the columnar EEG container format (see
+    eeg_store.py) instead of being pickled, `load` tells them apart by their
+    magic bytes and returns a RawArray again.
+    """
+    eeg_codec: str = CODEC_ZLIB
+
     def save(self, data: Any, path: str) -> None:
         raise NotImplementedError()
 
     def load(self, path: str) -> Any:
         raise NotImplementedError()
 
+    def _dump(self, data: Any, file) -> None:
+        if isinstance(data, BaseRaw):
+            write_raw(file, data, codec=self.eeg_codec)
+        else:
+            pickle.dump(data, file)
+
+    @staticmethod
+    def _load_file(full_path) -> Any:
+        if is_eeg_container(full_path):
+            return EEGContainer(full_path).to_raw()
+        with open(full_path, "rb") as file:
+            return pickle.load(file)
+
 # Local Pickle Storage
 
 
 class LocalPickleStorage(FileStorage):
+    # Uncompressed EEG containers are memory-mapped when opened
+    eeg_codec = CODEC_NONE
+
     def __init__(self):
         self.cache_dir = Path(__file__).parent.parent.parent / "temp"
         self.cache_dir.mkdir(exist_ok=True)
@@ -33,28 +62,52 @@ class LocalPickleStorage(FileStorage):
         full_path = self.cache_dir / path
         full_path.parent.mkdir(parents=True, exist_ok=True)
         with open(full_path, "wb") as file:
-            pickle.dump(data, file)
+            self._dump(data, file)
 
     def load(self, path: str) -> Any:
-        full_path = self.cache_dir / path
-        with open(full_path, "rb") as file:
-            return pickle.load(file)
+        return self._load_file(self.cache_dir / path)
+
+    def open_eeg(self, path: str) -> EEGContainer:
+        """Open a stored EEG recording for partial or memory-mapped reads."""
+        return EEGContainer(self.cache_dir / path)
+
+class S3EEGContainer(EEGContainer):
+    """EEG container read straight from S3, fetching only the header and the needed byte ranges."""
+
+    def __init__(self, s3_repo: S3Repo, key: str):
+        self.s3_repo = s3_repo
+        self.key = key
+        self.path = None
+        self._load_header(s3_repo.get_size(key))
+
+    def _read_at(self, offset: int, size: int) -> bytes:
+        return self.s3_repo.get_range(self.key, offset, offset + size - 1)
+
+    def __repr__(self) -> str:
+        return f"<S3EEGContainer {self.key}>"
+
 
 # S3 Pickle Storage with Caching (Uses S3Repo)
 class S3PickleStorage(FileStorage):
     def __init__(self, config=CONFIG):
-        self.s3_repo = S3Repo(config)
+        # Storages of the default configuration share one client, thread pool and cache
+        self.s3_repo = get_s3_repo() if config is CONFIG else S3Repo(config)
 
     def save(self, data: Any, path: str) -> None:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pkl") as temp_file:
-            pickle.dump(data, temp_file)
-        self.s3_repo.upload_file(temp_file.name, path)
-        os.remove(temp_file.name)  # Cleanup
+        # Serialized straight into a multipart upload, without a temp file
+        with self.s3_repo.open_writer(path) as writer:
+            self._dump(data, writer)
 
     def load(self, path: str) -> Any:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pkl") as temp_file:
-            self.s3_repo.download_file(path, temp_file.name)
-            with open(temp_file.name, "rb") as f:
-                data = pickle.load(f)
-        os.remove(temp_file.name)
-        return data
+        # Deserialized from the cached download in place
+        return self._load_file(self.s3_repo.open_cached(path))
+
+    def open_eeg(self, path: str) -> EEGContainer:
+        """Open a stored EEG recording, partial reads only download the blocks they need."""
+        return S3EEGContainer(self.s3_repo, path)
+
+    async def save_async(self, data: Any, path: str) -> None:
+        await self.s3_repo.run_async(self.save, data, path)
+
+    async def load_async(self, path: str) -> Any:
+        return await self.s3_repo.run_async(self.load, path)
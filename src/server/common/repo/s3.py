@@ -1,31 +1,214 @@
-import os
+import asyncio
+import io
+import threading
+import time
 import tempfile
 import shutil  # Import shutil for cross-platform file operations
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import Callable, Dict, Iterable, List, Optional, Union
 import boto3
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ClientError
 from pathlib import Path
-from functools import lru_cache
 from fastapi import HTTPException
-import hashlib
 from server.config import CONFIG
+from server.common.repo.disk_cache import DiskCache
+
+
+# S3 parts must be at least 5 MiB, except the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+
+class MultipartUploadWriter(io.RawIOBase):
+    """
+    Writable file object that uploads to S3 in parts as data is written to it.
+
+    At most one part is buffered in memory. Objects smaller than a part are
+    sent with a single put_object when the writer is closed. Leaving the
+    `with` block on an exception aborts the upload, nothing is stored.
+    `on_complete` is called once the object is stored.
+
+    Only an explicit `close()` (or leaving the `with` block normally) stores
+    the object. A writer garbage-collected while still open, e.g. dropped after
+    a failed write, aborts the upload instead of storing a truncated object.
+    """
+
+    def __init__(self, s3, bucket: str, key: str, part_size: int = DEFAULT_PART_SIZE,
+                 on_complete: Optional[Callable[[], None]] = None):
+        super().__init__()
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.on_complete = on_complete
+        self._buffer = bytearray()
+        self._parts = []
+        self._upload_id: Optional[str] = None
+        self._position = 0
+        self.finalized = False
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def write(self, data) -> int:
+        data = memoryview(data).cast("B")
+        self._buffer += data
+        self._position += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(self.part_size)
+        return len(data)
+
+    def _upload_part(self, size: int):
+        if self._upload_id is None:
+            self._upload_id = self.s3.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key)["UploadId"]
+        part_number = len(self._parts) + 1
+        response = self.s3.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+            PartNumber=part_number, Body=bytes(self._buffer[:size]))
+        del self._buffer[:size]
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._upload_id is None:
+                self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer))
+            else:
+                if self._buffer:
+                    self._upload_part(len(self._buffer))
+                self.s3.complete_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                    MultipartUpload={"Parts": self._parts})
+            self.finalized = True
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._buffer = bytearray()
+            super().close()
+        if self.on_complete is not None:
+            self.on_complete()
+
+    def abort(self):
+        """Drop the upload and the parts sent so far."""
+        if self._upload_id is not None:
+            self.s3.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+            self._upload_id = None
+        self._buffer = bytearray()
+        super().close()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def __del__(self):
+        # IOBase.__del__ would close(), i.e. complete whatever was written so far
+        if not self.closed:
+            try:
+                self.abort()
+            except Exception as e:
+                print(f"Could not abort the upload of {self.key}: {e}")
+
+
+@lru_cache(maxsize=None)
+def _create_client(endpoint_url: Optional[str], access_key: str, secret_key: str,
+                   max_pool_connections: int):
+    return boto3.client(
+        service_name="s3",
+        endpoint_url=endpoint_url,
+        aws_access_key_id=access_key,
+        aws_secret_access_key=secret_key,
+        config=BotoConfig(max_pool_connections=max_pool_connections,
+                          retries={"mode": "standard"}, tcp_keepalive=True),
+    )
+
+
+def get_client(config=CONFIG):
+    """
+    The process-wide boto3 client for a set of credentials.
+
+    boto3 clients are thread-safe, sharing one keeps a single pool of
+    keep-alive connections instead of a pool per repository.
+    """
+    return _create_client(config.AWS_S3_ENDPOINT, config.AWS_S3_ACCESS_KEY,
+                          config.AWS_S3_SECRET_KEY, config.S3_MAX_POOL_CONNECTIONS)
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_executor(config=CONFIG) -> ThreadPoolExecutor:
+    """The bounded thread pool running the blocking S3 calls of the async methods."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=config.S3_MAX_CONCURRENCY,
+                                           thread_name_prefix="s3")
+        return _executor
+
+
+def shutdown_executor():
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+@lru_cache(maxsize=None)
+def get_s3_repo() -> "S3Repo":
+    """The S3Repo of the default configuration, shared by every storage of the process."""
+    return S3Repo(CONFIG)
+
+
+def reset_clients():
+    """Forget the shared clients and repository, e.g. after changing credentials or in tests."""
+    _create_client.cache_clear()
+    get_s3_repo.cache_clear()
 
 
 class S3Repo:
+    """
+    Objects of one bucket, with a local disk cache of the downloaded ones.
+
+    The blocking methods are meant for worker threads. Async code uses the
+    `*_async` methods and `get_many`/`put_many`, which run the same calls on
+    the shared S3 thread pool so the event loop never waits on the network.
+    """
+
     def __init__(self, config=CONFIG):
         self.config = config
-        self.s3 = boto3.client(
-            service_name="s3",
-            endpoint_url=config.AWS_S3_ENDPOINT,
-            aws_access_key_id=config.AWS_S3_ACCESS_KEY,
-            aws_secret_access_key=config.AWS_S3_SECRET_KEY,
-        )
-        self.cache_dir = Path(tempfile.gettempdir()) / "s3_cache"
+        self.s3 = get_client(config)
+        self.cache = DiskCache(Path(tempfile.gettempdir()) / "s3_cache",
+                               config.S3_CACHE_MAX_BYTES, config.S3_CACHE_EVICTION_POLICY)
         self.cache_dir.mkdir(exist_ok=True)
 
-    @lru_cache(maxsize=128)
+    @property
+    def cache_dir(self) -> Path:
+        return self.cache.root
+
+    @cache_dir.setter
+    def cache_dir(self, path: Path):
+        self.cache.root = Path(path)
+
     def get_cached_path(self, key):
-        cached_path = self.cache_dir / key
-        cached_path.parent.mkdir(parents=True, exist_ok=True)
-        return cached_path
+        return self.cache.path(key)
+
+    def _drop_cached(self, key: str):
+        """Forget the cached copy of an object that was just overwritten."""
+        with self.cache.lock(key):
+            self.cache.remove(key)
 
     def upload_file(self, file_path: str, key: str):
         try:
@@ -33,45 +216,167 @@ class S3Repo:
         except boto3.exceptions.S3UploadFailedError as e:
             raise HTTPException(
                 status_code=500, detail=f"R2 upload failed: {e}")
+        self._drop_cached(key)
 
-    def download_file(self, key: str, file_path: str):
-        cached_path = self.get_cached_path(key)
-        if cached_path.exists():
-            # Check ETag in R2 to see if the file has changed
-            try:
-                r2_etag = self.s3.head_object(
-                    Bucket=self.config.AWS_S3_BUCKET, Key=key
-                )["ETag"][1:-1]
-            except boto3.exceptions.ClientError as e:
-                raise HTTPException(
-                    status_code=404, detail=f"File not found in R2: {e}")
-
-            hash_md5 = hashlib.md5()
-            with open(cached_path, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    hash_md5.update(chunk)
-            local_etag = hash_md5.hexdigest()
-
-            if r2_etag == local_etag:
-                shutil.copy2(cached_path, file_path)  # Copy with metadata
-                return
-
-        # If not cached or ETags don't match, download from R2
+    def open_writer(self, key: str, part_size: int = DEFAULT_PART_SIZE) -> MultipartUploadWriter:
+        """Open a file object streaming whatever is written to it into `key`.
+
+        The cached copy of `key`, if any, is dropped once the upload completes.
+        """
+        return MultipartUploadWriter(self.s3, self.config.AWS_S3_BUCKET, key, part_size,
+                                     on_complete=partial(self._drop_cached, key))
+
+    def upload_stream(self, chunks: Iterable[Union[bytes, bytearray, memoryview]], key: str,
+                      part_size: int = DEFAULT_PART_SIZE):
+        """Upload the chunks yielded by a generator, or any iterable of buffers, as one object."""
         try:
-            self.s3.download_file(
-                self.config.AWS_S3_BUCKET, key, str(cached_path)
-            )
-            shutil.copy2(cached_path, file_path)  # Copy with metadata
-        except Exception as e:
+            with self.open_writer(key, part_size) as writer:
+                for chunk in chunks:
+                    writer.write(chunk)
+        except ClientError as e:
+            raise HTTPException(
+                status_code=500, detail=f"R2 upload failed: {e}")
+
+    def upload_bytes(self, data: Union[bytes, bytearray, memoryview], key: str):
+        self.upload_stream([data], key)
+
+    def get_size(self, key: str) -> int:
+        try:
+            return self.s3.head_object(
+                Bucket=self.config.AWS_S3_BUCKET, Key=key)["ContentLength"]
+        except ClientError as e:
+            raise HTTPException(
+                status_code=404, detail=f"File not found in R2: {e}")
+
+    def get_fingerprint(self, key: str) -> dict:
+        """ETag and size of an object, they change whenever it is overwritten."""
+        try:
+            head = self.s3.head_object(Bucket=self.config.AWS_S3_BUCKET, Key=key)
+        except ClientError as e:
+            raise HTTPException(
+                status_code=404, detail=f"File not found in R2: {e}")
+        return {"etag": head["ETag"], "size": head["ContentLength"]}
+
+    def get_bytes(self, key: str) -> bytes:
+        """Read a whole object into memory, bypassing the disk cache."""
+        try:
+            response = self.s3.get_object(
+                Bucket=self.config.AWS_S3_BUCKET, Key=key)
+            return response["Body"].read()
+        except ClientError as e:
+            raise HTTPException(
+                status_code=404, detail=f"File not found in R2: {e}")
+
+    def get_range(self, key: str, start: int, end: int) -> bytes:
+        """Fetch bytes [start, end] (inclusive, as in HTTP ranges) of an object."""
+        try:
+            response = self.s3.get_object(
+                Bucket=self.config.AWS_S3_BUCKET, Key=key, Range=f"bytes={start}-{end}")
+            return response["Body"].read()
+        except ClientError as e:
+            raise HTTPException(
+                status_code=404, detail=f"File not found in R2: {e}")
+
+    @property
+    def meta_dir(self) -> Path:
+        """Sidecar index of the cache, one JSON file per cached key."""
+        return self.cache.meta_dir
+
+    def _read_meta(self, key: str) -> Optional[dict]:
+        return self.cache.read_meta(key)
+
+    def _is_fresh(self, key: str, meta: dict) -> bool:
+        """Whether the cached copy can be used without asking R2."""
+        if any(key.startswith(prefix) for prefix in self.config.S3_CACHE_IMMUTABLE_PREFIXES):
+            return True
+        return time.time() - meta["validated_at"] < self.config.S3_CACHE_FRESHNESS_SECONDS
+
+    def open_cached(self, key: str) -> Path:
+        """Make sure `key` is in the local cache and up to date, and return the cached file.
+
+        The ETag, size and last-modified time of each download are kept in a
+        sidecar index, so validating a cached copy is one head_object call and a
+        metadata comparison (or nothing within the freshness window). Workers
+        asking for the same key wait for a single download. Callers read the
+        cached file in place, it must not be modified; it may be evicted once
+        newer downloads need the space, so open it right away.
+        """
+        with self.cache.lock(key):
+            cached_path = self.get_cached_path(key)
+            meta = self._read_meta(key) if cached_path.exists() else None
+            if meta is not None and meta["size"] == cached_path.stat().st_size:
+                if self._is_fresh(key, meta):
+                    return self.cache.record_hit(key, meta)
+                # Check ETag in R2 to see if the file has changed
+                try:
+                    head = self.s3.head_object(
+                        Bucket=self.config.AWS_S3_BUCKET, Key=key)
+                except ClientError as e:
+                    raise HTTPException(
+                        status_code=404, detail=f"File not found in R2: {e}")
+                if head["ETag"] == meta["etag"] and head["ContentLength"] == meta["size"]:
+                    meta["validated_at"] = time.time()
+                    return self.cache.record_hit(key, meta)
+
+            # If not cached or changed, download from R2
+            return self._fetch(key)
+
+    def _fetch(self, key: str) -> Path:
+        try:
+            response = self.s3.get_object(
+                Bucket=self.config.AWS_S3_BUCKET, Key=key)
+            return self.cache.write(key, response["Body"].iter_chunks(1024 * 1024), {
+                "etag": response["ETag"],
+                "last_modified": response["LastModified"].isoformat(),
+                "validated_at": time.time(),
+            })
+        except ClientError as e:
             raise HTTPException(
                 status_code=404, detail=f"File not found in R2: {e}")
 
+    def get_cache_stats(self) -> dict:
+        return self.cache.get_stats()
+
+    def download_file(self, key: str, file_path: str):
+        cached_path = self.open_cached(key)
+        shutil.copy2(cached_path, file_path)  # Copy with metadata
+
     def delete_file(self, key: str):
         try:
             self.s3.delete_object(Bucket=self.config.AWS_S3_BUCKET, Key=key)
-            cached_path = self.get_cached_path(key)
-            if cached_path.exists():
-                os.remove(cached_path)
+            with self.cache.lock(key):
+                self.cache.remove(key)
         except boto3.exceptions.S3DeleteFailedError as e:
             raise HTTPException(
                 status_code=500, detail=f"R2 delete failed: {e}")
+
+    async def run_async(self, fn, *args, **kwargs):
+        """Await a blocking call, run on the shared S3 thread pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(self.config), partial(fn, *args, **kwargs))
+
+    async def get_bytes_async(self, key: str) -> bytes:
+        return await self.run_async(self.get_bytes, key)
+
+    async def upload_bytes_async(self, data: Union[bytes, bytearray, memoryview], key: str):
+        await self.run_async(self.upload_bytes, data, key)
+
+    async def get_range_async(self, key: str, start: int, end: int) -> bytes:
+        return await self.run_async(self.get_range, key, start, end)
+
+    async def open_cached_async(self, key: str) -> Path:
+        return await self.run_async(self.open_cached, key)
+
+    async def delete_file_async(self, key: str):
+        await self.run_async(self.delete_file, key)
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, bytes]:
+        """Fetch many objects concurrently, as many at once as the thread pool allows."""
+        keys = list(keys)
+        values = await asyncio.gather(*(self.get_bytes_async(key) for key in keys))
+        return dict(zip(keys, values))
+
+    async def put_many(self, items: Dict[str, Union[bytes, bytearray, memoryview]]) -> List[str]:
+        """Upload many objects concurrently. Returns the keys written."""
+        await asyncio.gather(*(self.upload_bytes_async(data, key) for key, data in items.items()))
+        return list(items)
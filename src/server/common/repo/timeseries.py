@@ -1,8 +1,13 @@
 from fastapi import APIRouter, Depends, HTTPException
-from pymongo import MongoClient, ASCENDING
+from pymongo import MongoClient, ASCENDING, DESCENDING
 from pymongo.database import Database
 from server.config import CONFIG
+from server.common.repo.eeg_buckets import (
+    BUCKET_COLLECTION, BinStats, EEGBucketWriter, unpack_bucket, unpack_summary)
 from enum import Enum
+from typing import Iterator, List, Optional, Sequence, Tuple
+import threading
+import numpy as np
 import pickle
 
 router = APIRouter()
@@ -17,6 +22,34 @@ def get_mongo_db():
     client = MongoClient(CONFIG.MONGO_URI)
     return client[CONFIG.MONGO_DB]
 
+
+_eeg_writer: Optional[EEGBucketWriter] = None
+_eeg_writer_lock = threading.Lock()
+
+
+def get_eeg_writer() -> EEGBucketWriter:
+    '''The process-wide writer of EEG bucket documents, connecting to MongoDB on its first write.'''
+    global _eeg_writer
+    with _eeg_writer_lock:
+        if _eeg_writer is None:
+            settings = CONFIG.BCI_CONFIG
+            _eeg_writer = EEGBucketWriter(
+                lambda: get_mongo_db()[BUCKET_COLLECTION],
+                bucket_seconds=settings.EEG_BUCKET_SECONDS,
+                flush_interval=settings.EEG_FLUSH_INTERVAL_SECONDS,
+                max_pending=settings.EEG_MAX_PENDING_BUCKETS,
+                summary_seconds=settings.EEG_SUMMARY_SECONDS,
+            )
+        return _eeg_writer
+
+
+def shutdown_eeg_writer():
+    global _eeg_writer
+    with _eeg_writer_lock:
+        writer, _eeg_writer = _eeg_writer, None
+    if writer is not None:
+        writer.shutdown()
+
 # Create or get the time series collection
 
 
@@ -31,6 +64,183 @@ async def startup_event(db: Database = Depends(get_mongo_db)):
 # Endpoint for appending EEG data points
 
 
+# (channel names, channel-major samples, timestamps) of a stretch of EEG
+EEGChunkArrays = Tuple[List[str], np.ndarray, np.ndarray]
+
+
+def points_to_arrays(points: List[dict]) -> EEGChunkArrays:
+    '''Convert {"epoch_timestamp", "magnitude"} points, one magnitude or one per channel, to arrays.'''
+    timestamps = np.array([point["epoch_timestamp"] for point in points], dtype=np.float64)
+    samples = np.array([point["magnitude"] for point in points], dtype=np.float32)
+    samples = samples.reshape(len(points), -1).T
+    ch_names = ["magnitude"] if samples.shape[0] == 1 else [
+        f"ch{i}" for i in range(samples.shape[0])]
+    return ch_names, samples, timestamps
+
+
+def select_range(chunk: EEGChunkArrays, start_time: Optional[float] = None,
+                 end_time: Optional[float] = None,
+                 channels: Optional[Sequence[str]] = None) -> EEGChunkArrays:
+    '''Keep the samples within [start_time, end_time] of the picked channels, NaN for missing ones.'''
+    ch_names, samples, timestamps = chunk
+    if start_time is not None or end_time is not None:
+        keep = np.ones(len(timestamps), dtype=bool)
+        if start_time is not None:
+            keep &= timestamps >= start_time
+        if end_time is not None:
+            keep &= timestamps <= end_time
+        if not keep.all():
+            samples, timestamps = samples[:, keep], timestamps[keep]
+    if channels is not None:
+        rows = {name: i for i, name in enumerate(ch_names)}
+        picked = np.full((len(channels), len(timestamps)), np.nan, dtype=samples.dtype)
+        for i, name in enumerate(channels):
+            if name in rows:
+                picked[i] = samples[rows[name]]
+        ch_names, samples = list(channels), picked
+    return ch_names, samples, timestamps
+
+
+def bucket_query(session_id: str, start_time: Optional[float] = None,
+                 end_time: Optional[float] = None, bucket_seconds: Optional[float] = None) -> dict:
+    '''
+    Filter of the buckets overlapping [start_time, end_time], either bound optional.
+
+    A bucket never spans more than `bucket_seconds`, so both bounds apply to
+    `min_ts` and the (session_id, min_ts) index scans only the matching range.
+    '''
+    if bucket_seconds is None:
+        bucket_seconds = CONFIG.BCI_CONFIG.EEG_BUCKET_SECONDS
+    query = {"session_id": session_id}
+    min_ts = {}
+    if start_time is not None:
+        min_ts["$gte"] = start_time - bucket_seconds
+        query["max_ts"] = {"$gte": start_time}
+    if end_time is not None:
+        min_ts["$lte"] = end_time
+    if min_ts:
+        query["min_ts"] = min_ts
+    return query
+
+
+def iter_bucket_chunks(collection, session_id: str, start_time: Optional[float] = None,
+                       end_time: Optional[float] = None,
+                       channels: Optional[Sequence[str]] = None) -> Iterator[EEGChunkArrays]:
+    '''Yield the EEG of a session bucket by bucket, in time order, reading only the picked channels.'''
+    projection = {"_id": 0, "channels": 1, "timestamps": 1}
+    if channels is None:
+        projection["data"] = 1
+    else:
+        projection.update({f"data.{name}": 1 for name in channels})
+    cursor = collection.find(bucket_query(session_id, start_time, end_time),
+                             projection).sort("min_ts", ASCENDING)
+    for doc in cursor:
+        names = [name for name in doc["channels"] if name in doc["data"]]
+        samples, timestamps = unpack_bucket(doc, picks=names)
+        chunk = select_range((names, samples, timestamps), start_time, end_time, channels)
+        if len(chunk[2]):
+            yield chunk
+
+
+def session_extent(collection, session_id: str) -> Optional[Tuple[float, float]]:
+    '''First and last stored timestamps of a session, from the first and last bucket only.'''
+    first = collection.find_one({"session_id": session_id}, {"min_ts": 1},
+                                sort=[("min_ts", ASCENDING)])
+    if first is None:
+        return None
+    # Buckets of a session never overlap, the last one to start holds the last sample
+    last = collection.find_one({"session_id": session_id}, {"max_ts": 1},
+                               sort=[("min_ts", DESCENDING)])
+    return first["min_ts"], last["max_ts"]
+
+
+def raw_bin_stats(chunk: EEGChunkArrays) -> Tuple[List[str], BinStats]:
+    '''Samples as bin stats of their own, each its own min, max and sum with a count of one.'''
+    ch_names, samples, timestamps = chunk
+    return ch_names, (timestamps, samples, samples, samples,
+                      np.ones(len(timestamps), dtype=np.int64))
+
+
+def iter_bucket_summaries(collection, session_id: str, start_time: Optional[float] = None,
+                          end_time: Optional[float] = None,
+                          channels: Optional[Sequence[str]] = None,
+                          bin_seconds: float = 0.0) -> Iterator[Tuple[List[str], BinStats]]:
+    '''
+    Yield (channel names, bin stats) of a session's buckets, for envelopes of bins of `bin_seconds`.
+
+    When the bins are at least as long as the stored summaries, only the
+    summaries are read, otherwise or for buckets without a summary the raw
+    samples are. Summary bins are kept when they start within the range.
+    '''
+    summary_seconds = CONFIG.BCI_CONFIG.EEG_SUMMARY_SECONDS
+    if not summary_seconds or bin_seconds < summary_seconds:
+        for chunk in iter_bucket_chunks(collection, session_id, start_time, end_time, channels):
+            yield raw_bin_stats(chunk)
+        return
+
+    projection = {"channels": 1, "summary.timestamps": 1, "summary.count": 1}
+    for stat in ("min", "max", "mean"):
+        if channels is None:
+            projection[f"summary.{stat}"] = 1
+        else:
+            projection.update({f"summary.{stat}.{name}": 1 for name in channels})
+    cursor = collection.find(bucket_query(session_id, start_time, end_time),
+                             projection).sort("min_ts", ASCENDING)
+    for doc in cursor:
+        if "summary" not in doc:
+            raw = collection.find_one({"_id": doc["_id"]})
+            names = list(raw["channels"])
+            samples, timestamps = unpack_bucket(raw, picks=names)
+            chunk = select_range((names, samples, timestamps), start_time, end_time, channels)
+            if len(chunk[2]):
+                yield raw_bin_stats(chunk)
+            continue
+        present = [name for name in doc["channels"] if name in doc["summary"]["min"]]
+        timestamps, mins, maxs, sums, counts = unpack_summary(doc, picks=present)
+        keep = np.ones(len(timestamps), dtype=bool)
+        if start_time is not None:
+            keep &= timestamps >= start_time
+        if end_time is not None:
+            keep &= timestamps <= end_time
+        if keep.any():
+            yield present, (timestamps[keep], mins[:, keep], maxs[:, keep],
+                            sums[:, keep], counts[keep])
+
+
+def local_extent(filename: str) -> Optional[Tuple[float, float]]:
+    '''First and last timestamps of the EEG appended to a local file.'''
+    extent = None
+    for _, _, timestamps in iter_local_chunks(filename):
+        low, high = float(timestamps.min()), float(timestamps.max())
+        extent = (low, high) if extent is None else (min(extent[0], low), max(extent[1], high))
+    return extent
+
+
+def iter_local_chunks(filename: str, start_time: Optional[float] = None,
+                      end_time: Optional[float] = None,
+                      channels: Optional[Sequence[str]] = None) -> Iterator[EEGChunkArrays]:
+    '''
+    Yield the EEG appended to a local file, one appended batch at a time.
+
+    Batches are appended in stream order, reading stops at the first batch
+    starting after `end_time`.
+    '''
+    with open(filename, "rb") as f:
+        while True:
+            try:
+                points = pickle.load(f)
+            except EOFError:
+                return
+            if not points:
+                continue
+            chunk = points_to_arrays(points)
+            if end_time is not None and chunk[2][0] > end_time:
+                return
+            chunk = select_range(chunk, start_time, end_time, channels)
+            if len(chunk[2]):
+                yield chunk
+
+
 @router.post("/eeg_data/")
 async def append_eeg_data(
     eeg_data: list[dict],
@@ -44,14 +254,13 @@ async def append_eeg_data(
                 status_code=400, detail="Session ID is required for MongoDB storage")
 
         try:
-            for data_point in eeg_data:
-                data_point["metadata"] = {"session_id": session_id}
-            collection = db["eeg_data_time_series"]
-            result = collection.insert_many(eeg_data)
-            return {"inserted_ids": [str(id) for id in result.inserted_ids]}
-        except Exception as e:
+            ch_names, samples, timestamps = points_to_arrays(eeg_data)
+            # Written in the background by the bucket writer
+            get_eeg_writer().enqueue(session_id, samples, timestamps, ch_names)
+            return {"enqueued": len(eeg_data)}
+        except (KeyError, ValueError) as e:
             raise HTTPException(
-                status_code=500, detail=f"Error inserting data: {e}")
+                status_code=400, detail=f"Invalid EEG data points: {e}")
 
     elif storage_type == StorageType.LOCAL_FILE:
         try:
@@ -1,5 +1,6 @@
 from server.machine_learning.config import MLConfig
-from typing import Optional
+from server.bci.config import BCIConfig
+from typing import List, Literal, Optional
 from pydantic import Field, SecretStr
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from dotenv import dotenv_values
@@ -97,6 +98,36 @@ class Settings(BaseSettings):
         title="AWS S3 Secret Key",
         description="AWS S3 Secret Key",
     )
+    S3_MAX_POOL_CONNECTIONS: int = Field(
+        default=32,
+        title="S3 Connection Pool Size",
+        description="Keep-alive connections of the process-wide S3 client",
+    )
+    S3_MAX_CONCURRENCY: int = Field(
+        default=16,
+        title="S3 Concurrency",
+        description="Threads running S3 calls for async handlers and batched gets and puts",
+    )
+    S3_CACHE_MAX_BYTES: int = Field(
+        default=2 * 1024 ** 3,
+        title="S3 Cache Size",
+        description="Bytes of S3 objects kept in the local disk cache before the least used ones are evicted",
+    )
+    S3_CACHE_EVICTION_POLICY: Literal["lru", "lfu"] = Field(
+        default="lru",
+        title="S3 Cache Eviction Policy",
+        description="Evict the least recently used (lru) or least frequently used (lfu) cached objects first",
+    )
+    S3_CACHE_FRESHNESS_SECONDS: float = Field(
+        default=0.0,
+        title="S3 Cache Freshness Window",
+        description="Seconds a cached S3 object is trusted without checking its ETag again",
+    )
+    S3_CACHE_IMMUTABLE_PREFIXES: List[str] = Field(
+        default=[],
+        title="Immutable S3 Key Prefixes",
+        description="Keys under these prefixes never change once written, their cached copies are never revalidated",
+    )
 
     POSTMARK_API_KEY: str = Field(
         title="Postmark API Key",
@@ -114,6 +145,12 @@ class Settings(BaseSettings):
         description="ML Configurations",
     )
 
+    BCI_CONFIG: BCIConfig = Field(
+        default=BCIConfig(),
+        title="BCI Config",
+        description="BCI Session Configurations",
+    )
+
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
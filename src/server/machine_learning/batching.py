@@ -0,0 +1,157 @@
+'''
+Micro-batching of real-time classification requests.
+'''
+
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+
+@dataclass
+class InferenceRequest:
+    session_id: str
+    model: object
+    epochs: np.ndarray  # (n_epochs, n_channels, n_times)
+    future: Future = field(default_factory=Future)
+    submitted_at: float = field(default_factory=time.monotonic)
+
+
+class InferenceBatcher:
+    """
+    Collects classification requests for up to `max_delay` seconds and
+    classifies them in one `predict_epochs` call per model.
+
+    A batch is closed when its oldest request has waited `max_delay` or when
+    it holds `max_batch_size` epochs, whichever comes first. Requests are
+    grouped by the model object `resolve_model` returns for their session, and
+    each request's future gets back the predictions for its own epochs. Every
+    session trains its own model, so a predict call combines the requests of
+    one session (e.g. the push loop and a polling client), sessions only share
+    one when they resolve to the same model object.
+
+    Models are resolved in `submit`, on the caller's thread, so loading a cold
+    model from storage does not hold up the batches of other sessions. Batches
+    run on a single background thread.
+    """
+
+    def __init__(self, resolve_model: Callable[[str], Optional[object]],
+                 max_batch_size: int = 64, max_delay: float = 0.005):
+        self.resolve_model = resolve_model
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self._pending: List[InferenceRequest] = []
+        self._pending_epochs = 0
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self.stats = {
+            "requests": 0,
+            "epochs": 0,
+            "batches": 0,
+            "predict_calls": 0,
+            "largest_batch": 0,
+        }
+
+    def submit(self, session_id: str, epochs: np.ndarray) -> Future:
+        """Queue epochs for classification, the future resolves to one prediction per epoch.
+
+        The epochs are not copied, views must not be written to until the future is done.
+        """
+        model = self.resolve_model(session_id)
+        if model is None:
+            future = Future()
+            future.set_exception(ValueError(
+                f"Model not loaded or training not completed for session {session_id}"))
+            return future
+        request = InferenceRequest(session_id=session_id, model=model, epochs=epochs)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Inference batcher is shut down")
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="inference-batcher", daemon=True)
+                self._thread.start()
+            self._pending.append(request)
+            self._pending_epochs += len(epochs)
+            self.stats["requests"] += 1
+            self._cond.notify()
+        return request.future
+
+    def predict(self, session_id: str, epochs: np.ndarray) -> list:
+        """Classify epochs through the batcher, blocking until the batch has run."""
+        return self.submit(session_id, epochs).result()
+
+    def _next_batch(self) -> Optional[List[InferenceRequest]]:
+        with self._cond:
+            while not self._pending and not self._closed:
+                self._cond.wait()
+            if not self._pending:
+                return None
+            deadline = self._pending[0].submitted_at + self.max_delay
+            while self._pending_epochs < self.max_batch_size and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch, n_epochs = [], 0
+            while self._pending:
+                size = len(self._pending[0].epochs)
+                if batch and n_epochs + size > self.max_batch_size:
+                    break
+                batch.append(self._pending.pop(0))
+                n_epochs += size
+            self._pending_epochs -= n_epochs
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                self._run_batch(batch)
+            except Exception as e:
+                print(f"Error running inference batch: {e}")
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+
+    def _run_batch(self, batch: List[InferenceRequest]):
+        groups: Dict[int, tuple] = {}
+        for request in batch:
+            groups.setdefault(id(request.model), (request.model, []))[1].append(request)
+
+        n_epochs = sum(len(request.epochs) for request in batch)
+        self.stats["batches"] += 1
+        self.stats["epochs"] += n_epochs
+        self.stats["largest_batch"] = max(self.stats["largest_batch"], n_epochs)
+
+        for model, requests in groups.values():
+            try:
+                data = np.concatenate([request.epochs for request in requests])
+                # Preprocessed as the calibration data was, see SessionModel
+                predictions = np.asarray(model.predict_epochs(data))
+                self.stats["predict_calls"] += 1
+            except Exception as e:
+                for request in requests:
+                    request.future.set_exception(e)
+                continue
+            offset = 0
+            for request in requests:
+                count = len(request.epochs)
+                request.future.set_result(predictions[offset:offset + count].tolist())
+                offset += count
+
+    def shutdown(self):
+        """Run the queued requests, then stop the batching thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
@@ -0,0 +1,168 @@
+'''
+In-memory cache of trained models, bounded by their estimated size.
+'''
+
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+
+class _ByteCounter:
+    """Write-only file object that only counts the bytes written to it."""
+
+    def __init__(self):
+        self.nbytes = 0
+
+    def write(self, data) -> int:
+        n = memoryview(data).nbytes
+        self.nbytes += n
+        return n
+
+
+def estimate_nbytes(model: object) -> int:
+    '''Estimate the memory held by a model as the size of its pickle, without materializing it.'''
+    counter = _ByteCounter()
+    pickle.dump(model, counter, protocol=pickle.HIGHEST_PROTOCOL)
+    return counter.nbytes
+
+
+class ModelCache:
+    """
+    LRU cache of trained models, keyed by (session ID, model version).
+
+    The cache evicts the least recently used models once the estimated bytes
+    of all entries exceed `max_bytes`. Loading is single-flight: concurrent
+    `get_or_load` calls for the same missing key wait for one loader call
+    instead of each fetching the model from storage.
+
+    `invalidate` also abandons the loads in flight for the session: a load
+    started before it does not populate the cache with the model it read, and
+    later callers start a new load. Keys the loader found no model for are
+    remembered for `miss_ttl` seconds, so polling a session whose model is not
+    trained yet does not hit storage every time.
+    """
+
+    def __init__(self, max_bytes: int, sizeof: Callable[[object], int] = estimate_nbytes,
+                 miss_ttl: float = 0.0):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.miss_ttl = miss_ttl
+        self.nbytes = 0
+        self._entries: "OrderedDict[Hashable, Tuple[object, int]]" = OrderedDict()
+        self._loading: Dict[Hashable, Future] = {}
+        # Expiry time of the keys the loader returned None for
+        self._missing: Dict[Hashable, float] = {}
+        self._lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "negative_hits": 0,
+            "stale_loads": 0,
+            "evictions": 0,
+            "loads": 0,
+            "load_failures": 0,
+        }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    def get(self, key) -> Optional[object]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[0]
+
+    def put(self, key, model: object, nbytes: Optional[int] = None):
+        """Add or replace a model, evicting the least recently used ones to fit the budget."""
+        nbytes = self.sizeof(model) if nbytes is None else nbytes
+        with self._lock:
+            self._put(key, model, nbytes)
+
+    def _put(self, key, model: object, nbytes: int):
+        self._remove(key)
+        self._missing.pop(key, None)
+        if nbytes > self.max_bytes:
+            print(f"Model {key} ({nbytes} bytes) is larger than the model cache, not caching it")
+            return
+        self._entries[key] = (model, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            evicted_key, _ = next(iter(self._entries.items()))
+            self._remove(evicted_key)
+            self.stats["evictions"] += 1
+
+    def get_or_load(self, key, loader: Callable[[], object]) -> object:
+        """Return the cached model, or load it once with `loader` however many callers ask for it."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[0]
+            if self._missing.get(key, 0.0) > time.monotonic():
+                self.stats["negative_hits"] += 1
+                return None
+            self.stats["misses"] += 1
+            future = self._loading.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._loading[key] = future
+        if not leader:
+            return future.result()
+
+        try:
+            model = loader()
+            nbytes = self.sizeof(model) if model is not None else 0
+        except BaseException as e:
+            with self._lock:
+                if self._loading.get(key) is future:
+                    del self._loading[key]
+                self.stats["load_failures"] += 1
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self.stats["loads"] += 1
+            # The load is no longer registered if the session was invalidated meanwhile
+            if self._loading.get(key) is not future:
+                self.stats["stale_loads"] += 1
+            else:
+                del self._loading[key]
+                if model is not None:
+                    self._put(key, model, nbytes)
+                elif self.miss_ttl > 0:
+                    now = time.monotonic()
+                    self._missing = {k: expiry for k, expiry in self._missing.items() if expiry > now}
+                    self._missing[key] = now + self.miss_ttl
+        future.set_result(model)
+        return model
+
+    def invalidate(self, session_id: str):
+        """Drop every cached version of a session's model and abandon the loads in flight."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == session_id]:
+                self._remove(key)
+            for key in [key for key in self._loading if key[0] == session_id]:
+                del self._loading[key]
+            for key in [key for key in self._missing if key[0] == session_id]:
+                del self._missing[key]
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {**self.stats, "entries": len(self._entries), "bytes": self.nbytes,
+                    "max_bytes": self.max_bytes}
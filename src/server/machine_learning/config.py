@@ -1,4 +1,5 @@
 
+from typing import Optional
 from pydantic_settings import BaseSettings
 from pydantic import Field
 from .models import StorageType
@@ -47,6 +48,47 @@ class MLConfig(BaseSettings):
         title="Models Directory",
         description="Models Directory",
     )
+    SOURCE_DATA_FILE: str = Field(
+        "source_np.pkl",
+        title="Source Dataset File",
+        description="Pickled source-domain dataset used to train the LATSS models",
+    )
+    SOURCE_CACHE_DIR: Optional[str] = Field(
+        None,
+        title="Source Dataset Cache Directory",
+        description="Local directory holding the source dataset as memory-mappable .npy files, "
+                    "defaults to a directory in the system temp folder",
+    )
+    MODEL_CACHE_MAX_BYTES: int = Field(
+        256 * 1024 * 1024,
+        title="Model Cache Size",
+        description="Estimated bytes of trained models kept in memory, least recently used ones are evicted",
+    )
+    MODEL_CACHE_MISS_TTL_SECONDS: float = Field(
+        2.0,
+        title="Model Cache Miss TTL",
+        description="Seconds a session without a stored model is not looked up in storage again",
+    )
+    INFERENCE_MAX_BATCH_SIZE: int = Field(
+        64,
+        title="Inference Batch Size",
+        description="Maximum number of epochs classified in one batched predict call",
+    )
+    INFERENCE_MAX_DELAY_MS: float = Field(
+        5.0,
+        title="Inference Batch Window",
+        description="Milliseconds a classification request may wait for others to batch with",
+    )
+    TRAINING_WORKERS: int = Field(
+        1,
+        title="Training Workers",
+        description="Number of worker processes training models concurrently",
+    )
+    TRAINING_QUEUE_SIZE: int = Field(
+        8,
+        title="Training Queue Size",
+        description="Training jobs allowed to wait for a worker before new ones are rejected",
+    )
 
     class Config:
         env_file = ".env"
@@ -1,6 +1,10 @@
 # These models are to be recieved already serialized and everything,
 # also note that the source domain dataset is too large to be retrieved multiple times so im thinking to save it somehow in the filesystem??...
+import copy
+
+import mne
 import mne.io
+import numpy as np
 from typing import Dict, Optional
 from pydantic import BaseModel, Field
 from server.machine_learning.models import ClassEnum
@@ -26,3 +30,161 @@ class ModelCalibrator:
         # Perform calibration using the provided data
         calibrated_model = {}
         return calibrated_model
+
+
+class SessionModel:
+    """
+    LATSS classifier of one session with the preprocessing it was trained with.
+
+    LATSS only runs its preprocessing (artifact removal, band-pass, resampling
+    and intra-epoch segmentation) on MNE Raw input, while live epochs can only
+    be passed to it already preprocessed. This wrapper cuts the calibration
+    recording into the same windows the live stream is cut into and runs one
+    transform chain on both, so inference features match training ones:
+
+    1. Common average reference.
+    2. ICA artifact removal, the ICA and the components labeled as artifacts
+       by ICLabel are fitted on the calibration recording and kept.
+    3. Zero-phase band-pass (8-30 Hz by default) over the window and
+       `context_seconds` of data before it, which is then cropped off so the
+       filter edges fall outside the window.
+    4. Resampling to the sampling rate of the LATSS source dataset.
+
+    Windows are `window_size` seconds long and overlap as in LATSS's
+    intra-epoch segmentation, both taken from the LATSS model. Live epochs are
+    `epoch_length` seconds long (window plus context), at the sampling rate of
+    the calibration recording, and cut every `epoch_length * (1 - overlap)`.
+
+    Pickling leaves out the memory-mapped arrays the classifier refers to, i.e.
+    the source dataset it was trained with (see MLRepo.load_source_data): the
+    fitted classifier does not need it and it is far larger than the model.
+    """
+
+    # Trials start this long after their annotation, as in LATSS's Epochify
+    TRIAL_TMIN = 0.5
+
+    def __init__(self, model, context_seconds: float = 0.5, l_freq: float = 8.0,
+                 h_freq: float = 30.0, n_components: int = 5, remove_artifacts: bool = True,
+                 ica_method: str = "infomax"):
+        params = model.get_params()
+        self.model = model
+        self.target_sfreq: float = params["sfreq"]
+        self.trial_length: float = params["epoch_length"]
+        self.window_size: float = params["window_size"] or params["epoch_length"]
+        self.window_overlap: float = params["window_overlap"] if params["window_size"] else 0.0
+        self.context_seconds = context_seconds
+        self.l_freq = l_freq
+        self.h_freq = h_freq
+        self.n_components = n_components
+        self.remove_artifacts = remove_artifacts
+        self.ica_method = ica_method
+        # Set by fit from the calibration recording
+        self.sfreq: Optional[float] = None
+        self.info: Optional[mne.Info] = None
+        self.ica: Optional[mne.preprocessing.ICA] = None
+        self.exclude: list = []
+
+    @property
+    def epoch_length(self) -> float:
+        """Seconds of stream each live epoch holds, the window and its filter context."""
+        return self.window_size + self.context_seconds
+
+    @property
+    def overlap(self) -> float:
+        """Overlap of the live epochs, so they start every window step as in training."""
+        return 1 - self.window_size * (1 - self.window_overlap) / self.epoch_length
+
+    def _samples(self, seconds: float) -> int:
+        return int(round(seconds * self.sfreq))
+
+    def _fit_ica(self, raw: mne.io.BaseRaw):
+        from mne.preprocessing import ICA
+        from mne_icalabel import label_components
+        raw = raw.copy().set_eeg_reference("average", verbose=False)
+        raw.filter(1, 100 if self.sfreq > 200 else None, fir_design="firwin", verbose=False)
+        # Extended infomax as in LATSS, other methods are faster to fit
+        fit_params = dict(extended=True) if self.ica_method == "infomax" else None
+        ica = ICA(n_components=min(self.n_components, len(raw.ch_names) - 1), random_state=97,
+                  max_iter="auto", method=self.ica_method, fit_params=fit_params)
+        try:
+            ica.fit(raw, verbose=False)
+            labels = label_components(raw, ica, method="iclabel")["labels"]
+        except (RuntimeError, ValueError) as e:
+            # e.g. no channel positions, training and inference both go without it
+            print(f"Artifact removal skipped: {e}")
+            return
+        self.ica = ica
+        self.exclude = [i for i, label in enumerate(labels) if label not in ("brain", "other")]
+
+    def calibration_windows(self, raw: mne.io.BaseRaw, event_id: Dict[str, int]):
+        """Cut the annotated trials of a recording into live-sized epochs, returns (epochs, labels)."""
+        events, _ = mne.events_from_annotations(raw, event_id=event_id, verbose=False)
+        data = raw.get_data()
+        context, window = self._samples(self.context_seconds), self._samples(self.window_size)
+        step = max(int(window * (1 - self.window_overlap)), 1)
+        trial, tmin = self._samples(self.trial_length), self._samples(self.TRIAL_TMIN)
+        starts, labels = [], []
+        for onset, _, label in events:
+            first = onset - raw.first_samp + tmin
+            for start in range(first, first + trial - window + 1, step):
+                if start >= context and start + window <= data.shape[1]:
+                    starts.append(start - context)
+                    labels.append(label)
+        if not starts:
+            raise ValueError("No complete calibration trial in the recording")
+        indices = np.array(starts)[:, None] + np.arange(context + window)
+        return data[:, indices].transpose(1, 0, 2), np.array(labels)
+
+    def transform(self, epochs: np.ndarray) -> np.ndarray:
+        """Preprocess (n_epochs, n_channels, n_times) epochs into LATSS windows."""
+        data = np.asarray(epochs, dtype=np.float64)
+        data = data - data.mean(axis=1, keepdims=True)
+        if self.ica is not None:
+            data = self.ica.apply(mne.EpochsArray(data, self.info, verbose=False),
+                                  exclude=self.exclude, verbose=False).get_data(copy=False)
+        data = mne.filter.filter_data(data, self.sfreq, self.l_freq, self.h_freq,
+                                      method="iir", verbose=False)
+        data = data[..., -self._samples(self.window_size):]
+        if self.sfreq != self.target_sfreq:
+            data = mne.filter.resample(data, up=self.target_sfreq, down=self.sfreq,
+                                       axis=-1, verbose=False)
+        return data
+
+    def fit(self, raw: mne.io.BaseRaw, event_id: Dict[str, int] = {"rest": 0, "feet": 1}):
+        """Fit the preprocessing and the classifier on an annotated calibration recording."""
+        raw = raw.copy().pick("eeg")
+        self.sfreq = raw.info["sfreq"]
+        self.info = raw.info
+        if self.remove_artifacts:
+            self._fit_ica(raw)
+        epochs, labels = self.calibration_windows(raw, event_id)
+        events = np.column_stack([np.zeros_like(labels), np.zeros_like(labels), labels])
+        self.model.fit({"data": self.transform(epochs), "events": events}, event_id)
+        return self
+
+    def predict_epochs(self, epochs: np.ndarray) -> np.ndarray:
+        """Classify live epochs of `epoch_length` seconds at the calibration sampling rate."""
+        if self.sfreq is None:
+            raise ValueError("Model not trained")
+        return np.asarray(self.model.predict({"data": self.transform(epochs)}))
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        model_state = getattr(self.model, "__dict__", {})
+        if any(isinstance(value, np.memmap) for value in model_state.values()):
+            model = copy.copy(self.model)
+            model.__dict__ = {key: None if isinstance(value, np.memmap) else value
+                              for key, value in model_state.items()}
+            state["model"] = model
+        return state
+
+    def predict(self, raw: mne.io.BaseRaw) -> np.ndarray:
+        """Classify every window of a recording, in order."""
+        data = raw.copy().pick("eeg").get_data()
+        length = self._samples(self.epoch_length)
+        step = max(self._samples(self.epoch_length * (1 - self.overlap)), 1)
+        starts = np.arange(0, data.shape[1] - length + 1, step)
+        if not len(starts):
+            raise ValueError(f"Need at least {self.epoch_length} seconds of data to classify")
+        indices = starts[:, None] + np.arange(length)
+        return self.predict_epochs(data[:, indices].transpose(1, 0, 2))
@@ -35,3 +35,6 @@ class TrainingStatus(str, Enum):
     FAILED = "FAILED"
     NOT_FOUND = "NOT_FOUND"
     PENDING = "PENDING"
+    # Cancelled while running, the worker is still busy until the job returns
+    CANCELLING = "CANCELLING"
+    CANCELLED = "CANCELLED"
@@ -1,4 +1,8 @@
 from abc import ABC
+from typing import List, Optional
+
+import numpy as np
+from scipy.signal import butter, iirnotch, sosfilt, sosfilt_zi, tf2sos
 
 # ... Preprocessor Classes ...
 
@@ -27,4 +31,89 @@ class CSPPreprocessor(Preprocessor):
 
 
 
+# ... Online (streaming) preprocessors ...
+# These work on consecutive channel-major chunks (n_channels, n_samples) of one
+# stream and carry their state from one chunk to the next, so every sample is
+# filtered exactly once and the output matches filtering the whole recording.
+
+class StreamingSOSFilter(Preprocessor):
+    """IIR filter in second-order sections, keeping per-channel state across chunks."""
+
+    def __init__(self, sos: np.ndarray):
+        self.sos = sos
+        self._zi: Optional[np.ndarray] = None
+
+    def reset(self):
+        self._zi = None
+
+    def preprocess(self, eeg_data):
+        if eeg_data.shape[-1] == 0:
+            return eeg_data
+        if self._zi is None:
+            # Start in the steady state for the first sample to avoid a step transient
+            zi = sosfilt_zi(self.sos)
+            self._zi = zi[:, None, :] * eeg_data[None, :, 0, None]
+        filtered, self._zi = sosfilt(self.sos, eeg_data, axis=-1, zi=self._zi)
+        return filtered
+
+
+class StreamingBandpass(StreamingSOSFilter):
+    def __init__(self, sfreq: float, l_freq: Optional[float] = 1.0,
+                 h_freq: Optional[float] = 40.0, order: int = 4):
+        nyquist = sfreq / 2
+        if h_freq is not None and h_freq >= nyquist:
+            h_freq = None
+        if l_freq and h_freq:
+            sos = butter(order, [l_freq, h_freq], btype="bandpass", fs=sfreq, output="sos")
+        elif l_freq:
+            sos = butter(order, l_freq, btype="highpass", fs=sfreq, output="sos")
+        elif h_freq:
+            sos = butter(order, h_freq, btype="lowpass", fs=sfreq, output="sos")
+        else:
+            raise ValueError("Band-pass filter needs at least one cutoff frequency")
+        super().__init__(sos)
+
+
+class StreamingNotch(StreamingSOSFilter):
+    def __init__(self, sfreq: float, line_freq: float = 50.0, quality: float = 30.0):
+        b, a = iirnotch(line_freq, quality, fs=sfreq)
+        super().__init__(tf2sos(b, a))
+
+
+class CommonAverageReference(Preprocessor):
+    """Re-reference every sample to the mean over channels (stateless)."""
+
+    def reset(self):
+        pass
+
+    def preprocess(self, eeg_data):
+        return eeg_data - eeg_data.mean(axis=0, keepdims=True)
+
+
+class StreamingFilterBank(Preprocessor):
+    """
+    Online signal conditioning for one EEG stream: line noise notch, band-pass
+    and common-average reference, applied chunk by chunk.
+    """
+
+    def __init__(self, sfreq: float, l_freq: Optional[float] = 1.0, h_freq: Optional[float] = 40.0,
+                 notch_freq: Optional[float] = 50.0, car: bool = True):
+        self.stages: List[Preprocessor] = []
+        if notch_freq and notch_freq < sfreq / 2:
+            self.stages.append(StreamingNotch(sfreq, notch_freq))
+        if l_freq or h_freq:
+            self.stages.append(StreamingBandpass(sfreq, l_freq, h_freq))
+        if car:
+            self.stages.append(CommonAverageReference())
+
+    def reset(self):
+        for stage in self.stages:
+            stage.reset()
+
+    def preprocess(self, eeg_data):
+        for stage in self.stages:
+            eeg_data = stage.preprocess(eeg_data)
+        return eeg_data
+
+
 # ... Other core classes, load_pipeline_from_config ... (From previous examples)
@@ -40,14 +40,28 @@ import pickle
 from abc import ABC, abstractmethod
 from typing import Optional, Tuple
 
+import json
+import tempfile
+from pathlib import Path
+
 import mne
 from mne.io import RawArray
 import numpy as np
 
+from fastapi import HTTPException
+
 from server.config import CONFIG
 
+try:
+    import fcntl
+except ImportError:  # Windows, the cache is still written atomically without the lock
+    fcntl = None
+
 settings = CONFIG.ML_CONFIG
 
+# Version of the model stored directly in the session's directory
+LATEST_MODEL_VERSION = "latest"
+
 
 
 class MLRepo(ABC):
@@ -65,8 +79,15 @@ class MLRepo(ABC):
         """Load an object (model or data) from the configured storage."""
         pass
 
-    def get_file_path(self, filename: str, session_id: str = None) -> str:
+    @abstractmethod
+    def _fingerprint(self, filename: str) -> dict:
+        """Identify the stored content of a file, e.g. its size and ETag, without reading it."""
+        pass
+
+    def get_file_path(self, filename: str, session_id: str = None, version: str = None) -> str:
         """Get the full file path for the given filename."""
+        if session_id and version and version != LATEST_MODEL_VERSION:
+            return os.path.join(settings.MODELS_DIR, session_id, version, filename)
         if session_id:
             return os.path.join(settings.MODELS_DIR, session_id, filename)
         return os.path.join(settings.MODELS_DIR, filename)
@@ -76,6 +97,92 @@ class MLRepo(ABC):
         filename = settings.UNTRAINED_MODEL_FILE
         return self._load_from_storage(filename)
 
+    def source_cache_dir(self) -> Path:
+        if settings.SOURCE_CACHE_DIR:
+            return Path(settings.SOURCE_CACHE_DIR)
+        return Path(tempfile.gettempdir()) / "latss_source"
+
+    def load_source_data(self) -> dict:
+        """
+        Load the source-domain dataset as read-only memory maps.
+
+        The pickled dataset is fetched and converted to one .npy file per array
+        the first time only. Every process then maps the same files, so
+        concurrent trainings share the page cache instead of each holding an
+        unpickled copy.
+
+        The cache is rebuilt when SOURCE_DATA_FILE names another file or the
+        stored file changed since the cache was built.
+        """
+        cache_dir = self.source_cache_dir()
+        manifest_path = cache_dir / "manifest.json"
+        try:
+            fingerprint = self._fingerprint(settings.SOURCE_DATA_FILE)
+        except Exception as e:
+            # Storage unreachable, a cache of the same file is better than none
+            print(f"Could not check the source data, using the cache as is: {e}")
+            fingerprint = None
+        manifest = self._read_source_manifest(manifest_path, fingerprint)
+        if manifest is None:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            with open(cache_dir / ".lock", "w") as lock_file:
+                if fcntl is not None:
+                    # Concurrent workers wait for the first one to build the cache
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                manifest = self._read_source_manifest(manifest_path, fingerprint)
+                if manifest is None:
+                    manifest = self._build_source_cache(cache_dir, fingerprint)
+
+        source = {}
+        if manifest["extras"]:
+            with open(cache_dir / "extras.pkl", "rb") as f:
+                source.update(pickle.load(f))
+        for key in manifest["arrays"]:
+            source[key] = np.load(cache_dir / f"{key}.npy", mmap_mode="r")
+        return source
+
+    @staticmethod
+    def _read_source_manifest(manifest_path: Path, fingerprint: Optional[dict]) -> Optional[dict]:
+        """The cache manifest if it was built from the current source data, else None."""
+        if not manifest_path.exists():
+            return None
+        manifest = json.loads(manifest_path.read_text())
+        if manifest.get("source") != settings.SOURCE_DATA_FILE:
+            return None
+        if fingerprint is not None and manifest.get("fingerprint") != fingerprint:
+            return None
+        return manifest
+
+    def _build_source_cache(self, cache_dir: Path, fingerprint: Optional[dict]) -> dict:
+        # Taken before the download, a change during it is picked up by the next load
+        if fingerprint is None:
+            fingerprint = self._fingerprint(settings.SOURCE_DATA_FILE)
+        # Readers of a stale cache wait for the rebuild instead of mixing files
+        (cache_dir / "manifest.json").unlink(missing_ok=True)
+        source = self._load_from_storage(settings.SOURCE_DATA_FILE)
+        arrays = {key: value for key, value in source.items() if isinstance(value, np.ndarray)}
+        extras = {key: value for key, value in source.items() if key not in arrays}
+        for key, value in arrays.items():
+            # Write under a temporary name so readers never map a partial file
+            tmp_path = cache_dir / f"{key}.npy.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, value)
+            os.replace(tmp_path, cache_dir / f"{key}.npy")
+        if extras:
+            with open(cache_dir / "extras.pkl", "wb") as f:
+                pickle.dump(extras, f)
+        # The manifest is written last, its presence marks the cache as complete
+        manifest = {
+            "source": settings.SOURCE_DATA_FILE,
+            "fingerprint": fingerprint,
+            "arrays": list(arrays),
+            "extras": bool(extras),
+        }
+        tmp_path = cache_dir / "manifest.json.tmp"
+        tmp_path.write_text(json.dumps(manifest))
+        os.replace(tmp_path, cache_dir / "manifest.json")
+        return manifest
+
     # def train_model(
     #     self, model: object, X: np.ndarray, y: np.ndarray
     # ) -> object:
@@ -93,16 +200,25 @@ class MLRepo(ABC):
         """Save an object (model or data) to the configured storage."""
         pass
 
-    def store_model(self, model: object, metadata: dict, filename: str = settings.TRAINED_MODEL_FILE, session_id: str = None):
+    def store_model(self, model: object, session_id: str = None, metadata: Optional[dict] = None,
+                    filename: str = settings.TRAINED_MODEL_FILE, version: str = None):
         """Store the trained model and associated metadata to S3 or local storage."""
-        with open(filename, "wb") as f:
-            pickle.dump({"model": model, "metadata": metadata}, f)
-        self._save_to_storage(filename)
-
-    def load_model(self, session_id) -> object:
-        """Load a trained model from S3 or local storage."""
-        filename = settings.TRAINED_MODEL_FILE
-        loaded_data = self._load_from_storage(filename)
+        self._save_to_storage({"model": model, "metadata": metadata or {}},
+                              self.get_file_path(filename, session_id, version))
+
+    def _is_missing(self, error: Exception) -> bool:
+        """Whether a storage error means the file does not exist."""
+        return isinstance(error, FileNotFoundError)
+
+    def load_model(self, session_id, version: str = None) -> Optional[object]:
+        """Load a trained model of a session, the latest one by default, None if there is none."""
+        try:
+            loaded_data = self._load_from_storage(
+                self.get_file_path(settings.TRAINED_MODEL_FILE, session_id, version))
+        except Exception as e:
+            if self._is_missing(e):
+                return None
+            raise
         return loaded_data["model"] if loaded_data else None
 
 
@@ -116,6 +232,12 @@ class S3MLRepo(MLRepo):
     def _load_from_storage(self, filename: str) -> Optional[object]:
         return self.storage.load(filename)
 
+    def _fingerprint(self, filename: str) -> dict:
+        return self.storage.s3_repo.get_fingerprint(filename)
+
+    def _is_missing(self, error: Exception) -> bool:
+        return isinstance(error, HTTPException) and error.status_code == 404
+
     def _save_to_storage(self, obj: object, filename: str):
         self.storage.save(obj, filename)
 
@@ -132,3 +254,7 @@ class LocalMLRepo(MLRepo):
 
     def _save_to_storage(self, obj: object, filename: str):
         self.storage.save(obj, filename)
+
+    def _fingerprint(self, filename: str) -> dict:
+        stat = (self.storage.cache_dir / filename).stat()
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
@@ -0,0 +1,205 @@
+'''
+Background scheduler for model training jobs.
+
+Training a model takes seconds to minutes of CPU, so it never runs on the
+event loop or in the request handlers. Jobs wait in a bounded queue and are
+dispatched to a process pool, at most `max_workers` at a time.
+'''
+
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from .models import TrainingStatus
+
+
+class TrainingQueueFull(ValueError):
+    """Raised when a training job is submitted while the queue is at capacity."""
+
+
+@dataclass
+class TrainingJob:
+    """
+    A training job and its lifecycle, PENDING -> IN_PROGRESS -> COMPLETED/FAILED/CANCELLED.
+
+    A job cancelled while running is CANCELLING until its worker returns.
+    """
+    session_id: str
+    fn: Callable = field(repr=False)
+    args: Tuple = field(default=(), repr=False)
+    on_update: Optional[Callable[['TrainingJob'], None]] = field(default=None, repr=False)
+    status: TrainingStatus = TrainingStatus.PENDING
+    result: Any = field(default=None, repr=False)
+    error: Optional[str] = None
+    submitted_at: float = field(default_factory=time.monotonic)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    future: Optional[Future] = field(default=None, repr=False)
+
+    @property
+    def done(self) -> bool:
+        return self.status in (TrainingStatus.COMPLETED, TrainingStatus.FAILED,
+                               TrainingStatus.CANCELLED)
+
+
+def _default_executor(max_workers: int) -> Executor:
+    # Spawned workers do not inherit the server's threads, sockets and locks
+    return ProcessPoolExecutor(max_workers=max_workers,
+                               mp_context=multiprocessing.get_context("spawn"))
+
+
+class TrainingScheduler:
+    """
+    Runs training jobs in a worker pool with a bounded queue.
+
+    Jobs are only handed to the pool when a worker is free, so a PENDING job
+    can still be cancelled and the queue length is exact. `submit` raises
+    `TrainingQueueFull` once `max_queue` jobs are waiting, letting callers push
+    back instead of piling up work. A running job cannot be interrupted,
+    cancelling it marks it CANCELLING and discards its result: it keeps its
+    worker slot until the worker returns, then becomes CANCELLED and the next
+    queued job starts.
+
+    The `on_update` callback of a job is called on every status change, from
+    the thread that caused it (the submitting thread or a pool callback thread).
+    Finished jobs drop their arguments, e.g. the calibration recording, and
+    only the last `max_history` of them are kept for `get_job`.
+    """
+
+    def __init__(self, max_workers: int = 1, max_queue: int = 8,
+                 executor_factory: Callable[[int], Executor] = _default_executor,
+                 max_history: int = 64):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.max_history = max_history
+        self._executor_factory = executor_factory
+        self._executor: Optional[Executor] = None
+        self._lock = threading.RLock()
+        self._pending: "OrderedDict[str, TrainingJob]" = OrderedDict()
+        self._running: Dict[str, TrainingJob] = {}
+        self.jobs: Dict[str, TrainingJob] = {}
+
+    @property
+    def queued(self) -> int:
+        return len(self._pending)
+
+    @property
+    def running(self) -> int:
+        return len(self._running)
+
+    def submit(self, session_id: str, fn: Callable, *args,
+               on_update: Optional[Callable[[TrainingJob], None]] = None) -> TrainingJob:
+        """Queue `fn(*args)` as the training job of a session."""
+        with self._lock:
+            existing = self.jobs.get(session_id)
+            if existing is not None and not existing.done:
+                raise ValueError(f"Training already scheduled for session {session_id}")
+            if len(self._pending) >= self.max_queue:
+                raise TrainingQueueFull(
+                    f"Training queue is full ({self.max_queue} jobs waiting), try again later")
+            job = TrainingJob(session_id=session_id, fn=fn, args=args, on_update=on_update)
+            # Moved to the end, the history is pruned oldest first
+            self.jobs.pop(session_id, None)
+            self.jobs[session_id] = job
+            self._pending[session_id] = job
+        self._notify(job)
+        self._prune()
+        self._dispatch()
+        return job
+
+    def get_job(self, session_id: str) -> Optional[TrainingJob]:
+        return self.jobs.get(session_id)
+
+    def cancel(self, session_id: str) -> bool:
+        """Cancel a queued or running job. Returns False if there is nothing to cancel."""
+        with self._lock:
+            job = self.jobs.get(session_id)
+            if job is None or job.done or job.status == TrainingStatus.CANCELLING:
+                return False
+            if self._pending.pop(session_id, None) is not None:
+                self._finish(job, TrainingStatus.CANCELLED)
+            elif job.future is not None and job.future.cancel():
+                # Not picked up by a worker yet
+                del self._running[session_id]
+                self._finish(job, TrainingStatus.CANCELLED)
+            else:
+                # The worker runs on, the slot is freed when it returns
+                job.status = TrainingStatus.CANCELLING
+        self._notify(job)
+        self._prune()
+        self._dispatch()
+        return True
+
+    def _finish(self, job: TrainingJob, status: TrainingStatus, result=None, error=None):
+        job.args = ()
+        job.status = status
+        job.result = result
+        job.error = error
+        job.finished_at = time.monotonic()
+
+    def _dispatch(self):
+        """Move queued jobs to the pool while workers are free."""
+        started = []
+        with self._lock:
+            while self._pending and len(self._running) < self.max_workers:
+                session_id, job = self._pending.popitem(last=False)
+                if self._executor is None:
+                    self._executor = self._executor_factory(self.max_workers)
+                job.status = TrainingStatus.IN_PROGRESS
+                job.started_at = time.monotonic()
+                self._running[session_id] = job
+                job.future = self._executor.submit(job.fn, *job.args)
+                started.append(job)
+        for job in started:
+            self._notify(job)
+            job.future.add_done_callback(
+                lambda future, job=job: self._on_job_done(job, future))
+
+    def _on_job_done(self, job: TrainingJob, future: Future):
+        with self._lock:
+            if self._running.get(job.session_id) is not job:
+                # Cancelled before a worker picked it up
+                return
+            del self._running[job.session_id]
+            if future.cancelled() or job.status == TrainingStatus.CANCELLING:
+                # The result of a job cancelled while running is discarded
+                self._finish(job, TrainingStatus.CANCELLED)
+            elif future.exception() is not None:
+                self._finish(job, TrainingStatus.FAILED, error=str(future.exception()))
+            else:
+                self._finish(job, TrainingStatus.COMPLETED, result=future.result())
+        if job.status == TrainingStatus.FAILED:
+            print(f"Error during model training for session {job.session_id}: {job.error}")
+        self._notify(job)
+        self._prune()
+        self._dispatch()
+
+    def _prune(self):
+        """Forget the oldest finished jobs beyond `max_history`."""
+        with self._lock:
+            finished = [session_id for session_id, job in self.jobs.items() if job.done]
+            for session_id in finished[:max(len(finished) - self.max_history, 0)]:
+                del self.jobs[session_id]
+
+    def _notify(self, job: TrainingJob):
+        if job.on_update is None:
+            return
+        try:
+            job.on_update(job)
+        except Exception as e:
+            print(f"Error in training callback for session {job.session_id}: {e}")
+
+    def shutdown(self, wait: bool = False):
+        """Cancel the queued jobs and stop the worker pool."""
+        with self._lock:
+            pending = list(self._pending)
+        for session_id in pending:
+            self.cancel(session_id)
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
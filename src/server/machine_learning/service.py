@@ -1,81 +1,135 @@
 from .repo import MLRepo, S3MLRepo, LocalMLRepo
 from .models import StorageType, TrainingStatus
+from .scheduler import TrainingJob, TrainingQueueFull, TrainingScheduler
+from .cache import ModelCache
+from .batching import InferenceBatcher
+from .repo import LATEST_MODEL_VERSION
 # from tensorflow.keras.models import load_model
 import pickle as pkl
 
 from server.config import CONFIG
-from typing import Dict, Optional
+from typing import Callable, Dict, Optional
 from typing import Tuple
 
 from latss import LATSS
+from .model import SessionModel
+
+
+def create_repo() -> MLRepo:
+    return S3MLRepo() if CONFIG.ML_CONFIG.MODEL_STORAGE == StorageType.s3 else LocalMLRepo()
+
+
+_worker_repo: Optional[MLRepo] = None
+
+
+def train_session_model(session_id: str, calibration_data: object, repo: Optional[MLRepo] = None):
+    """
+    Train and store the model of a session on its calibration data.
+
+    This is the body of a training job, it runs in a training worker process
+    and creates its own repository there.
+    """
+    global _worker_repo
+    if repo is None:
+        if _worker_repo is None:
+            _worker_repo = create_repo()
+        repo = _worker_repo
+    # Memory-mapped, shared with the other training workers
+    source_data = repo.load_source_data()
+    # The preprocessing is fitted with the classifier, live epochs go through the same chain
+    trained_model = SessionModel(LATSS(source_data)).fit(calibration_data)
+    # The memory-mapped source dataset is left out when the model is pickled
+    repo.store_model(trained_model, session_id)
+    return trained_model
 
 
 class MachineLearningService:
     def __init__(self):
-        self.model_queue: list = []  # Queue for pending training tasks
-        # Dictionary to store models and their statuses
-        self.models: Dict[str, Tuple[object, TrainingStatus]] = {}
-        self.repo: MLRepo = (
-            S3MLRepo() if CONFIG.ML_CONFIG.MODEL_STORAGE == StorageType.s3 else LocalMLRepo()
+        # Trained models by (session ID, version), bounded by their estimated size
+        self.models = ModelCache(CONFIG.ML_CONFIG.MODEL_CACHE_MAX_BYTES,
+                                 miss_ttl=CONFIG.ML_CONFIG.MODEL_CACHE_MISS_TTL_SECONDS)
+        self.training_status: Dict[str, TrainingStatus] = {}
+        self.repo: MLRepo = create_repo()
+        # Training runs in worker processes, never on the event loop
+        self.scheduler = TrainingScheduler(
+            max_workers=CONFIG.ML_CONFIG.TRAINING_WORKERS,
+            max_queue=CONFIG.ML_CONFIG.TRAINING_QUEUE_SIZE,
+        )
+        # Real-time epochs of all sessions are classified in micro-batches
+        self.batcher = InferenceBatcher(
+            self.load_model,
+            max_batch_size=CONFIG.ML_CONFIG.INFERENCE_MAX_BATCH_SIZE,
+            max_delay=CONFIG.ML_CONFIG.INFERENCE_MAX_DELAY_MS / 1000,
         )
 
+    @property
+    def model_queue(self) -> list:
+        """Session IDs of the training jobs waiting for a worker."""
+        return [session_id for session_id, job in self.scheduler.jobs.items()
+                if job.status == TrainingStatus.PENDING]
+
+    def _load_calibration_data(self, session_id: str, calibration_data: object = None,
+                               calib_path: str = None):
+        if calib_path:
+            # Load the calibration data from the repo
+            calibration_data = self.repo._load_from_storage(calib_path)
+        elif calibration_data is None:
+            calibration_data = self.repo._load_from_storage(
+                "calibration_raw"+session_id+".pkl")
+        if calibration_data is None:
+            # Raise an exception if the calibration data is missing
+            raise ValueError("Calibration data is required")
+        return calibration_data
+
     def train_model(self, session_id: str, calibration_data: object = None, calib_path: str = None):
         """
         Train the model with the calibration data and source data.
 
-        This function is designed to be run as a background task.
+        This trains in the calling thread, request handlers queue a background job with `add_to_queue` instead.
         """
-        self.models[session_id] = (
-            None, TrainingStatus.PENDING)  # Initial status: PENDING
-        # Add the model to the models dictionary with status PENDING
+        self.training_status[session_id] = TrainingStatus.PENDING  # Initial status: PENDING
         try:
-            # untrained_model = self.repo.load_untrained_model()
-            if calib_path:
-                # Load the calibration data from the repo
-                self.repo._load_from_storage(calib_path)
-            elif calibration_data is None:
-                calibration_data = self.repo._load_from_storage(
-                    "calibration_raw"+session_id+".pkl")
-
-            source_data = self.repo._load_from_storage("source_np.pkl")
+            calibration_data = self._load_calibration_data(
+                session_id, calibration_data, calib_path)
             # Update status: IN_PROGRESS
-            self.models[session_id] = (
-                None, TrainingStatus.IN_PROGRESS)
-            untrained_model = LATSS(source_data)
-            self.models[session_id] = (
-                untrained_model, TrainingStatus.IN_PROGRESS)
-            # Train the model
-            trained_model = untrained_model.calibrate(calibration_data)
+            self.training_status[session_id] = TrainingStatus.IN_PROGRESS
+            trained_model = train_session_model(
+                session_id, calibration_data, repo=self.repo)
             # Update status: COMPLETED
-            self.models[session_id] = (trained_model, TrainingStatus.COMPLETED)
-            self.repo.store_model(trained_model, session_id)
+            self._model_trained(session_id, trained_model)
         except Exception as e:
-            self.models[session_id] = (None, TrainingStatus.FAILED)
+            self.training_status[session_id] = TrainingStatus.FAILED
             print(f"Error during model training: {e}")
             raise  # Re-raise the exception so it can be handled elsewhere
 
+    def _model_trained(self, session_id: str, model: object):
+        # A new model replaces every cached version of the session's previous one
+        self.models.invalidate(session_id)
+        self.models.put((session_id, LATEST_MODEL_VERSION), model)
+        self.training_status[session_id] = TrainingStatus.COMPLETED
+
     def get_model_status(self, session_id: str) -> TrainingStatus:
         """Get the training status of a model."""
-        _, status = self.models.get(
-            session_id, (None, TrainingStatus.NOT_FOUND))
-        return status
+        status = self.training_status.get(session_id)
+        if status is None and (session_id, LATEST_MODEL_VERSION) in self.models:
+            return TrainingStatus.COMPLETED
+        return status or TrainingStatus.NOT_FOUND
 
-    def load_model(self, session_id: str) -> Optional[object]:
+    def load_model(self, session_id: str, version: Optional[str] = None) -> Optional[object]:
         """Load the trained model for classification, if available."""
-        model, status = self.models.get(session_id, (None, None))
-        if status == TrainingStatus.COMPLETED:
-            return model
-        else:
-            # try loading from storage
+        version = version or LATEST_MODEL_VERSION
+
+        def load_from_storage():
             print(f"Loading model from storage for session {session_id}")
-            model = self.repo.load_model(session_id)
-            if model:
-                self.models[session_id] = (model, TrainingStatus.COMPLETED)
-                return model
-            else:
-                print(
-                    f"Cannot load model for session {session_id}: Status is {status}")
-                return None  # Or raise an exception, depending on your error handling strategy
+            return self.repo.load_model(session_id, version=version)
+
+        try:
+            # Concurrent requests for a model that is not cached share one storage fetch
+            return self.models.get_or_load((session_id, version), load_from_storage)
+        except Exception as e:
+            print(
+                f"Cannot load model for session {session_id}: {e}, status is {self.get_model_status(session_id)}")
+            return None  # Or raise an exception, depending on your error handling strategy
 
     def classify(self, session_id: str, data: object):
         """Classify the data using the trained model for the given session."""
@@ -91,30 +145,43 @@ class MachineLearningService:
             predictions = predictions[-1]
         return predictions
 
-    def add_to_queue(self, session_id: str, calibration_data: object = None, calib_path: str = None):
+    def classify_epochs(self, session_id: str, epochs) -> list:
+        """Classify a batch of epochs shaped (n_epochs, n_channels, n_times), one prediction per epoch.
+
+        The epochs are batched with the other requests classified by the same model object.
+        """
+        return self.batcher.predict(session_id, epochs)
+
+    def add_to_queue(self, session_id: str, calibration_data: object = None, calib_path: str = None,
+                     on_done: Optional[Callable[[TrainingJob], None]] = None) -> TrainingJob:
         """
         Add a model training task to the queue.
+
+        Returns immediately, the model is trained by a worker process. `on_done`
+        is called with the job once it completed, failed or was cancelled.
+        Raises `TrainingQueueFull` when too many jobs are already waiting.
         """
         # Checking if the calibration data is available and loading it
-        if calib_path:
-            # Load calibration data from the repo
-            calibration_data = self.repo._load_from_storage(calib_path)
-        elif calibration_data is None:
-            calibration_data = self.repo._load_from_storage(
-                "calibration_raw"+session_id+".pkl")
-        elif calibration_data:
-            # Add the task to the queue
-            pass
-        else:
-            # Raise an exception if the calibration data is missing
-            raise ValueError("Calibration data is required")
+        calibration_data = self._load_calibration_data(
+            session_id, calibration_data, calib_path)
+
+        def on_update(job: TrainingJob):
+            if job.status == TrainingStatus.COMPLETED:
+                self._model_trained(session_id, job.result)
+                # The model cache owns the model now, the job no longer pins it in memory
+                job.result = None
+            else:
+                self.training_status[session_id] = job.status
+            if job.done and on_done is not None:
+                on_done(job)
 
         # Add the task to the queue
-        self.model_queue.append((session_id, calibration_data))
+        return self.scheduler.submit(session_id, train_session_model, session_id,
+                                     calibration_data, on_update=on_update)
+
+    def cancel_training(self, session_id: str) -> bool:
+        """Cancel the queued or running training job of a session."""
+        return self.scheduler.cancel(session_id)
 
-        # TODO: make this a background async task in a real-world application
-        while self.model_queue:
-            session_id, calibration_data = self.model_queue.pop(0)
-            self.train_model(session_id, calibration_data)
 
 ml_service = MachineLearningService()
@@ -96,6 +96,37 @@ app.add_exception_handler(RequestValidationError, validation_exception_handler)
 app.add_exception_handler(Exception, common_exception_handler)
 
 
+@app.on_event("startup")
+async def start_session_reaper():
+    from server.bci.service import session_manager
+    session_manager.start_reaper()
+
+
+@app.on_event("shutdown")
+async def stop_session_reaper():
+    from server.bci.service import session_manager
+    session_manager.stop_reaper()
+
+
+@app.on_event("shutdown")
+def stop_training_workers():
+    from server.machine_learning.service import ml_service
+    ml_service.scheduler.shutdown()
+    ml_service.batcher.shutdown()
+
+
+@app.on_event("shutdown")
+def stop_s3_workers():
+    from server.common.repo.s3 import shutdown_executor
+    shutdown_executor()
+
+
+@app.on_event("shutdown")
+def flush_eeg_writer():
+    from server.common.repo.timeseries import shutdown_eeg_writer
+    shutdown_eeg_writer()
+
+
 @app.get(f"{ROOT_PREFIX}/healthcheck")
 def healthcheck():
     return {"status": "ok"}
@@ -1,7 +1,15 @@
 import asyncio
 import random
+import uuid
+import numpy as np
 import pytest
 from server.bci.models import EEGChunk
+from server.bci.frames import FrameError, decode_frame, encode_frame
+from server.bci.buffers import EEGRingBuffer
+from server.bci.models import SessionState, CalibrationProtocol, CalibrationSet, CalibrationAction
+from server.bci.service import BCISession, SessionManager
+from starlette.websockets import WebSocketDisconnect
+from server.common.repo.pickle_storage import LocalPickleStorage
 
 # Use a new UUID for each test
 SESSION_ID = "12345678-1234-5678-1234-567812345678"
@@ -34,6 +42,17 @@ async def send_fake_data(websocket):
             await asyncio.sleep(0.1)  # Adjust sleep for real-time simulation
 
 
+def end_session(websocket, session_id: str) -> list:
+    """Send END and return the text messages received until the server closes the socket."""
+    websocket.send_json({"type": "END", "session_id": session_id})
+    messages = []
+    while True:
+        try:
+            messages.append(websocket.receive_text())
+        except WebSocketDisconnect:
+            return messages
+
+
 # @pytest.mark.skip # Skip this test for now
 @pytest.mark.asyncio
 async def test_bci_session(testapp):  # Use the 'testapp' fixture
@@ -73,57 +92,570 @@ async def test_bci_session(testapp):  # Use the 'testapp' fixture
         await asyncio.sleep(2)
         # stop sending data before cancelling
         send_task.cancel()
-        # Send end packet
+        # Send end packet, the last text message is the end response
+        assert "Session ended" in end_session(websocket, session_id)[-1]
+
+
+def test_binary_frame_roundtrip():
+    data = np.random.rand(64, 8).astype(np.float32)
+    timestamps = np.arange(64) / 250.0
+    payload = encode_frame(SESSION_ID, 7, data, timestamps)
+
+    frame = decode_frame(payload)
+    assert frame.session_id == uuid.UUID(SESSION_ID)
+    assert frame.sequence == 7
+    assert np.array_equal(frame.data, data)
+    assert np.array_equal(frame.timestamps, timestamps)
+    # decoded arrays are views into the message, not copies
+    assert not frame.data.flags.owndata
+    assert not frame.timestamps.flags.owndata
+
+    with pytest.raises(FrameError):
+        decode_frame(payload[:-8])
+    with pytest.raises(FrameError):
+        decode_frame(b"XXXX" + payload[4:])
+
+
+def test_eeg_ring_buffer():
+    buffer = EEGRingBuffer(n_channels=2, capacity=10, sfreq=10)
+    stream = np.arange(2 * 25, dtype=np.float32).reshape(2, 25)
+    timestamps = np.arange(25) / 10.0
+
+    buffer.append(stream[:, :6], timestamps[:6])
+    data, ts = buffer.latest(4)
+    assert np.array_equal(data, stream[:, 2:6])
+    assert np.array_equal(ts, timestamps[2:6])
+    # contiguous reads are views into the ring
+    assert np.shares_memory(data, buffer.data)
+
+    buffer.append(stream[:, 6:13], timestamps[6:13])
+    assert len(buffer) == 10
+    assert buffer.first_index == 3
+    # range straddling the end of the storage is copied
+    data, ts = buffer.read(5, 13)
+    assert np.array_equal(data, stream[:, 5:13])
+    assert not np.shares_memory(data, buffer.data)
+    with pytest.raises(IndexError):
+        buffer.read(0, 5)
+
+    # chunks larger than the capacity keep only the newest samples
+    buffer.append(stream[:, 13:25], timestamps[13:25])
+    assert buffer.total_samples == 25
+    data, ts = buffer.last_seconds(1.0)
+    assert np.array_equal(data, stream[:, 15:25])
+    assert np.array_equal(ts, timestamps[15:25])
+
+
+def test_epoch_windower():
+    from server.bci.epoching import EpochWindower
+    buffer = EEGRingBuffer(n_channels=2, capacity=40, sfreq=10)
+    stream = np.arange(2 * 100, dtype=np.float32).reshape(2, 100)
+    timestamps = np.arange(100) / 10.0
+    # 1 second epochs with 50% overlap -> 10 sample windows every 5 samples
+    windower = EpochWindower(sfreq=10, epoch_length=1, overlap=0.5)
+    windower.reset(0)
+
+    buffer.append(stream[:, :8], timestamps[:8])
+    assert windower.collect(buffer) is None
+
+    buffer.append(stream[:, 8:22], timestamps[8:22])
+    batch = windower.collect(buffer)
+    assert batch.data.shape == (3, 2, 10)
+    assert list(batch.start_indices) == [0, 5, 10]
+    assert np.array_equal(batch.data[1], stream[:, 5:15])
+    assert np.array_equal(batch.timestamps, timestamps[[9, 14, 19]])
+    # epochs are strided views over the ring, not copies
+    assert np.shares_memory(batch.data, buffer.data)
+    # nothing is emitted twice
+    assert windower.collect(buffer) is None
+
+    # a reader that fell behind the ring resumes at the oldest complete window
+    buffer.append(stream[:, 22:100], timestamps[22:100])
+    windower.max_epochs = 2
+    batch = windower.collect(buffer)
+    assert list(batch.start_indices) == [85, 90]
+    assert np.array_equal(batch.data[-1], stream[:, 90:100])
+
+
+def test_classification_epochs(monkeypatch):
+    import mne
+    from server.bci import service
+    from server.config import CONFIG
+    monkeypatch.setattr(CONFIG.BCI_CONFIG, "FILTER_ENABLED", False)
+    classified = []
+
+    def classify_epochs(session_id, epochs):
+        classified.append(epochs.shape)
+        return [1] * len(epochs)
+    monkeypatch.setattr(service.ml_service, "classify_epochs", classify_epochs)
+
+    session = BCISession(session_id=uuid.UUID(SESSION_ID))
+    session.info = mne.create_info(
+        ch_names=['C3', 'C4', 'Cz'], sfreq=100, ch_types=['eeg'] * 3)
+    session.allocate_buffers(3)
+    session.state_handler.state = SessionState.READY_FOR_CLASSIFICATION
+    session.state_handler.transition_to(SessionState.CLASSIFICATION)
+
+    for start in range(0, 300, 50):
+        session.add_eeg_data(EEGChunk(data=np.random.rand(50, 3).tolist(),
+                                      timestamps=list(np.arange(start, start + 50) / 100)))
+    assert session.get_classification_results() == 1
+    # 3 seconds of data cut into 1 second epochs every 0.5 seconds
+    assert classified == [(5, 3, 100)]
+    assert len(session.prediction_buffer) == 5
+    assert session.prediction_buffer[-1][0] == pytest.approx(2.99)
+    # no new data, the previous prediction is returned without classifying again
+    assert session.get_classification_results() == 1
+    assert len(classified) == 1
+
+
+def test_calibration_recording(tmp_path, monkeypatch):
+    import mne
+    # 3 sets of a single 2 second action -> 6 seconds of calibration
+    action_set = CalibrationSet(repeat=1, actions=[
+        CalibrationAction(time=1, baseline=0.5, cooldown=0.5, action="Rest", label="rest")])
+    protocol = CalibrationProtocol(
+        prepare=action_set, main_trial=action_set, end=action_set)
+    from server.config import CONFIG
+    monkeypatch.setattr(CONFIG.BCI_CONFIG, "FILTER_ENABLED", False)
+    storage = LocalPickleStorage()
+    storage.cache_dir = tmp_path
+    session = BCISession(session_id=uuid.UUID(SESSION_ID), storage_repo=storage)
+    session.info = mne.create_info(
+        ch_names=['C3', 'C4', 'Cz'], sfreq=100, ch_types=['eeg'] * 3)
+    session.allocate_buffers(3)
+    # training is queued without holding up the stream
+    lock_held = []
+    monkeypatch.setattr(session, "init_training", lambda: lock_held.append(session._buffer_lock.locked()))
+
+    assert session.init_calibration(protocol)
+    assert session.state_handler.state == SessionState.CALIBRATION
+
+    stream = np.random.rand(700, 3).astype(np.float32)
+    for start in range(0, 700, 64):
+        session.add_eeg_data(EEGChunk(data=stream[start:start + 64].tolist(),
+                                      timestamps=list(np.arange(start, min(start + 64, 700)) / 100)))
+
+    assert session.state_handler.state == SessionState.TRAINING
+    assert lock_held == [False]
+    assert session.calibration_recorder is None
+    assert session.calibration_raw.get_data().shape == (3, 600)
+    assert np.allclose(session.calibration_raw.get_data(), stream[:600].T)
+    assert (tmp_path / ("calibration_raw" + SESSION_ID)).exists()
+
+
+def test_session_manager_indexes():
+    manager = SessionManager(n_shards=4)
+    session_ids = [uuid.uuid4() for _ in range(10)]
+    for i, session_id in enumerate(session_ids):
+        manager.create_session(session_id.hex, user_id="alice" if i % 2 else "bob")
+    assert len(manager) == 10
+
+    # lookups accept any UUID notation
+    session = manager.get_session(str(session_ids[3]))
+    assert session is manager.get_session(session_ids[3].hex)
+    assert manager.get_session("not-a-uuid") is None
+    with pytest.raises(ValueError):
+        manager.create_session(session_ids[3])
+    assert manager.get_or_create_session(session_ids[3]) is session
+
+    assert len(manager.sessions_by_user("alice")) == 5
+    assert len(manager.sessions_by_state(SessionState.UNSTARTED)) == 10
+    session.state_handler.state = SessionState.CLASSIFICATION
+    assert manager.sessions_by_state(SessionState.CLASSIFICATION) == [session]
+    assert len(manager.sessions_by_state(SessionState.UNSTARTED)) == 9
+
+    manager.set_owner(session_ids[3], "carol")
+    assert manager.sessions_by_user("carol") == [session]
+    assert manager.remove_session(session_ids[3]) is session
+    assert manager.get_session(session_ids[3]) is None
+    assert manager.sessions_by_state(SessionState.CLASSIFICATION) == []
+    assert len(manager.sessions_by_user("alice")) == 4
+
+
+def test_session_reaper(tmp_path, monkeypatch):
+    from server.config import CONFIG
+    storage = LocalPickleStorage()
+    storage.cache_dir = tmp_path
+    manager = SessionManager(n_shards=4, spill_storage=storage)
+    monkeypatch.setattr(CONFIG.BCI_CONFIG, "SESSION_IDLE_TTL_SECONDS", 100)
+    monkeypatch.setattr(CONFIG.BCI_CONFIG, "CLOSED_SESSION_TTL_SECONDS", 10)
+    # counts the samples as sent
+    monkeypatch.setattr(CONFIG.BCI_CONFIG, "TIMESTAMP_REGULARIZATION", False)
+
+    sessions = [manager.create_session(uuid.uuid4()) for _ in range(3)]
+    for i, session in enumerate(sessions):
+        session.add_eeg_data(EEGChunk(data=np.ones((10, 4)).tolist(),
+                                      timestamps=list(range(10))))
+        session.last_activity = 1000 + i
+    per_session = sessions[0].buffer_nbytes
+    monkeypatch.setattr(CONFIG.BCI_CONFIG, "SESSION_MEMORY_BUDGET_BYTES", 2 * per_session)
+    monkeypatch.setattr(CONFIG.BCI_CONFIG, "SESSION_REAPER_INTERVAL_SECONDS", 30)
+
+    # sessions streaming since the last run are left in memory, whatever the budget
+    manager.enforce_memory_budget(0, now=1020)
+    assert manager.memory_usage() == 3 * per_session
+
+    # over budget: the least recently active session is spilled to disk
+    stats = manager.reap(now=1050)
+    assert stats["spilled"] == 1
+    assert sessions[0].eeg_buffer is None
+    assert manager.memory_usage() == 2 * per_session
+    # and transparently restored on its next chunk
+    sessions[0].add_eeg_data(EEGChunk(data=np.ones((2, 4)).tolist(), timestamps=[10, 11]))
+    assert sessions[0].eeg_buffer.total_samples == 12
+    assert not list((tmp_path / "spill").iterdir())
+
+    manager.end_session(sessions[1].session_id)
+    sessions[1].closed_at = 1050
+    sessions[0].last_activity = 1060
+    sessions[2].last_activity = 1060
+    stats = manager.reap(now=1070)
+    assert stats["evicted_closed"] == 1
+    assert manager.get_session(sessions[1].session_id) is None
+
+    # a session training its model is not idle, and its job is cancelled with it
+    import server.bci.service as bci_service
+    cancelled = []
+    monkeypatch.setattr(bci_service.ml_service, "cancel_training", cancelled.append)
+    training = manager.create_session(uuid.uuid4())
+    training.state_handler.state = SessionState.TRAINING
+    training.last_activity = 1000
+    stats = manager.reap(now=1200)
+    assert stats["evicted_idle"] == 2
+    assert len(manager) == 1 and cancelled == []
+    manager.remove_session(training.session_id)
+    assert cancelled == [str(training.session_id)]
+    assert len(manager) == 0
+
+
+def test_bci_session_binary_frames(testapp):
+    session_id = "87654321-4321-8765-4321-876543218765"
+    channel_labels = ['T3', 'T4', 'C3', 'C4', 'O1', 'O2', 'P3', 'P4']
+    with testapp.websocket_connect("api/v1/bci/stream/"+session_id) as websocket:
+        assert "Session created" in websocket.receive_text()
         websocket.send_json({
-            "type": "END",
-            "session_id": session_id
+            "type": "START",
+            "session_id": session_id,
+            "sampling_rate": 250,
+            "channel_labels": channel_labels,
+            "encoding": "binary"
         })
-        # check end response, get the last text message
-
-
-        # keep accumulating text until the last response is received
-        end_response_accumulator = []
-        while True:
-            try:
-                end_response_accumulator.append(websocket.receive_text())
-            except:
-                break
-        print(end_response_accumulator)
-        assert "Session ended" in end_response_accumulator[-1]
-
+        assert websocket.receive_json()["encoding"] == "binary"
+        assert "ACK" in websocket.receive_text()
+
+        for seq in range(5):
+            data = np.random.rand(32, len(channel_labels))
+            timestamps = (seq * 32 + np.arange(32)) / 250.0
+            websocket.send_bytes(encode_frame(session_id, seq, data, timestamps))
+            assert "ACK" in websocket.receive_text()
+
+        # wrong channel count is rejected without closing the stream
+        websocket.send_bytes(encode_frame(
+            session_id, 5, np.zeros((4, 3)), np.zeros(4)))
+        assert "error" in websocket.receive_json()
+        # and without moving the high-water mark, the frame can be sent again
+        data = np.random.rand(32, len(channel_labels))
+        websocket.send_bytes(encode_frame(session_id, 5, data, (160 + np.arange(32)) / 250.0))
+        assert "ACK" in websocket.receive_text()
+        from server.bci.service import session_manager
+        stats = session_manager.get_session(session_id).get_session_stats()
+        assert stats["last_sequence"] == 5 and stats["samples_received"] == 6 * 32
+        assert stats["duplicate_frames"] == 0 and stats["missing_frames"] == 0
+
+        assert "Session ended" in end_session(websocket, session_id)[-1]
+
+
+def test_bci_session_cumulative_acks(testapp):
+    session_id = "99999999-8888-7777-6666-555555555555"
+    channel_labels = ['C3', 'C4']
+    with testapp.websocket_connect("api/v1/bci/stream/"+session_id) as websocket:
+        assert "Session created" in websocket.receive_text()
+        websocket.send_json({"type": "START", "session_id": session_id, "sampling_rate": 250,
+                             "channel_labels": channel_labels, "encoding": "binary",
+                             "ack_mode": "cumulative", "ack_every": 4, "ack_interval_ms": 200})
+        assert websocket.receive_json()["encoding"] == "binary"
+        assert websocket.receive_json()["ack_mode"] == "cumulative"
+        assert websocket.receive_text() == "ACK"
+
+        def send(seq):
+            websocket.send_bytes(encode_frame(
+                session_id, seq, np.random.rand(8, 2), (seq * 8 + np.arange(8)) / 250.0))
+
+        # one ACK for four frames, carrying the last of them
+        for seq in range(4):
+            send(seq)
+        assert websocket.receive_text() == "ACK 3"
+        # a frame arriving after a gap is held until the gap fills
+        send(5)
+        send(4)
+        send(6)
+        assert websocket.receive_text() == "ACK 6"  # sent after ack_interval_ms
+
+        assert "Session ended" in end_session(websocket, session_id)[-1]
+
+
+def test_bci_session_resume(testapp):
+    from server.bci.service import session_manager
+    session_id = "77777777-6666-5555-4444-333333333333"
+    channel_labels = ['C3', 'C4']
+
+    def frame(seq):
+        return encode_frame(session_id, seq, np.random.rand(8, 2), (seq * 8 + np.arange(8)) / 250.0)
 
-# # 1. Data Consistency Tests
-# @pytest.mark.asyncio
-# async def test_duplicate_timestamp(testapp):
-#     session_id = "test_duplicate_timestamp"
-#     with testapp.websocket_connect(f"api/v1/bci/stream/{session_id}") as websocket:
-#         await websocket.send_json({
-#             "type": "START",
-#             "session_id": session_id,
-#             "sampling_rate": 200,
-#             "channel_labels": ['T3', 'T4', 'C3', 'C4', 'O1', 'O2', 'P3', 'P4']
-#         })
-#         # Send duplicate timestamp
-#         for _ in range(2):
-#             packet = EEGChunk(timestamps=[1.0], data=[
-#                               [random.random() for _ in range(8)]])
-#             await websocket.send_json({
-#                 "type": "EEG_DATA",
-#                 "timestamps": packet.timestamps,
-#                 "data": packet.data
-#             })
-#             await asyncio.sleep(0.1)
-#         await websocket.send_json({"type": "END", "session_id": session_id})
-#         response = await websocket.receive_json()
-#         # Assert for a specific error message or behavior related to duplicate timestamps
-#         assert "Error: Duplicate timestamp" in response.get(
-#             "error", ""), response
+    with testapp.websocket_connect("api/v1/bci/stream/"+session_id) as websocket:
+        assert "Session created" in websocket.receive_text()
+        websocket.send_json({"type": "START", "session_id": session_id, "sampling_rate": 250,
+                             "channel_labels": channel_labels, "encoding": "binary"})
+        assert websocket.receive_json()["encoding"] == "binary"
+        assert websocket.receive_text() == "ACK"
+        for seq in range(3):
+            websocket.send_bytes(frame(seq))
+            assert websocket.receive_text() == "ACK"
+
+        # a second connection cannot take over the live stream
+        with testapp.websocket_connect("api/v1/bci/stream/"+session_id) as second:
+            assert "active stream" in second.receive_json()["error"]
+            with pytest.raises(WebSocketDisconnect) as closed:
+                second.receive_json()
+            assert closed.value.code == 1008
+        websocket.send_bytes(frame(3))
+        assert websocket.receive_text() == "ACK"
+
+    # the stream dropped without END, the session waits for the client
+    session = session_manager.get_session(session_id)
+    assert session.state != SessionState.CLOSED
+    assert session.disconnected_at is not None
+    assert not session.stream_attached
 
+    with testapp.websocket_connect("api/v1/bci/stream/"+session_id) as websocket:
+        assert "Session created" in websocket.receive_text()
+        # only RESUME continues the interrupted stream
+        websocket.send_json({"type": "START", "session_id": session_id, "sampling_rate": 250,
+                             "channel_labels": channel_labels, "encoding": "binary"})
+        assert "send RESUME" in websocket.receive_json()["error"]
+        websocket.send_json({"type": "RESUME", "session_id": session_id})
+        resume = websocket.receive_json()
+        assert resume["type"] == "RESUME"
+        assert resume["next_sequence"] == 4
+        assert resume["encoding"] == "binary"
+        assert websocket.receive_text() == "ACK"
+        assert session.disconnected_at is None
+
+        # a frame replayed by the client is skipped, the gap after it is counted
+        websocket.send_bytes(frame(3))
+        assert websocket.receive_text() == "ACK"
+        websocket.send_bytes(frame(6))
+        assert websocket.receive_text() == "ACK"
+        stats = session.get_session_stats()
+        # the two missing frames are interpolated on the sampling grid
+        assert stats["samples_received"] == 7 * 8
+        assert stats["duplicate_frames"] == 1
+        assert stats["missing_frames"] == 2
+        assert stats["last_sequence"] == 6
+
+        assert "Session ended" in end_session(websocket, session_id)[-1]
+
+
+def test_classification_result_push(testapp, monkeypatch):
+    import mne
+    from server.bci import service
+    from server.bci.service import session_manager
+    from server.config import CONFIG
+    monkeypatch.setattr(CONFIG.BCI_CONFIG, "FILTER_ENABLED", False)
+    monkeypatch.setattr(service.ml_service, "classify_epochs",
+                        lambda session_id, epochs: [1] * len(epochs))
+    session_id = "11111111-2222-3333-4444-555555555555"
+    channel_labels = ['C3', 'C4', 'Cz']
+    session = session_manager.get_or_create_session(session_id)
+    session.info = mne.create_info(ch_names=channel_labels, sfreq=100, ch_types=['eeg'] * 3)
+    session.allocate_buffers(3)
+    session.state_handler.state = SessionState.READY_FOR_CLASSIFICATION
+    session.state_handler.transition_to(SessionState.CLASSIFICATION)
+
+    with testapp.websocket_connect("api/v1/bci/results/"+session_id) as results, \
+            testapp.websocket_connect("api/v1/bci/stream/"+session_id) as websocket:
+        assert "Session created" in websocket.receive_text()
+        websocket.send_json({"type": "START", "session_id": session_id,
+                             "sampling_rate": 100, "channel_labels": channel_labels})
+        assert "ACK" in websocket.receive_text()
+        websocket.send_json({"type": "SUBSCRIBE", "results": True})
+        assert "ACK" in websocket.receive_text()
+
+        # 1.5 seconds of data complete two 1 second epochs with 50% overlap
+        websocket.send_json({"type": "EEG_DATA", "data": np.random.rand(150, 3).tolist(),
+                             "timestamps": list(np.arange(150) / 100)})
+        assert "ACK" in websocket.receive_text()
+        pushed = [websocket.receive_json() for _ in range(2)]
+        assert all(message["type"] == "CLASSIFICATION_RESULT" and message["state"] == "feet"
+                   for message in pushed)
+        assert pushed[-1]["stream_timestamp"] == pytest.approx(1.49)
+        # the read-only subscriber gets the same results
+        assert [results.receive_json() for _ in range(2)] == pushed
+
+        assert "Session ended" in end_session(websocket, session_id)[-1]
+        assert results.receive_json()["message"] == "Session ended"
+    session_manager.remove_session(session_id)
+
+    # subscribing to an unknown session does not create it
+    with testapp.websocket_connect("api/v1/bci/results/"+session_id) as results:
+        assert "not found" in results.receive_json()["error"]
+        with pytest.raises(WebSocketDisconnect) as closed:
+            results.receive_json()
+        assert closed.value.code == 1008
+    assert session_manager.get_session(session_id) is None
+
+class _FeetClassifier:
+    """Stands in for LATSS, learns nothing and always predicts feet."""
+    def get_params(self):
+        return {"sfreq": 100, "epoch_length": 1, "window_size": None, "window_overlap": 0}
+
+    def fit(self, data, event_id):
+        self.labels = data["events"][:, -1]
+
+    def predict(self, data):
+        return [1] * len(data["data"])
+
+
+def test_calibration_to_classification(testapp, tmp_path, monkeypatch):
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from server.bci.service import session_manager
+    from server.config import CONFIG
+    from server.machine_learning import service as ml_module
+    from server.machine_learning.model import SessionModel
+    from server.machine_learning.scheduler import TrainingScheduler
+    monkeypatch.setattr(CONFIG.BCI_CONFIG, "FILTER_ENABLED", False)
+    # Trained in a thread, on the calibration the session recorded
+    monkeypatch.setattr(ml_module.ml_service, "scheduler",
+                        TrainingScheduler(executor_factory=ThreadPoolExecutor))
+    trained = []
+
+    def train_session_model(session_id, calibration_data):
+        trained.append(SessionModel(_FeetClassifier(), remove_artifacts=False).fit(calibration_data))
+        return trained[-1]
+    monkeypatch.setattr(ml_module, "train_session_model", train_session_model)
+
+    trial = CalibrationSet(repeat=2, actions=[
+        CalibrationAction(baseline=0.5, time=2, cooldown=0.5, action="Imagine walking", label="feet"),
+        CalibrationAction(baseline=0.5, time=2, cooldown=0.5, action="Relax", label="rest")])
+    cue = CalibrationSet(repeat=1, actions=[CalibrationAction(time=1, action="Get ready")])
+    protocol = CalibrationProtocol(prepare=cue, main_trial=trial, end=cue)
+    session_id = "33333333-4444-5555-6666-777777777777"
+    channel_labels = ['C3', 'C4', 'Cz']
 
-@pytest.mark.asyncio
-async def test_inconsistent_timestamp(testapp):
-    # ... Similar structure to test_duplicate_timestamp, but send timestamps that are not consistent with the sampling rate ...
-    pass
+    with testapp.websocket_connect("api/v1/bci/stream/"+session_id) as websocket:
+        assert "Session created" in websocket.receive_text()
+        session = session_manager.get_session(session_id)
+        session.storage_repo = LocalPickleStorage()
+        session.storage_repo.cache_dir = tmp_path
+        websocket.send_json({"type": "CALIBRATE", "protocol": protocol.model_dump()})
+        assert "START" in websocket.receive_json()["error"]
+        websocket.send_json({"type": "START", "session_id": session_id,
+                             "sampling_rate": 100, "channel_labels": channel_labels})
+        assert "ACK" in websocket.receive_text()
+        websocket.send_json({"type": "CALIBRATE", "protocol": protocol.model_dump()})
+        assert "ACK" in websocket.receive_text()
+        assert session.state == SessionState.CALIBRATION
+
+        # 1 + 2 * 6 + 1 seconds of protocol
+        for start in range(0, 1400, 200):
+            websocket.send_json({"type": "EEG_DATA", "data": np.random.rand(200, 3).tolist(),
+                                 "timestamps": list(np.arange(start, start + 200) / 100)})
+            assert "ACK" in websocket.receive_text()
+        deadline = time.monotonic() + 10
+        while session.state != SessionState.READY_FOR_CLASSIFICATION and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert session.state == SessionState.READY_FOR_CLASSIFICATION
+        annotations = session.calibration_raw.annotations
+        assert list(annotations.description) == ["Get ready"] + ["feet", "rest"] * 2 + ["Get ready"]
+        assert list(annotations.onset) == [0, 1.5, 4.5, 7.5, 10.5, 13]
+        # One window per trial, in the order of the protocol
+        assert trained[0].model.labels.tolist() == [1, 0, 1, 0]
+
+        websocket.send_json({"type": "SUBSCRIBE", "results": True})
+        assert "ACK" in websocket.receive_text()
+        assert session.state == SessionState.CLASSIFICATION
+        # Epochs of the window and its filter context, cut every window
+        websocket.send_json({"type": "EEG_DATA", "data": np.random.rand(150, 3).tolist(),
+                             "timestamps": list(np.arange(1400, 1550) / 100)})
+        assert "ACK" in websocket.receive_text()
+        pushed = websocket.receive_json()
+        assert pushed["type"] == "CLASSIFICATION_RESULT" and pushed["state"] == "feet"
+
+        assert "Session ended" in end_session(websocket, session_id)[-1]
+    session_manager.remove_session(session_id)
+
+
+# 1. Data Consistency Tests
+def test_duplicate_timestamp(testapp):
+    from server.bci.service import session_manager
+    session_id = "d0d0d0d0-1111-2222-3333-444444444444"
+    with testapp.websocket_connect(f"api/v1/bci/stream/{session_id}") as websocket:
+        assert "Session created" in websocket.receive_text()
+        websocket.send_json({
+            "type": "START",
+            "session_id": session_id,
+            "sampling_rate": 200,
+            "channel_labels": ['T3', 'T4', 'C3', 'C4', 'O1', 'O2', 'P3', 'P4']
+        })
+        assert websocket.receive_text() == "ACK"
+        # Send duplicate timestamp
+        for timestamps in ([1.0], [1.0], [1.0, 1.005]):
+            websocket.send_json({
+                "type": "EEG_DATA",
+                "timestamps": timestamps,
+                "data": [[random.random() for _ in range(8)] for _ in timestamps]
+            })
+            assert websocket.receive_text() == "ACK"
+        stats = session_manager.get_session(session_id).get_session_stats()
+        assert stats["clock"]["duplicate_samples"] == 2
+        assert stats["samples_received"] == 2
+        assert "Session ended" in end_session(websocket, session_id)[-1]
+
+
+def test_inconsistent_timestamp():
+    from server.bci.clock import ClockModel
+    rng = np.random.default_rng(0)
+    sfreq = 250
+    # device running 200 ppm fast, with 0.5 ms of timestamp jitter
+    true_times = 100 + np.arange(5000) / (sfreq * 1.0002)
+    timestamps = true_times + rng.normal(0, 0.0005, true_times.shape)
+    stream = np.sin(2 * np.pi * 3 * true_times)[None].astype(np.float32)
+    sent = np.delete(np.arange(5000), np.s_[1000:1010])  # 10 samples lost
+    sent = np.insert(sent, 2000, sent[1999])  # and one sent twice
+
+    clock = ClockModel(sfreq)
+    chunks = [clock.regularize(stream[:, idx], timestamps[idx])
+              for idx in np.array_split(sent, len(sent) // 37)]
+    data = np.concatenate([chunk[0] for chunk in chunks], axis=1)
+    grid = np.concatenate([chunk[1] for chunk in chunks])
+
+    # uniform grid at the declared rate, so time is index arithmetic
+    assert np.allclose(np.diff(grid), 1 / sfreq)
+    assert data.shape == (1, len(grid))
+    error = np.abs(data[0] - np.sin(2 * np.pi * 3 * grid))
+    in_gap = (grid > true_times[999]) & (grid < true_times[1010])
+    assert error[~in_gap].max() < 0.01
+    # the lost samples are interpolated
+    assert error[in_gap].max() < 0.05
+    stats = clock.get_stats()
+    assert stats["duplicate_samples"] == 1
+    assert stats["missing_samples"] == 10
+    assert stats["drift_ppm"] == pytest.approx(-200, abs=50)
+    assert stats["jitter_seconds"] == pytest.approx(0.0005, rel=0.2)
+
+    # a chunk with other channels is rejected before the model takes it in
+    before = (clock.get_stats(), clock.last_timestamp, clock.next_grid)
+    with pytest.raises(ValueError):
+        clock.regularize(np.zeros((2, 40), dtype=np.float32), timestamps[:40] + 20)
+    assert (clock.get_stats(), clock.last_timestamp, clock.next_grid) == before
+
+    # a jump in the clock starts a new grid instead of interpolating over it
+    later, later_grid = clock.regularize(stream[:, :40], timestamps[:40] + 500)
+    assert clock.get_stats()["resyncs"] == 1
+    assert later_grid[0] == pytest.approx(timestamps[0] + 500, abs=0.002)
+    assert np.allclose(np.diff(later_grid), 1 / sfreq)
 
 # 2. Data Processing Test
 
@@ -205,3 +737,155 @@ async def test_invalid_state_transitions(testapp):
 # what if i start classification without calibration
 # what if i start classification without any data
 # what if i start classification without any channel labels
+
+
+def test_eeg_data_streaming(testapp, tmp_path, monkeypatch):
+    import json
+    import pickle
+    from server.common.repo.timeseries import bucket_query
+    monkeypatch.chdir(tmp_path)
+    session_id = "22222222-3333-4444-5555-666666666666"
+    with open(f"eeg_data_{session_id}.pkl", "ab") as f:
+        for batch in range(3):
+            pickle.dump([{"epoch_timestamp": batch * 10 + i, "magnitude": [i, -i]}
+                         for i in range(10)], f)
+
+    url = f"api/v1/bci/eeg_data/?session_id={session_id}&storage_type=local_file"
+    response = testapp.get(url + "&end_time=14&channels=ch1")
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert len(lines) == 2 and lines[1]["timestamps"] == [10, 11, 12, 13, 14]
+    assert lines[1]["channels"] == ["ch1"] and lines[1]["data"] == [[0, -1, -2, -3, -4]]
+
+    response = testapp.get(url + "&start_time=25&encoding=binary")
+    assert response.headers["x-eeg-channels"] == "ch0,ch1"
+    frame = decode_frame(response.content)
+    assert frame.sequence == 0 and list(frame.timestamps) == [25, 26, 27, 28, 29]
+    assert frame.data[:, 0].tolist() == [5, 6, 7, 8, 9]
+
+    assert testapp.get(url.replace(session_id, "missing")).status_code == 404
+    # both bounds of a range query fall on the (session_id, min_ts) index
+    assert bucket_query("s", 100, None, bucket_seconds=10) == {
+        "session_id": "s", "min_ts": {"$gte": 90}, "max_ts": {"$gte": 100}}
+    assert bucket_query("s", None, 200, bucket_seconds=10) == {
+        "session_id": "s", "min_ts": {"$lte": 200}}
+
+
+def test_eeg_data_envelope(testapp, tmp_path, monkeypatch):
+    import pickle
+    from server.bci.eeg_query import EEGEnvelope
+    from server.common.repo.eeg_buckets import pack_bucket, unpack_summary
+    from server.common.repo.timeseries import raw_bin_stats
+    sfreq, ch_names = 250.0, ["C3", "C4"]
+    samples = np.random.rand(2, 5000).astype(np.float32)
+    timestamps = 100.0 + np.arange(5000) / sfreq  # 20 s
+
+    # 40 half-second bins, from the raw samples or from 0.1 s bucket summaries
+    raw = EEGEnvelope(100.0, 120.0, 40)
+    raw.add(*raw_bin_stats((ch_names, samples, timestamps)))
+    from_summaries = EEGEnvelope(100.0, 120.0, 40)
+    for start in (0, 2500):
+        doc = pack_bucket("s", 100.0 + start / sfreq, ch_names, samples[:, start:start + 2500],
+                          timestamps[start:start + 2500], summary_seconds=0.1)
+        from_summaries.add(ch_names, unpack_summary(doc))
+    expected = samples.reshape(2, 40, 125)
+    for envelope in (raw, from_summaries):
+        result = envelope.to_dict()
+        assert len(result["timestamps"]) == 40 and result["count"] == [125] * 40
+        assert np.allclose(result["min"], expected.min(axis=2))
+        assert np.allclose(result["max"], expected.max(axis=2))
+        assert np.allclose(result["mean"], expected.mean(axis=2), atol=1e-5)
+
+    monkeypatch.chdir(tmp_path)
+    session_id = "33333333-4444-5555-6666-777777777777"
+    with open(f"eeg_data_{session_id}.pkl", "ab") as f:
+        pickle.dump([{"epoch_timestamp": i, "magnitude": i} for i in range(1000)], f)
+    response = testapp.get(f"api/v1/bci/eeg_data/?session_id={session_id}"
+                           "&storage_type=local_file&max_points=10&start_time=100")
+    result = response.json()
+    assert result["channels"] == ["magnitude"] and len(result["timestamps"]) == 10
+    assert result["min"][0][0] == 100 and result["max"][0][-1] == 999
+
+
+def test_stream_flow_control():
+    from server.bci.streaming import FlowControl
+
+    class FakeWebSocket:
+        def __init__(self):
+            self.sent = []
+
+        async def send_json(self, message):
+            self.sent.append(message)
+
+    async def run():
+        websocket = FakeWebSocket()
+        flow = FlowControl(websocket, max_queue=4, high_watermark=0.75, low_watermark=0.25)
+        accepted = [await flow.offer(i, droppable=True) for i in range(6)]
+        # control messages are queued even when the queue is full
+        assert await flow.offer({"type": "END"}, droppable=False)
+        assert accepted == [True] * 4 + [False] * 2
+        assert [message["type"] for message in websocket.sent] == ["SLOW_DOWN"]
+        assert [await flow.take() for _ in range(4)] == [0, 1, 2, 3]
+        assert websocket.sent[-1] == {"type": "FLOW_OK", "queue_depth": 1, "queue_size": 4,
+                                      "dropped_frames": 2}
+        assert await flow.take() == {"type": "END"}
+        flow.close()
+        assert await flow.take() is None
+        assert flow.metrics["max_queue_depth"] == 5 and flow.metrics["received"] == 7
+
+    asyncio.run(run())
+
+
+def test_ingest_metrics(testapp):
+    from server.bci.metrics import IngestMetrics
+    metrics = IngestMetrics(window_seconds=10)
+    for i in range(20):
+        # 0.5 s between frames, the last sample stamped 10 ms before processing, 40 ms for one
+        metrics.record_frame(n_samples=25, nbytes=1000, parse_seconds=0.0001,
+                             queue_wait_seconds=0.001, last_timestamp=i / 2 - (0.05 if i == 7 else 0.01),
+                             now=100 + i / 2)
+    stats = metrics.get_stats(now=110)
+    assert stats["frames"] == 20 and stats["samples"] == 500 and stats["bytes"] == 20000
+    assert stats["samples_per_second"] == pytest.approx(50)  # over the last 10 s
+    assert stats["latency_seconds"]["max"] == pytest.approx(0.04)
+    assert stats["latency_seconds"]["p50"] < 0.001
+    assert stats["queue_wait_seconds"]["count"] == 20
+    metrics.reset_clock()
+    assert metrics.clock_offset is None
+
+    from server.bci.service import session_manager
+    session_id = "abababab-1111-2222-3333-444444444444"
+    with testapp.websocket_connect("api/v1/bci/stream/"+session_id) as websocket:
+        assert "Session created" in websocket.receive_text()
+        websocket.send_json({"type": "START", "session_id": session_id, "sampling_rate": 250,
+                             "channel_labels": ['C3', 'C4'], "encoding": "binary"})
+        assert websocket.receive_json()["encoding"] == "binary"
+        assert websocket.receive_text() == "ACK"
+        payloads = [encode_frame(session_id, seq, np.random.rand(16, 2),
+                                 (seq * 16 + np.arange(16)) / 250.0) for seq in range(3)]
+        for payload in payloads:
+            websocket.send_bytes(payload)
+            assert websocket.receive_text() == "ACK"
+        # a replayed frame is skipped and not counted
+        websocket.send_bytes(payloads[-1])
+        assert websocket.receive_text() == "ACK"
+
+        response = testapp.get("api/v1/bci/session/metrics/", params={"id": session_id})
+        assert response.status_code == 200
+        ingest = response.json()[session_id]["ingest"]
+        assert ingest["frames"] == 3 and ingest["samples"] == 48
+        assert ingest["bytes"] == sum(len(payload) for payload in payloads)
+        assert ingest["parse_seconds"]["count"] == 3
+        assert ingest["latency_seconds"]["count"] == 3
+        assert response.json()[session_id]["stream"]["processed"] >= 5
+
+        # a new stream may run on another clock
+        assert session_manager.get_session(session_id).ingest.clock_offset is not None
+        websocket.send_json({"type": "START", "session_id": session_id, "sampling_rate": 250,
+                             "channel_labels": ['C3', 'C4'], "encoding": "binary"})
+        assert websocket.receive_json()["encoding"] == "binary"
+        assert websocket.receive_text() == "ACK"
+        assert session_manager.get_session(session_id).ingest.clock_offset is None
+
+        assert "Session ended" in end_session(websocket, session_id)[-1]
+    assert testapp.get("api/v1/bci/session/metrics/", params={"id": "missing"}).status_code == 404
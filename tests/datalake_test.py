@@ -5,7 +5,7 @@ from functools import lru_cache
 from fastapi import HTTPException
 from server.config import CONFIG
 import pytest
-from server.common.repo.s3 import S3Repo
+from server.common.repo.s3 import S3Repo, get_s3_repo, reset_clients
 from server.common.repo.pickle_storage import LocalPickleStorage, S3PickleStorage
 
 
@@ -83,3 +83,318 @@ def test_s3_pickle_storage():
     assert loaded_data == new_data
     # test deleting
     pass
+
+
+def test_eeg_container(tmp_path):
+    import mne
+    import numpy as np
+    from server.common.repo.eeg_store import EEGContainer, write_raw, CODEC_NONE, CODEC_ZLIB
+
+    sfreq = 100
+    data = np.random.rand(4, 2500)
+    info = mne.create_info(ch_names=['C3', 'C4', 'Cz', 'Pz'], sfreq=sfreq, ch_types=['eeg'] * 4)
+    raw = mne.io.RawArray(data, info, verbose=False)
+    raw.set_annotations(mne.Annotations(onset=[2.0, 12.5], duration=[1.0, 1.0],
+                                        description=['feet', 'rest']))
+
+    for codec in (CODEC_ZLIB, CODEC_NONE):
+        path = tmp_path / f"recording_{codec}.eeg"
+        write_raw(path, raw, codec=codec, block_seconds=5)
+        container = EEGContainer(path)
+        assert container.ch_names == ['C3', 'C4', 'Cz', 'Pz']
+        assert container.sfreq == sfreq and container.n_times == 2500
+        # partial reads by time and channel
+        assert np.array_equal(container.read(7.3, 16.1, picks=['Cz', 'C3']),
+                              data[[2, 0], 730:1610])
+        assert np.array_equal(container.read_samples(), data)
+
+        loaded = container.to_raw(tmin=10, tmax=20)
+        assert loaded.n_times == 1000
+        assert list(loaded.annotations.description) == ['rest']
+        # as after raw.crop, the range and its annotations keep their recording time
+        assert loaded.first_samp == 1000
+        assert loaded.annotations.onset[0] == 12.5
+
+    # uncompressed containers are memory-mapped
+    mapped = container.memmap()
+    assert isinstance(mapped, np.memmap)
+    assert np.array_equal(mapped, data)
+
+    # measurement metadata survives the round trip
+    from datetime import datetime, timezone
+    raw = mne.io.RawArray(data, info.copy(), first_samp=300, verbose=False)
+    raw.set_meas_date(datetime(2024, 5, 1, 12, 30, tzinfo=timezone.utc))
+    raw.info["bads"] = ["Pz"]
+    raw.set_montage(mne.channels.make_standard_montage("standard_1005"))
+    raw.set_annotations(mne.Annotations(onset=[2.0], duration=[1.0], description=['feet'],
+                                        orig_time=None))
+    path = tmp_path / "recording_meta.eeg"
+    write_raw(path, raw)
+    loaded = EEGContainer(path).to_raw()
+    assert loaded.info["meas_date"] == raw.info["meas_date"]
+    assert loaded.info["bads"] == ["Pz"] and loaded.first_samp == 300
+    assert np.allclose(loaded._get_channel_positions(), raw._get_channel_positions())
+    assert len(loaded.info["dig"]) == len(raw.info["dig"])
+    assert np.allclose(loaded.annotations.onset, raw.annotations.onset)
+    # a cropped range keeps its position in the recording
+    cropped = EEGContainer(path).to_raw(tmin=10, picks=['C3', 'C4'])
+    assert cropped.first_samp == 1300 and cropped.info["bads"] == []
+
+
+def test_local_storage_eeg_payloads(tmp_path):
+    import mne
+    import numpy as np
+    storage = LocalPickleStorage()
+    storage.cache_dir = tmp_path
+    info = mne.create_info(ch_names=['C3', 'C4'], sfreq=100, ch_types=['eeg'] * 2)
+    raw = mne.io.RawArray(np.random.rand(2, 500), info, verbose=False)
+
+    storage.save(raw, "calibration_raw")
+    # EEG is written as a container instead of a pickle
+    assert (tmp_path / "calibration_raw").read_bytes()[:4] == b"EEGC"
+    loaded = storage.load("calibration_raw")
+    assert isinstance(loaded, mne.io.BaseRaw)
+    assert np.allclose(loaded.get_data(), raw.get_data())
+    assert np.array_equal(storage.open_eeg("calibration_raw").read(1, 2, picks=['C4']),
+                          raw.get_data()[[1], 100:200])
+
+    storage.save({"key": "value"}, "other.pkl")
+    assert storage.load("other.pkl") == {"key": "value"}
+
+
+@pytest.fixture
+def mock_s3_repo(monkeypatch, tmp_path):
+    moto = pytest.importorskip("moto")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    config = CONFIG.model_copy(update={"AWS_S3_ENDPOINT": None, "AWS_S3_BUCKET": "test-bucket"})
+    # the shared client must be created inside the mock
+    reset_clients()
+    with moto.mock_aws():
+        s3 = S3Repo(config)
+        s3.cache_dir = tmp_path
+        s3.s3.create_bucket(Bucket="test-bucket")
+        yield s3
+    reset_clients()
+
+
+def test_s3_streaming_upload_and_ranges(mock_s3_repo):
+    s3 = mock_s3_repo
+    chunk = bytes(range(256)) * 4096  # 1 MiB
+    # 12 MiB from a generator, sent as three parts without a temp file
+    s3.upload_stream((chunk for _ in range(12)), "big_object")
+    assert s3.get_size("big_object") == 12 * len(chunk)
+    assert s3.get_range("big_object", 5 * len(chunk) + 10, 5 * len(chunk) + 19) == chunk[10:20]
+
+    s3.upload_bytes(b"small", "small_object")
+    assert s3.open_cached("small_object").read_bytes() == b"small"
+
+    # a failed upload is aborted and leaves nothing behind
+    def failing():
+        yield chunk * 6
+        raise RuntimeError("producer failed")
+    with pytest.raises(RuntimeError):
+        s3.upload_stream(failing(), "failed_object")
+    assert s3.s3.list_multipart_uploads(Bucket="test-bucket").get("Uploads", []) == []
+
+    # so is a writer dropped without being closed
+    import gc
+    writer = s3.open_writer("dropped_object", part_size=5 * len(chunk))
+    writer.write(chunk * 6)
+    assert len(s3.s3.list_multipart_uploads(Bucket="test-bucket")["Uploads"]) == 1
+    del writer
+    gc.collect()
+    assert s3.s3.list_multipart_uploads(Bucket="test-bucket").get("Uploads", []) == []
+    with pytest.raises(HTTPException):
+        s3.get_size("dropped_object")
+
+
+def test_s3_storage_eeg_partial_reads(mock_s3_repo):
+    import mne
+    import numpy as np
+    storage = S3PickleStorage()
+    storage.s3_repo = mock_s3_repo
+    info = mne.create_info(ch_names=['C3', 'C4', 'Cz'], sfreq=100, ch_types=['eeg'] * 3)
+    raw = mne.io.RawArray(np.random.rand(3, 6000), info, verbose=False)
+
+    storage.save(raw, "calibration_raw")
+    storage.save({"key": "value"}, "test.pkl")
+    assert storage.load("test.pkl") == {"key": "value"}
+    assert np.allclose(storage.load("calibration_raw").get_data(), raw.get_data())
+
+    container = storage.open_eeg("calibration_raw")
+    requested = []
+    get_range = mock_s3_repo.get_range
+    mock_s3_repo.get_range = lambda key, start, end: requested.append(end - start + 1) or get_range(key, start, end)
+    assert np.allclose(container.read(25, 32, picks=['C4']), raw.get_data()[[1], 2500:3200])
+    # only the blocks covering the requested seconds are fetched
+    assert len(requested) == 1 and requested[0] < mock_s3_repo.get_size("calibration_raw") / 2
+
+
+def test_s3_cache_sidecar_metadata(mock_s3_repo, monkeypatch):
+    s3 = mock_s3_repo
+    heads = []
+    head_object = s3.s3.head_object
+    monkeypatch.setattr(s3.s3, "head_object", lambda **kwargs: heads.append(kwargs["Key"]) or head_object(**kwargs))
+    monkeypatch.setattr(s3.config, "S3_CACHE_FRESHNESS_SECONDS", 0)
+
+    # multipart objects have a non-MD5 ETag, the cache must still hit
+    s3.upload_stream((b"x" * 1024 * 1024 for _ in range(11)), "multipart_object")
+    path = s3.open_cached("multipart_object")
+    meta = s3._read_meta("multipart_object")
+    assert "-" in meta["etag"] and meta["size"] == 11 * 1024 * 1024
+    mtime = path.stat().st_mtime_ns
+    assert s3.open_cached("multipart_object") == path
+    assert path.stat().st_mtime_ns == mtime  # validated, not downloaded again
+    assert heads == ["multipart_object"]
+
+    # a changed object is fetched again
+    s3.upload_bytes(b"new content", "multipart_object")
+    assert s3.open_cached("multipart_object").read_bytes() == b"new content"
+
+    # within the freshness window, or for immutable keys, R2 is not asked at all
+    heads.clear()
+    monkeypatch.setattr(s3.config, "S3_CACHE_FRESHNESS_SECONDS", 60)
+    s3.open_cached("multipart_object")
+    monkeypatch.setattr(s3.config, "S3_CACHE_FRESHNESS_SECONDS", 0)
+    monkeypatch.setattr(s3.config, "S3_CACHE_IMMUTABLE_PREFIXES", ["multipart"])
+    s3.open_cached("multipart_object")
+    assert heads == []
+
+    # overwriting an object drops the cached copy, even one that is still fresh
+    s3.upload_bytes(b"newer content", "multipart_object")
+    assert s3._read_meta("multipart_object") is None
+    assert s3.open_cached("multipart_object").read_bytes() == b"newer content"
+    storage = S3PickleStorage()
+    storage.s3_repo = s3
+    storage.save({"version": 1}, "object.pkl")
+    assert storage.load("object.pkl") == {"version": 1}
+    storage.save({"version": 2}, "object.pkl")
+    assert storage.load("object.pkl") == {"version": 2}
+
+
+def test_disk_cache_eviction(tmp_path):
+    from server.common.repo.disk_cache import DiskCache
+    cache = DiskCache(tmp_path / "cache", max_bytes=300)
+    for key in ("a", "b", "nested/c"):
+        cache.write(key, [b"x" * 100], {"etag": key})
+    assert cache.usage() == 300 and cache.read_meta("nested/c")["etag"] == "nested/c"
+
+    # "a" was used last, "b" is the least recently used
+    cache.record_hit("a", cache.read_meta("a"))
+    cache.write("d", [b"y" * 50, b"y" * 50])
+    assert not (cache.root / "b").exists() and cache.read_meta("b") is None
+    assert sorted(key for key, _, _ in cache.entries()) == ["a", "d", "nested/c"]
+    # an entry larger than the budget is still returned, evicting everything else
+    cache.write("big", [b"z" * 500])
+    assert [key for key, _, _ in cache.entries()] == ["big"]
+    assert not list(cache.root.glob(".*.part"))
+
+    stats = cache.get_stats()
+    assert stats["hits"] == 1 and stats["misses"] == 5
+    assert stats["bytes_served_local"] == 100 and stats["bytes_fetched"] == 900
+    assert stats["hit_ratio"] == pytest.approx(1 / 6)
+
+    lfu = DiskCache(tmp_path / "lfu", max_bytes=200, policy="lfu")
+    lfu.write("a", [b"x" * 100])
+    lfu.write("b", [b"x" * 100])
+    lfu.record_hit("a", lfu.read_meta("a"))
+    lfu.record_hit("a", lfu.read_meta("a"))
+    lfu.record_hit("b", lfu.read_meta("b"))
+    lfu.write("c", [b"x" * 100])
+    # "b" was used more recently than "a", but less often
+    assert sorted(key for key, _, _ in lfu.entries()) == ["a", "c"]
+
+    # writes and evictions go through the in-memory index, not a rescan
+    lfu.entries = lambda: pytest.fail("rescanned")
+    with lfu.lock("c"):
+        pass
+    with lfu.lock("d"):
+        lfu.write("d", [b"x" * 100])
+    # evicted entries leave no meta or lock file behind
+    assert lfu.usage() == 200
+    assert not (lfu.meta_dir / "c.lock").exists() and not (lfu.meta_dir / "c.json").exists()
+    lfu.remove("d")
+    assert lfu.usage() == 100 and not (lfu.meta_dir / "d.lock").exists()
+    # the thread locks of a process do not grow with the keys it has seen
+    from server.common.repo.disk_cache import LOCK_STRIPES
+    for i in range(2 * LOCK_STRIPES):
+        with lfu.lock(f"key-{i}"):
+            pass
+    assert len(lfu._thread_locks) == LOCK_STRIPES
+
+
+def test_s3_cache_budget(mock_s3_repo, monkeypatch):
+    s3 = mock_s3_repo
+    monkeypatch.setattr(s3.cache, "max_bytes", 2048)
+    for key in ("first", "second", "third"):
+        s3.upload_bytes(bytes(1024), key)
+        s3.open_cached(key)
+    assert not (s3.cache_dir / "first").exists()
+    assert s3.open_cached("third") == s3.cache_dir / "third"
+    assert s3.open_cached("first").read_bytes() == bytes(1024)
+    stats = s3.get_cache_stats()
+    assert stats["hits"] == 1 and stats["misses"] == 4 and stats["bytes"] <= 2048
+
+
+def test_s3_shared_client_and_async_batches(mock_s3_repo):
+    import asyncio
+    s3 = mock_s3_repo
+    assert S3Repo(s3.config).s3 is s3.s3
+    assert S3PickleStorage().s3_repo is get_s3_repo()
+    assert s3.s3.meta.config.max_pool_connections == s3.config.S3_MAX_POOL_CONNECTIONS
+
+    async def roundtrip():
+        items = {f"batch/{i}": bytes([i]) * (i + 1) for i in range(20)}
+        assert await s3.put_many(items) == list(items)
+        fetched = await s3.get_many(items)
+        assert fetched == items
+        assert (await s3.open_cached_async("batch/3")).read_bytes() == items["batch/3"]
+        assert await s3.get_range_async("batch/19", 0, 4) == bytes([19]) * 5
+        with pytest.raises(HTTPException):
+            await s3.get_bytes_async("missing")
+
+    asyncio.run(roundtrip())
+
+
+class _FakeCollection:
+    def __init__(self):
+        self.docs = []
+        self.calls = []
+
+    def create_index(self, keys):
+        pass
+
+    def bulk_write(self, requests, ordered=True):
+        from types import SimpleNamespace
+        self.calls.append((len(requests), ordered))
+        self.docs.extend(request._doc for request in requests)
+        return SimpleNamespace(inserted_count=len(requests))
+
+
+def test_eeg_bucket_writer():
+    import numpy as np
+    from server.common.repo.eeg_buckets import EEGBucketWriter, unpack_bucket
+    collection = _FakeCollection()
+    writer = EEGBucketWriter(lambda: collection, bucket_seconds=10.0, flush_interval=60)
+    sfreq, ch_names = 250.0, ["C3", "C4", "Cz"]
+    data = np.random.rand(3, 6250).astype(np.float32)  # 25 s
+    timestamps = 1005.0 + np.arange(6250) / sfreq
+    for start in range(0, 6250, 100):
+        writer.enqueue("a", data[:, start:start + 100], timestamps[start:start + 100], ch_names)
+    writer.enqueue("b", data[:, :10], timestamps[:10], ch_names)
+    assert collection.docs == []  # nothing is written on the enqueue path
+
+    writer.flush()
+    # 1005-1010, 1010-1020, 1020-1030 for "a", one bucket for "b", in one unordered bulk write
+    assert collection.calls == [(4, False)]
+    docs = sorted((doc for doc in collection.docs if doc["session_id"] == "a"),
+                  key=lambda doc: doc["bucket_start"])
+    assert [doc["bucket_start"] for doc in docs] == [1000.0, 1010.0, 1020.0]
+    assert [doc["n_samples"] for doc in docs] == [1250, 2500, 2500]
+    assert docs[1]["min_ts"] == 1010.0 and docs[1]["max_ts"] == pytest.approx(1020.0 - 1 / sfreq)
+    samples, ts = unpack_bucket(docs[1], picks=["C4"])
+    assert np.array_equal(samples, data[[1], 1250:3750]) and np.array_equal(ts, timestamps[1250:3750])
+
+    stats = writer.get_stats()
+    assert stats["buckets_written"] == 4 and stats["enqueued_samples"] == 6260
+    writer.shutdown()
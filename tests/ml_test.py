@@ -12,6 +12,8 @@
 # # Testing machine learning module funcitonality
 
 import time
+import numpy as np
+from server.machine_learning.preprocessors import StreamingFilterBank
 from server.machine_learning.repo import MLRepo, S3MLRepo, LocalMLRepo
 from server.machine_learning.models import StorageType, TrainingStatus
 from server.machine_learning.service import MachineLearningService
@@ -28,7 +30,7 @@ def test_ml_service():
     # Create a new service instance
     service = MachineLearningService()
     assert service.model_queue == []
-    assert service.models == {}
+    assert len(service.models) == 0
     assert isinstance(service.repo, MLRepo)
     assert service.repo.storage_type == CONFIG.ML_CONFIG.MODEL_STORAGE
 
@@ -50,4 +52,351 @@ def test_ml_service():
     prediction = service.classify(session_id, data)
 
     assert prediction == "feet" or prediction == "rest"
-    
\ No newline at end of file
+    
+
+def test_streaming_filter_bank():
+    sfreq = 250
+    t = np.arange(5 * sfreq) / sfreq
+    # 10 Hz signal of interest plus 50 Hz line noise and a DC offset, on 4 channels
+    signal = np.sin(2 * np.pi * 10 * t)
+    eeg = np.stack([signal + 0.5 * np.sin(2 * np.pi * 50 * t) + 3 * ch
+                    for ch in range(4)])
+
+    whole = StreamingFilterBank(sfreq, notch_freq=50, car=False).preprocess(eeg)
+    bank = StreamingFilterBank(sfreq, notch_freq=50, car=False)
+    chunked = np.concatenate([bank.preprocess(eeg[:, i:i + 37])
+                              for i in range(0, eeg.shape[1], 37)], axis=1)
+    # filter state carries over between chunks
+    assert np.allclose(chunked, whole)
+
+    # after the initial transient the line noise and offset are gone, the 10 Hz signal stays
+    spectrum = np.abs(np.fft.rfft(chunked[:, sfreq:], axis=1)) / (4 * sfreq / 2)
+    freqs = np.fft.rfftfreq(4 * sfreq, 1 / sfreq)
+    assert np.all(spectrum[:, freqs == 10] > 0.9)
+    assert np.all(spectrum[:, freqs == 50] < 0.05)
+    assert np.all(spectrum[:, 0] < 0.05)
+
+    bank = StreamingFilterBank(sfreq, car=True)
+    referenced = bank.preprocess(eeg[:, :100])
+    assert np.allclose(referenced.mean(axis=0), 0)
+
+
+def test_training_scheduler():
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from server.machine_learning.scheduler import TrainingScheduler, TrainingQueueFull
+
+    release = threading.Event()
+    finished = threading.Event()
+
+    def train(value):
+        release.wait(5)
+        return value * 2
+
+    updates = []
+
+    def on_update(job):
+        updates.append((job.session_id, job.status))
+        if job.session_id == "b" and job.done:
+            finished.set()
+
+    scheduler = TrainingScheduler(max_workers=1, max_queue=2,
+                                  executor_factory=lambda n: ThreadPoolExecutor(n))
+    scheduler.submit("a", train, 1, on_update=on_update)
+    scheduler.submit("b", train, 2, on_update=on_update)
+    scheduler.submit("c", train, 3, on_update=on_update)
+    assert (scheduler.running, scheduler.queued) == (1, 2)
+    assert scheduler.get_job("a").status == TrainingStatus.IN_PROGRESS
+    assert scheduler.get_job("b").status == TrainingStatus.PENDING
+    # bounded queue pushes back instead of growing
+    with pytest.raises(TrainingQueueFull):
+        scheduler.submit("d", train, 4)
+
+    # queued jobs never start, running ones have their result discarded
+    assert scheduler.cancel("c")
+    assert scheduler.get_job("c").status == TrainingStatus.CANCELLED
+    assert scheduler.cancel("a")
+    assert not scheduler.cancel("a")
+    # but keep their worker until it returns
+    assert scheduler.get_job("a").status == TrainingStatus.CANCELLING
+    assert (scheduler.running, scheduler.queued) == (1, 1)
+    assert scheduler.get_job("b").status == TrainingStatus.PENDING
+
+    release.set()
+    assert finished.wait(5)
+    job = scheduler.get_job("b")
+    assert job.status == TrainingStatus.COMPLETED and job.result == 4
+    assert scheduler.get_job("a").status == TrainingStatus.CANCELLED
+    assert scheduler.get_job("a").result is None
+    assert updates[-2:] == [("b", TrainingStatus.IN_PROGRESS), ("b", TrainingStatus.COMPLETED)]
+    # finished jobs do not pin their arguments, and only the latest are kept
+    assert job.args == () and scheduler.get_job("a").args == ()
+    scheduler.max_history = 1
+    release.clear()
+    scheduler.submit("d", train, 4, on_update=on_update)
+    assert list(scheduler.jobs) == ["c", "d"]
+    release.set()
+    scheduler.shutdown(wait=True)
+
+    # the default pool runs jobs in separate processes
+    scheduler = TrainingScheduler(max_workers=1)
+    job = scheduler.submit("e", pow, 2, 10)
+    assert job.future.result(timeout=60) == 1024
+    scheduler.shutdown(wait=True)
+    assert job.status == TrainingStatus.COMPLETED
+
+
+def test_source_data_memmap_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(CONFIG.ML_CONFIG, "SOURCE_CACHE_DIR", str(tmp_path / "source"))
+    repo = LocalMLRepo()
+    repo.storage.cache_dir = tmp_path
+    source = {"data": np.random.rand(6, 3, 160), "events": np.ones((6, 3), dtype=int),
+              "sfreq": 160}
+    repo.storage.save(source, CONFIG.ML_CONFIG.SOURCE_DATA_FILE)
+
+    loaded = repo.load_source_data()
+    assert isinstance(loaded["data"], np.memmap)
+    assert not loaded["data"].flags.writeable
+    assert np.array_equal(loaded["data"], source["data"])
+    assert np.array_equal(loaded["events"], source["events"])
+    assert loaded["sfreq"] == 160
+
+    # later loads only map the cache, the pickle is not read again
+    monkeypatch.setattr(repo, "_load_from_storage", lambda filename: pytest.fail("reloaded"))
+    again = repo.load_source_data()
+    assert np.array_equal(again["data"], source["data"])
+    monkeypatch.undo()
+    monkeypatch.setattr(CONFIG.ML_CONFIG, "SOURCE_CACHE_DIR", str(tmp_path / "source"))
+
+    # the cache is rebuilt once the stored dataset changes
+    source["data"] = np.random.rand(8, 3, 160)
+    repo.storage.save(source, CONFIG.ML_CONFIG.SOURCE_DATA_FILE)
+    assert np.array_equal(repo.load_source_data()["data"], source["data"])
+
+    # or another dataset is configured
+    monkeypatch.setattr(CONFIG.ML_CONFIG, "SOURCE_DATA_FILE", "other_source.pkl")
+    other = dict(source, data=np.random.rand(8, 3, 160))
+    repo.storage.save(other, "other_source.pkl")
+    assert np.array_equal(repo.load_source_data()["data"], other["data"])
+
+
+def test_model_cache():
+    import threading
+    from server.machine_learning.cache import ModelCache
+
+    cache = ModelCache(max_bytes=100, sizeof=lambda model: model["size"])
+    cache.put(("a", "latest"), {"size": 40})
+    cache.put(("b", "latest"), {"size": 40})
+    assert cache.get(("a", "latest")) is not None
+    # "b" is the least recently used model and is evicted to fit "c"
+    cache.put(("c", "latest"), {"size": 40})
+    assert ("b", "latest") not in cache and ("a", "latest") in cache
+    assert cache.nbytes == 80
+    # models larger than the cache are not kept
+    cache.put(("d", "latest"), {"size": 200})
+    assert ("d", "latest") not in cache
+
+    # concurrent requests for a cold model trigger a single load
+    calls = []
+    release = threading.Event()
+
+    def loader():
+        calls.append(1)
+        release.wait(5)
+        return {"size": 10}
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_load(("e", "latest"), loader)))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(calls) == 1
+    assert len(results) == 4 and all(result is results[0] for result in results)
+
+    cache.invalidate("e")
+    assert ("e", "latest") not in cache
+    stats = cache.get_stats()
+    assert stats["evictions"] == 1 and stats["loads"] == 1
+    assert stats["hits"] >= 1 and stats["misses"] >= 1
+
+    # a load racing with an invalidation does not bring the old model back
+    started, release = threading.Event(), threading.Event()
+
+    def slow_loader():
+        started.set()
+        release.wait(5)
+        return {"size": 10, "version": "old"}
+    thread = threading.Thread(target=cache.get_or_load, args=(("f", "latest"), slow_loader))
+    thread.start()
+    started.wait(5)
+    cache.invalidate("f")
+    cache.put(("f", "latest"), {"size": 10, "version": "new"})
+    release.set()
+    thread.join(5)
+    assert cache.get(("f", "latest"))["version"] == "new"
+    assert cache.get_stats()["stale_loads"] == 1
+
+    # missing models are not looked up again for a while
+    cache.miss_ttl = 60
+    lookups = []
+    assert cache.get_or_load(("g", "latest"), lambda: lookups.append(1)) is None
+    assert cache.get_or_load(("g", "latest"), lambda: lookups.append(1)) is None
+    assert lookups == [1] and cache.get_stats()["negative_hits"] == 1
+    cache.invalidate("g")
+    assert cache.get_or_load(("g", "latest"), lambda: {"size": 10})["size"] == 10
+
+
+def test_missing_model_lookups(tmp_path, monkeypatch):
+    service = MachineLearningService()
+    service.repo = LocalMLRepo()
+    service.repo.storage.cache_dir = tmp_path
+    service.models.miss_ttl = 60
+    loads = []
+    load = service.repo.storage.load
+    monkeypatch.setattr(service.repo.storage, "load", lambda path: loads.append(path) or load(path))
+
+    # an untrained session is looked up in storage once, not on every poll
+    assert service.load_model("untrained") is None
+    assert service.load_model("untrained") is None
+    assert len(loads) == 1
+    assert service.models.get_stats()["negative_hits"] == 1
+
+    # until its model is trained
+    service._model_trained("untrained", {"weights": [1, 2]})
+    assert service.load_model("untrained") == {"weights": [1, 2]}
+    service.batcher.shutdown()
+
+
+def test_inference_batcher():
+    import threading
+    from server.machine_learning.batching import InferenceBatcher
+
+    class FirstSampleModel:
+        def __init__(self):
+            self.batch_sizes = []
+
+        def predict_epochs(self, data):
+            self.batch_sizes.append(len(data))
+            return data[:, 0, 0]
+
+    shared, other = FirstSampleModel(), FirstSampleModel()
+    models = {"a": shared, "b": shared, "c": other, "d": None}
+    resolved_on = []
+
+    def resolve_model(session_id):
+        resolved_on.append(threading.current_thread().name)
+        return models.get(session_id)
+    batcher = InferenceBatcher(resolve_model, max_batch_size=64, max_delay=0.2)
+
+    def epochs(value, n):
+        return np.full((n, 2, 10), value, dtype=np.float32)
+
+    futures = {}
+    start = threading.Barrier(4)
+
+    def submit(session_id, value, n):
+        start.wait()
+        futures[session_id] = batcher.submit(session_id, epochs(value, n))
+    threads = [threading.Thread(target=submit, args=args)
+               for args in [("a", 1, 2), ("b", 2, 3), ("c", 3, 1), ("d", 4, 1)]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # each session gets back its own predictions
+    assert futures["a"].result(5) == [1, 1]
+    assert futures["b"].result(5) == [2, 2, 2]
+    assert futures["c"].result(5) == [3]
+    with pytest.raises(ValueError):
+        futures["d"].result(0)
+    # models are resolved by the submitting threads, never by the batching one
+    assert len(resolved_on) == 4 and "inference-batcher" not in resolved_on
+    # sessions sharing a model are classified in a single call
+    assert shared.batch_sizes == [5]
+    assert other.batch_sizes == [1]
+    assert batcher.stats["batches"] == 1
+
+    # full batches do not wait for the deadline
+    batcher.max_batch_size, batcher.max_delay = 4, 60
+    assert batcher.predict("a", epochs(5, 4)) == [5] * 4
+    batcher.shutdown()
+
+
+def _synthetic_recording(seed, sfreq=250, n_trials=24):
+    import mne
+    rng = np.random.default_rng(seed)
+    channels = ["C3", "C4", "Cz", "P3", "P4", "T7", "T8", "Fz"]
+    patterns = {"feet": np.array([1, 0, 3, 0, 0, 0, 0, 0.5]), "rest": np.array([0, 3, 0, 1, 2, 0, 0, 0])}
+    times = np.arange(int((n_trials * 5 + 2) * sfreq)) / sfreq
+    data = rng.normal(0, 1, (len(channels), len(times)))
+    onsets, labels = [], []
+    for trial in range(n_trials):
+        label = "feet" if trial % 2 == 0 else "rest"
+        onset = 1 + trial * 5
+        start, stop = int(onset * sfreq), int((onset + 4) * sfreq)
+        data[:, start:stop] += patterns[label][:, None] * np.sin(2 * np.pi * 12 * times[start:stop] + rng.uniform(0, 6))
+        onsets.append(onset)
+        labels.append(label)
+    raw = mne.io.RawArray(data * 1e-5, mne.create_info(channels, sfreq, "eeg"), verbose=False)
+    raw.set_montage("standard_1020")
+    raw.set_annotations(mne.Annotations(onsets, [4] * n_trials, labels))
+    return raw
+
+
+def test_session_model_preprocessing():
+    from latss import LATSS
+    from server.machine_learning.model import SessionModel
+
+    class Params:
+        def get_params(self):
+            return {"sfreq": 160, "epoch_length": 2, "window_size": 1, "window_overlap": 0.2}
+
+    event_id = {"rest": 0, "feet": 1}
+    # source subject, preprocessed the same way at the model's sampling rate
+    source = _synthetic_recording(1)
+    preprocessor = SessionModel(Params(), remove_artifacts=False)
+    preprocessor.sfreq, preprocessor.info = source.info["sfreq"], source.info
+    windows, labels = preprocessor.calibration_windows(source, event_id)
+    source_data = {"data": preprocessor.transform(windows),
+                   "events": np.column_stack([np.zeros_like(labels), np.zeros_like(labels), labels])}
+    assert source_data["data"].shape[1:] == (8, 160)
+
+    recording = _synthetic_recording(2)
+    model = SessionModel(LATSS(source_data), ica_method="fastica").fit(recording, event_id)
+    assert model.sfreq == 250 and model.ica is not None
+    # live epochs are the model's window plus its filter context
+    assert model.epoch_length == pytest.approx(1.5)
+    assert model.window_overlap == 0.2
+
+    # epochs of the calibration recording are classified as they were labelled
+    windows, labels = model.calibration_windows(recording, event_id)
+    assert np.mean(np.asarray(model.predict_epochs(windows)) == labels) >= 0.9
+    with pytest.raises(ValueError):
+        SessionModel(Params()).predict_epochs(windows)
+
+
+class _Classifier:
+    def get_params(self):
+        return {"sfreq": 160, "epoch_length": 2, "window_size": 1, "window_overlap": 0.2}
+
+
+def test_session_model_pickle_leaves_out_source(tmp_path):
+    import pickle
+    from server.machine_learning.model import SessionModel
+
+    np.save(tmp_path / "data.npy", np.ones((4, 2, 160)))
+    classifier = _Classifier()
+    classifier.source = np.load(tmp_path / "data.npy", mmap_mode="r")
+    classifier.labels = classifier.source[:, 0, 0]
+    classifier.weights = np.arange(3)
+    model = SessionModel(classifier)
+
+    loaded = pickle.loads(pickle.dumps(model))
+    assert loaded.model.source is None and loaded.model.labels is None
+    assert np.array_equal(loaded.model.weights, classifier.weights)
+    # the model in use keeps its source
+    assert model.model.source is classifier.source